@@ -1,16 +1,47 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, session
+from flask import (Flask, render_template, request, jsonify, redirect, url_for, send_file, session, g, Response,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import tempfile
+import threading
+import uuid
+import csv
+import hashlib
+import time
+import base64
+import json
+import heapq
+import re
+import sys
+import unicodedata
+try:
+    import fcntl
+except ImportError:  # Windows: SQLite migrations run without the cross-process lock
+    fcntl = None
+from dateutil import tz as dateutil_tz
 from dateutil.relativedelta import relativedelta
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import DBAPIError, IntegrityError
 import os
 import logging
-from sqlalchemy import text
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from sqlalchemy import event, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
 from openpyxl.utils import get_column_letter
-from io import BytesIO
+from io import BytesIO, StringIO, TextIOWrapper
 import requests
 
 # Configure logging
@@ -23,6 +54,11 @@ app = Flask(__name__, instance_relative_config=True)
 # Make sure the instance/ directory exists
 os.makedirs(app.instance_path, exist_ok=True)
 
+# `python app.py test` runs the suite, which drops tables; like conftest.py for pytest, point it at a
+# throwaway database before the engine is created rather than at DATABASE_URL or instance/sport_courses.db
+if __name__ == '__main__' and 'test' in sys.argv[1:]:
+    os.environ['DATABASE_URL'] = os.getenv('TEST_DATABASE_URL', 'sqlite:///:memory:')
+
 # Database configuration - use PostgreSQL on Railway, SQLite locally
 if os.getenv('DATABASE_URL'):
     # Railway PostgreSQL
@@ -35,9 +71,292 @@ else:
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', os.urandom(24).hex())
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# ---------------- Metrics ----------------
+# Prometheus metrics served at /metrics. Under gunicorn, gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR
+# at a shared directory so every worker's samples are aggregated; the dev server uses the in-process registry.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # optional bearer token required by /metrics
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency by Flask endpoint',
+                            ['endpoint', 'method'])
+REQUESTS_TOTAL = Counter('http_requests_total', 'Responses by Flask endpoint and status code',
+                         ['endpoint', 'method', 'status'])
+REQUEST_EXCEPTIONS = Counter('http_request_exceptions_total', 'Unhandled exceptions by Flask endpoint',
+                             ['endpoint'])
+DB_POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled DB connection',
+                                  buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30))
+OUTBOUND_HTTP_LATENCY = Histogram('outbound_http_duration_seconds', 'Latency of calls to external services',
+                                  ['service', 'outcome'])
+EXPORT_DURATION = Histogram('export_duration_seconds', 'Time to build an export file', ['export'],
+                            buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120))
+EXPORT_ROWS = Counter('export_rows_total', 'Rows written to export files', ['export'])
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waits for a free connection (or opens a new one)."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+def database_engine_options(uri):
+    """
+    Pool settings for the serving profile. gunicorn.conf.py sets DB_POOL_SIZE to the worker's thread count, so
+    every thread can hold a connection; pre-ping and recycle replace connections the server or a proxy dropped.
+    """
+    if ':memory:' in uri:
+        return {}  # in-memory SQLite keeps its own single-connection pool
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '2')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    }
+    if uri.startswith(('postgresql', 'postgres:')):
+        options['connect_args'] = {
+            # Server-side cap per statement, so a runaway query can't pin a connection past the worker timeout
+            'options': f"-c statement_timeout={int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000'))}",
+            'connect_timeout': 10,
+            'keepalives': 1,
+            'keepalives_idle': 30,
+        }
+    return options
+
+
+# Engine options must be in place before SQLAlchemy(app) creates the engine
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).update(
+    database_engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+
+# Shared by all threads so calls to the same service reuse kept-alive TLS connections
+_http_session = requests.Session()
+
+
+def outbound_request(service, method, url, **kwargs):
+    """requests.request() that records the call's latency and outcome under the given service name."""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        response = _http_session.request(method, url, **kwargs)
+        outcome = f'{response.status_code // 100}xx'
+        return response
+    finally:
+        OUTBOUND_HTTP_LATENCY.labels(service, outcome).observe(time.perf_counter() - started)
+
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+def _metrics_endpoint():
+    # Unmatched URLs share one label so scanners can't blow up the label cardinality
+    return request.endpoint or 'unmatched'
+
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None and request.endpoint != 'metrics':
+        endpoint = _metrics_endpoint()
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        REQUESTS_TOTAL.labels(endpoint, request.method, str(response.status_code)).inc()
+    return response
+
+
+@app.teardown_request
+def _record_request_exception(exc):
+    if exc is not None:
+        REQUEST_EXCEPTIONS.labels(_metrics_endpoint()).inc()
+
+
 db = SQLAlchemy(app)
 CORS(app)
 
+# ---------------- SQL instrumentation ----------------
+# Every request records its statements; SQL_TIMING_HEADERS=true also reports them in the response headers
+app.config['SQL_TIMING_HEADERS'] = os.getenv('SQL_TIMING_HEADERS', 'false').lower() == 'true'
+try:
+    SLOW_REQUEST_DB_MS = float(os.getenv('SLOW_REQUEST_DB_MS', '500'))
+except Exception:
+    SLOW_REQUEST_DB_MS = 500.0
+
+
+class QueryStats:
+    """Statements executed while a recorder was active: count, total DB time and the slowest one."""
+
+    def __init__(self):
+        self.statements = []
+        self.total_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_statement = None
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def add(self, statement, elapsed_ms):
+        self.statements.append(statement)
+        self.total_ms += elapsed_ms
+        if elapsed_ms >= self.slowest_ms:
+            self.slowest_ms = elapsed_ms
+            self.slowest_statement = statement
+
+
+_query_recorders = threading.local()  # per-thread stack of active QueryStats
+
+
+def start_query_recording():
+    stats = QueryStats()
+    _query_recorders.__dict__.setdefault('stack', []).append(stats)
+    return stats
+
+
+def stop_query_recording(stats):
+    stack = getattr(_query_recorders, 'stack', [])
+    if stats in stack:
+        stack.remove(stats)
+
+
+@contextmanager
+def record_queries():
+    """Record the statements this thread executes inside the block (nested recorders all see them)."""
+    stats = start_query_recording()
+    try:
+        yield stats
+    finally:
+        stop_query_recording(stats)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and getattr(_query_recorders, 'stack', None):
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    if started is None:
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    for stats in getattr(_query_recorders, 'stack', ()):
+        stats.add(statement, elapsed_ms)
+
+
+@app.before_request
+def _start_request_query_recording():
+    g.request_started = time.perf_counter()
+    g.query_stats = start_query_recording()
+
+
+@app.after_request
+def _add_query_timing_headers(response):
+    stats = g.get('query_stats')
+    if stats is not None and app.config['SQL_TIMING_HEADERS']:
+        total_ms = (time.perf_counter() - g.request_started) * 1000
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.total_ms:.2f};desc="{stats.count} queries", '
+            f'db-slowest;dur={stats.slowest_ms:.2f}, total;dur={total_ms:.2f}')
+    return response
+
+
+@app.teardown_request
+def _stop_request_query_recording(exc):
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return
+    stop_query_recording(stats)
+    if stats.total_ms > SLOW_REQUEST_DB_MS:
+        logger.warning(f"Slow DB request {request.method} {request.path}: {stats.count} queries, "
+                       f"{stats.total_ms:.1f} ms; slowest {stats.slowest_ms:.1f} ms: {stats.slowest_statement[:300]}")
+
+
+# ---------------- SQLite tuning ----------------
+# Local and single-site deployments run on SQLite. In WAL mode readers keep going while a connection writes.
+# With synchronous=NORMAL a commit appends to the WAL without its own fsync, and busy_timeout makes concurrent
+# writers queue for the lock instead of failing with "database is locked". SQLITE_TUNING=false keeps SQLite's
+# defaults.
+SQLITE_TUNING = os.getenv('SQLITE_TUNING', 'true').lower() == 'true'
+SQLITE_PRAGMAS = (
+    ('auto_vacuum', 'INCREMENTAL'),  # must precede the first table; schema migration 7 converts older files
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))),
+    ('mmap_size', int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))),
+    ('cache_size', -int(os.getenv('SQLITE_CACHE_SIZE_KB', '65536'))),  # negative means KiB rather than pages
+    ('foreign_keys', 'ON'),
+    ('temp_store', 'MEMORY'),
+)
+SQLITE_MAINTENANCE_INTERVAL = float(os.getenv('SQLITE_MAINTENANCE_INTERVAL', '3600'))  # seconds, per process
+
+
+def tune_sqlite_connection(dbapi_connection, connection_record=None):
+    """Apply SQLITE_PRAGMAS to a new SQLite connection (a 'connect' listener on the engine)."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
+
+
+_sqlite_tuned = SQLITE_TUNING and app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite')
+if _sqlite_tuned:
+    with app.app_context():
+        event.listen(db.engine, 'connect', tune_sqlite_connection)
+
+_sqlite_maintenance_due = time.monotonic() + SQLITE_MAINTENANCE_INTERVAL
+_sqlite_maintenance_lock = threading.Lock()
+
+
+def run_sqlite_maintenance():
+    """
+    PRAGMA optimize refreshes the planner statistics that drifted since the last run, and incremental_vacuum
+    returns the pages freed by deletes to the filesystem.
+    """
+    try:
+        with app.app_context():
+            connection = db.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute('PRAGMA optimize')
+                cursor.execute('PRAGMA incremental_vacuum').fetchall()  # frees pages only as its rows are stepped
+                cursor.close()
+                connection.commit()
+            finally:
+                connection.close()
+    except Exception as e:
+        logger.error(f"SQLite maintenance failed: {e}")
+
+
+@app.after_request
+def _schedule_sqlite_maintenance(response):
+    global _sqlite_maintenance_due
+    if not _sqlite_tuned or time.monotonic() < _sqlite_maintenance_due:
+        return response
+    with _sqlite_maintenance_lock:
+        if time.monotonic() < _sqlite_maintenance_due:
+            return response
+        _sqlite_maintenance_due = time.monotonic() + SQLITE_MAINTENANCE_INTERVAL
+    # Runs once the response body has been sent, so no client waits for it
+    response.call_on_close(run_sqlite_maintenance)
+    return response
+
+
 # ---- Simple session-based auth configuration ----
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
 # Prefer a password hash via ADMIN_PASSWORD_HASH, else hash ADMIN_PASSWORD at startup
@@ -106,8 +425,8 @@ def send_landing_lead_email(form_data: dict):
     }
 
     try:
-        response = requests.post(
-            'https://api.sendgrid.com/v3/mail/send',
+        response = outbound_request(
+            'sendgrid', 'POST', 'https://api.sendgrid.com/v3/mail/send',
             headers={
                 'Authorization': f'Bearer {SENDGRID_API_KEY}',
                 'Content-Type': 'application/json'
@@ -140,7 +459,8 @@ GI_SEND_EMAIL = (os.getenv('GI_SEND_EMAIL', 'false').lower() == 'true')
 def _gi_token():
     if not GI_CLIENT_ID or not GI_CLIENT_SECRET:
         raise RuntimeError('Green Invoice credentials are not configured')
-    r = requests.post(f'{GI_API_BASE}/account/token', json={'id': GI_CLIENT_ID, 'secret': GI_CLIENT_SECRET}, timeout=20)
+    r = outbound_request('green_invoice', 'POST', f'{GI_API_BASE}/account/token',
+                         json={'id': GI_CLIENT_ID, 'secret': GI_CLIENT_SECRET}, timeout=20)
     r.raise_for_status()
     data = r.json()
     token = data.get('token')
@@ -156,9 +476,14 @@ def _gi_headers(token: str):
 # Database Models
 class Course(db.Model):
     __tablename__ = 'courses'
+    __table_args__ = (
+        db.Index('ix_courses_end_start', 'end_date', 'start_date'),  # active/overlapping-range filters
+        db.Index('ix_courses_coach_id', 'coach_id'),  # coach profile, feed, income and calendar filter
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
-    teacher = db.Column(db.String(100), nullable=False)
+    teacher = db.Column(db.String(100), nullable=False)  # display name; follows the coach's name when linked
+    coach_id = db.Column(db.Integer, db.ForeignKey('coaches.id'), nullable=True)
     start_date = db.Column(db.Date, nullable=False)
     time = db.Column(db.String(10), nullable=False)  # Format: "HH:MM"
     duration = db.Column(db.Integer, nullable=False, default=60)  # Duration in minutes for each meeting
@@ -167,12 +492,14 @@ class Course(db.Model):
     weekdays = db.Column(db.String(50), nullable=False)  # Format: "0,2,5" (Sunday=0, Saturday=6)
     end_date = db.Column(db.Date, nullable=False)
     color = db.Column(db.String(7), nullable=False, default='#3B82F6')  # Default blue color
+    monthly_fee = db.Column(db.Float, nullable=True)  # amount due per student per month; None if not tracked
 
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
             'teacher': self.teacher,
+            'coach_id': self.coach_id,
             'start_date': self.start_date.strftime('%Y-%m-%d'),
             'time': self.time,
             'duration': self.duration,
@@ -180,7 +507,8 @@ class Course(db.Model):
             'sessions_per_week': self.sessions_per_week,
             'weekdays': self.weekdays,
             'end_date': self.end_date.strftime('%Y-%m-%d'),
-            'color': self.color
+            'color': self.color,
+            'monthly_fee': self.monthly_fee
         }
 
 
@@ -191,13 +519,17 @@ class Coach(db.Model):
     last_name = db.Column(db.String(50), nullable=False)
     phone = db.Column(db.String(20), unique=True, nullable=False)
 
+    @property
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}".strip()
+
     def to_dict(self):
         return {
             'id': self.id,
             'first_name': self.first_name,
             'last_name': self.last_name,
             'phone': self.phone,
-            'full_name': f"{self.first_name} {self.last_name}".strip()
+            'full_name': self.full_name
         }
 
 
@@ -230,6 +562,10 @@ class Student(db.Model):
 
 class Enrollment(db.Model):
     __tablename__ = 'course_enrollments'
+    __table_args__ = (
+        db.Index('uq_course_enrollments_course_student', 'course_id', 'student_id', unique=True),
+        db.Index('ix_course_enrollments_student_id', 'student_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
@@ -239,6 +575,13 @@ class Enrollment(db.Model):
 
 class Payment(db.Model):
     __tablename__ = 'payments'
+    __table_args__ = (
+        db.Index('ix_payments_student_course_month', 'student_id', 'course_id', 'month'),
+        # Income analysis reads (course, date, amount) straight from these two, without touching the table
+        db.Index('ix_payments_course_date_amount', 'course_id', 'payment_date', 'amount'),
+        db.Index('ix_payments_date_amount', 'payment_date', 'amount'),
+        db.Index('ix_payments_month', 'month'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
@@ -250,6 +593,11 @@ class Payment(db.Model):
     student = db.relationship('Student', backref='payments')
     course = db.relationship('Course', backref='payments')
 
+    @classmethod
+    def listing_options(cls):
+        """Query options for listings that serialize with to_dict(), so rows don't lazy-load one by one."""
+        return joinedload(cls.student), joinedload(cls.course)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -265,18 +613,54 @@ class Payment(db.Model):
         }
 
 
+class RevenueRollup(db.Model):
+    """
+    Payment totals per payment month, course and method, kept current in the same transaction as every payment
+    write so the analysis views never scan payments. Coach and course name are joined from courses when read,
+    so reassigning or renaming a course needs no rollup rewrite.
+    """
+    __tablename__ = 'revenue_rollup'
+    month = db.Column(db.String(7), primary_key=True)  # "YYYY-MM" of payment_date ('' without a date)
+    course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), primary_key=True)
+    payment_method = db.Column(db.String(20), primary_key=True)  # '' for payments without a method
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    payment_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CourseSession(db.Model):
+    """One planned occurrence of a course, materialized from Course.weekdays/start_date/end_date."""
+    __tablename__ = 'course_sessions'
+    __table_args__ = (
+        db.UniqueConstraint('course_id', 'date', name='uq_course_sessions_course_date'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
+    time = db.Column(db.String(10), nullable=False)  # Format: "HH:MM"
+    duration = db.Column(db.Integer, nullable=False, default=60)
+    ordinal = db.Column(db.Integer, nullable=False)  # 0-based session number counted from course.start_date
+
+
 class CourseMeeting(db.Model):
     __tablename__ = 'course_meetings'
+    __table_args__ = (
+        db.Index('ix_course_meetings_course_date', 'course_id', 'date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     notes = db.Column(db.String(255))
+    session_id = db.Column(db.Integer, db.ForeignKey('course_sessions.id'), nullable=True)  # planned session it fulfils
     course = db.relationship('Course', backref=db.backref('meetings', lazy=True))
-    attendances = db.relationship('Attendance', backref='meeting', lazy=True)
+    attendances = db.relationship('Attendance', backref='meeting', lazy=True, order_by='Attendance.id')
 
 
 class Attendance(db.Model):
     __tablename__ = 'attendances'
+    __table_args__ = (
+        db.Index('uq_attendances_meeting_student', 'meeting_id', 'student_id', unique=True),
+        db.Index('ix_attendances_student_id', 'student_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     meeting_id = db.Column(db.Integer, db.ForeignKey('course_meetings.id'), nullable=False)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
@@ -284,23 +668,382 @@ class Attendance(db.Model):
     student = db.relationship('Student', backref=db.backref('attendances', lazy=True))
 
 
-def create_database():
-    with app.app_context():
-        db.create_all()
+class DataVersion(db.Model):
+    """Monotonic counter per data scope, bumped in the same transaction as every write to that scope."""
+    __tablename__ = 'data_versions'
+    scope = db.Column(db.String(30), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)  # UTC
 
-        # Add color column to existing courses if it doesn't exist
-        try:
-            if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+
+class DataChange(db.Model):
+    """Keys written at each data version of a scope, so in-memory indexes can catch up without a rebuild."""
+    __tablename__ = 'data_changes'
+    __table_args__ = (db.Index('ix_data_changes_scope_version', 'scope', 'version'),)
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(30), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    key = db.Column(db.Integer, nullable=False)
+
+
+class SchemaMigration(db.Model):
+    """One row per applied schema migration; the highest version is the schema version of the database."""
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ExportJob(db.Model):
+    """An export built in the background into the EXPORT_DIR directory, downloadable until expires_at."""
+    __tablename__ = 'export_jobs'
+    id = db.Column(db.String(32), primary_key=True)  # random, so download URLs can't be guessed
+    kind = db.Column(db.String(30), nullable=False)
+    period = db.Column(db.String(20), nullable=False)
+    cache_key = db.Column(db.String(200), nullable=False, index=True)  # kind, period and data versions
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    rows_total = db.Column(db.Integer, nullable=True)
+    filename = db.Column(db.String(200), nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # progress heartbeat
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'period': self.period,
+            'status': self.status,
+            'rows_done': self.rows_done,
+            'rows_total': self.rows_total,
+            'progress': round(self.rows_done / self.rows_total, 4) if self.rows_total else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() + 'Z',
+            'finished_at': self.finished_at.isoformat() + 'Z' if self.finished_at else None,
+            'expires_at': self.expires_at.isoformat() + 'Z',
+            'status_url': url_for('get_export_job', job_id=self.id),
+            'download_url': url_for('download_export_job', job_id=self.id) if self.status == 'done' else None
+        }
+
+
+# ---------------- Schema migrations ----------------
+# Databases created by older versions are upgraded by the ordered steps in MIGRATIONS. Each step must be
+# idempotent, since databases that predate the schema_migrations table may already be partly migrated.
+# run_migrations applies pending steps under a database-wide lock, so only one process migrates while the
+# others wait and then find the schema current. After that a process only checks the version once.
+
+MIGRATION_LOCK_KEY = 7_420_115  # pg_advisory_lock key, any constant unique to this app
+
+
+def _migrate_courses_columns():
+    """Add courses.duration and courses.color."""
+    inspector = db.inspect(db.engine)
+    if 'courses' not in inspector.get_table_names():
+        return
+    course_columns = [col['name'] for col in inspector.get_columns('courses')]
+    missing_columns = [col for col in ('duration', 'color') if col not in course_columns]
+    if not missing_columns:
+        return
+    try:
+        for col in missing_columns:
+            if col == 'duration':
+                db.session.execute(text('ALTER TABLE courses ADD COLUMN duration INTEGER DEFAULT 60'))
+            elif 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
                 db.session.execute(text('ALTER TABLE courses ADD COLUMN color VARCHAR(7) DEFAULT "#3B82F6"'))
             else:
                 db.session.execute(text('ALTER TABLE courses ADD COLUMN color VARCHAR(7) DEFAULT \'#3B82F6\''))
+        db.session.commit()
+        logger.info(f"Added missing columns to courses table: {missing_columns}")
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error adding columns to courses table: {e}")
+        # If ALTER TABLE fails, recreate the table
+        db.session.execute(text('DROP TABLE IF EXISTS courses CASCADE'))
+        db.session.commit()
+        Course.__table__.create(db.engine)
+        logger.info("Recreated courses table with correct schema")
+
+
+def _migrate_payments_columns():
+    """Recreate payments tables from before course_id/amount existed, and add payments.payment_method."""
+    inspector = db.inspect(db.engine)
+    if 'payments' not in inspector.get_table_names():
+        return
+    payment_columns = [col['name'] for col in inspector.get_columns('payments')]
+    if 'course_id' not in payment_columns or 'amount' not in payment_columns:
+        db.session.execute(text('DROP TABLE IF EXISTS payments CASCADE'))
+        db.session.commit()
+        Payment.__table__.create(db.engine)
+        logger.info("Payment table recreated successfully!")
+    elif 'payment_method' not in payment_columns:
+        db.session.execute(text('ALTER TABLE payments ADD COLUMN payment_method VARCHAR(20)'))
+        db.session.commit()
+        logger.info("Added payment_method column to existing payments table")
+
+
+def _migrate_course_sessions():
+    """Add course_meetings.session_id, and create and backfill course_sessions for existing courses."""
+    inspector = db.inspect(db.engine)
+    table_names = inspector.get_table_names()
+    if 'course_meetings' in table_names:
+        meeting_columns = [col['name'] for col in inspector.get_columns('course_meetings')]
+        if 'session_id' not in meeting_columns:
+            db.session.execute(text('ALTER TABLE course_meetings ADD COLUMN session_id INTEGER'))
             db.session.commit()
-            logger.info("Added color column to existing courses")
-        except Exception as e:
-            # Column might already exist
-            logger.info(f"Color column might already exist: {e}")
+            logger.info("Added session_id column to course_meetings table")
+    if 'course_sessions' not in table_names and 'courses' in table_names:
+        CourseSession.__table__.create(db.engine)
+        backfill_course_sessions()
+
 
-        logger.info("Database created successfully with correct schema!")
+def _migrate_missing_tables():
+    """Create the tables added since the database was created (coaches, data_versions, ...)."""
+    db.create_all()
+
+
+def _migrate_attendance_unique_index():
+    """
+    Add the (meeting_id, student_id) unique index that attendance upserts rely on, keeping the newest
+    row of any duplicates left by older versions.
+    """
+    index_names = {ix['name'] for ix in db.inspect(db.engine).get_indexes('attendances')}
+    if 'uq_attendances_meeting_student' in index_names:
+        return
+    db.session.execute(text(
+        'DELETE FROM attendances WHERE id NOT IN '
+        '(SELECT MAX(id) FROM attendances GROUP BY meeting_id, student_id)'))
+    db.session.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_attendances_meeting_student '
+        'ON attendances (meeting_id, student_id)'))
+    db.session.commit()
+    logger.info("Added unique index on attendances (meeting_id, student_id)")
+
+
+def ensure_indexes():
+    """
+    Create the non-unique model indexes missing from tables that predate them (create_all skips existing
+    tables). Unique indexes need their data cleaned first and get a migration of their own. Indexes on
+    columns a later migration adds are left to that migration, which calls this again.
+    """
+    inspector = db.inspect(db.engine)
+    table_names = inspector.get_table_names()
+    for table in db.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        columns = {col['name'] for col in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if index.unique or index.name in existing:
+                continue
+            if {column.name for column in index.columns} <= columns:
+                index.create(db.engine)
+                logger.info(f"Created index {index.name}")
+
+
+def _migrate_sqlite_incremental_vacuum():
+    """Switch SQLite files created without auto-vacuum to incremental mode, which takes a one-off VACUUM."""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:  # 2 = INCREMENTAL
+            cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            cursor.execute('VACUUM')
+            logger.info("Rebuilt the SQLite database with incremental auto-vacuum")
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def _migrate_revenue_rollup():
+    """Create revenue_rollup and fill it from the existing payments."""
+    RevenueRollup.__table__.create(db.engine, checkfirst=True)
+    rebuild_revenue_rollup()
+
+
+def _migrate_course_coach_id():
+    """
+    Add courses.coach_id and link each course whose teacher matches exactly one coach's full name (ignoring
+    case and repeated spaces), taking the coach's spelling of the name. Unmatched courses keep only their
+    teacher name.
+    """
+    course_columns = [col['name'] for col in db.inspect(db.engine).get_columns('courses')]
+    if 'coach_id' not in course_columns:
+        db.session.execute(text('ALTER TABLE courses ADD COLUMN coach_id INTEGER REFERENCES coaches (id)'))
+        db.session.commit()
+    ensure_indexes()
+
+    coaches = {}
+    for coach in Coach.query:
+        coaches.setdefault(normalize_coach_name(coach.full_name), []).append(coach)
+    links = []
+    for course_id, teacher in db.session.query(Course.id, Course.teacher).filter(Course.coach_id.is_(None)):
+        matches = coaches.get(normalize_coach_name(teacher), [])
+        if len(matches) == 1:
+            links.append({'id': course_id, 'coach_id': matches[0].id, 'teacher': matches[0].full_name})
+    if links:
+        db.session.execute(db.update(Course), links)
+    bump_data_version(SCHEDULE_SCOPE, COURSES_SCOPE)
+    db.session.commit()
+    logger.info(f"Linked {len(links)} courses to their coaches")
+
+
+def _migrate_course_teacher_names():
+    """Give courses linked by an earlier version of step 9 their coach's spelling of the teacher name."""
+    renames = [{'id': course_id, 'teacher': f"{first_name} {last_name}".strip()}
+               for course_id, teacher, first_name, last_name in
+               db.session.query(Course.id, Course.teacher, Coach.first_name, Coach.last_name).join(
+                   Coach, Course.coach_id == Coach.id)
+               if teacher != f"{first_name} {last_name}".strip()]
+    if renames:
+        db.session.execute(db.update(Course), renames)
+        bump_data_version(SCHEDULE_SCOPE, COURSES_SCOPE)
+    db.session.commit()
+    logger.info(f"Renamed the teacher of {len(renames)} linked courses to their coach's name")
+
+
+def _migrate_course_monthly_fee():
+    """Add courses.monthly_fee, the amount due per enrolled student per month."""
+    if 'monthly_fee' not in [col['name'] for col in db.inspect(db.engine).get_columns('courses')]:
+        db.session.execute(text('ALTER TABLE courses ADD COLUMN monthly_fee FLOAT'))
+        db.session.commit()
+
+
+def _migrate_export_jobs():
+    ExportJob.__table__.create(db.engine, checkfirst=True)
+
+
+def _migrate_enrollments_unique_index():
+    """
+    Replace the (course_id, student_id) index with the unique index that bulk enrollment's conflict-ignore
+    inserts rely on, keeping the first enrollment of any student enrolled twice in a course.
+    """
+    index_names = {ix['name'] for ix in db.inspect(db.engine).get_indexes('course_enrollments')}
+    if 'uq_course_enrollments_course_student' not in index_names:
+        removed = db.session.execute(text(
+            'DELETE FROM course_enrollments WHERE id NOT IN '
+            '(SELECT MIN(id) FROM course_enrollments GROUP BY course_id, student_id)')).rowcount
+        db.session.execute(text(
+            'CREATE UNIQUE INDEX IF NOT EXISTS uq_course_enrollments_course_student '
+            'ON course_enrollments (course_id, student_id)'))
+        if removed:
+            bump_data_version(SCHEDULE_SCOPE)
+        logger.info(f"Added unique index on course_enrollments (course_id, student_id), removing {removed} duplicates")
+    db.session.execute(text('DROP INDEX IF EXISTS ix_course_enrollments_course_student'))
+    db.session.commit()
+
+
+def _migrate_data_changes():
+    DataChange.__table__.create(db.engine, checkfirst=True)
+
+
+def _migrate_drop_course_teacher_index():
+    """Drop ix_courses_teacher: the schedule index looks courses up by coach_id, and nothing filters on teacher."""
+    db.session.execute(text('DROP INDEX IF EXISTS ix_courses_teacher'))
+    db.session.commit()
+
+
+# Append new steps with the next version number; never renumber or edit an applied step
+MIGRATIONS = [
+    (1, 'courses duration and color columns', _migrate_courses_columns),
+    (2, 'payments course, amount and method columns', _migrate_payments_columns),
+    (3, 'course sessions', _migrate_course_sessions),
+    (4, 'missing tables', _migrate_missing_tables),
+    (5, 'attendances unique index', _migrate_attendance_unique_index),
+    (6, 'query indexes', ensure_indexes),
+    (7, 'sqlite incremental auto-vacuum', _migrate_sqlite_incremental_vacuum),
+    (8, 'revenue rollup', _migrate_revenue_rollup),
+    (9, 'courses coach_id', _migrate_course_coach_id),
+    (10, 'courses monthly_fee', _migrate_course_monthly_fee),
+    (11, 'export jobs', _migrate_export_jobs),
+    (12, 'enrollments unique index', _migrate_enrollments_unique_index),
+    (13, 'data change log', _migrate_data_changes),
+    (14, 'linked course teacher names', _migrate_course_teacher_names),
+    (15, 'drop courses teacher index', _migrate_drop_course_teacher_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version():
+    """Highest applied migration, or 0 when the database predates schema_migrations."""
+    try:
+        return db.session.query(db.func.max(SchemaMigration.version)).scalar() or 0
+    except DBAPIError:
+        db.session.rollback()
+        return 0
+
+
+def stamp_schema_version():
+    """Record every migration as applied, for databases created from the current models."""
+    applied = {version for (version,) in db.session.query(SchemaMigration.version)}
+    db.session.add_all(SchemaMigration(version=version, name=name)
+                       for version, name, _ in MIGRATIONS if version not in applied)
+    db.session.commit()
+
+
+@contextmanager
+def migration_lock():
+    """
+    Hold a database-wide lock while migrating: a session advisory lock on PostgreSQL, or an exclusive
+    lock on a file beside the SQLite database. In-memory databases belong to a single process.
+    """
+    engine = db.engine
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        return
+    database = engine.url.database
+    if engine.dialect.name != 'sqlite' or not database or database == ':memory:' or fcntl is None:
+        yield
+        return
+    with open(f"{database}.migrate-lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_migrations():
+    """
+    Bring the database schema to SCHEMA_VERSION. Costs one query when it is already current. Returns
+    False when a step failed; that step and the ones after it are retried on the next start.
+    """
+    if get_schema_version() >= SCHEMA_VERSION:
+        return True
+    with migration_lock():
+        # Another process may have migrated while this one waited for the lock
+        version = get_schema_version()
+        if version >= SCHEMA_VERSION:
+            return True
+        table_names = set(db.inspect(db.engine).get_table_names())
+        if not table_names - {SchemaMigration.__tablename__}:
+            db.create_all()
+            stamp_schema_version()
+            logger.info("Database created successfully with correct schema!")
+            return True
+        SchemaMigration.__table__.create(db.engine, checkfirst=True)
+        for step_version, name, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            try:
+                step()
+                db.session.add(SchemaMigration(version=step_version, name=name))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Schema migration {step_version} ({name}) failed: {e}")
+                return False
+            logger.info(f"Applied schema migration {step_version}: {name}")
+    return True
 
 
 def reset_database():
@@ -313,107 +1056,22 @@ def reset_database():
 
             # Create all tables with current schema
             db.create_all()
+            stamp_schema_version()
             logger.info("Created all tables with current schema")
 
+            # Data versions restart from zero, so cached responses must not outlive the old tables
+            calendar_cache.clear()
+            ics_cache.clear()
+            _version_snapshots.clear()
+            coach_schedule_index.version = None
+            student_search_index.version = None
+
             return True
         except Exception as e:
             logger.error(f"Error resetting database: {e}")
             return False
 
 
-def migrate_existing_data():
-    with app.app_context():
-        # Check if we need to migrate existing tables
-        inspector = db.inspect(db.engine)
-        table_names = inspector.get_table_names()
-
-        # If no tables exist, create all tables
-        if not table_names:
-            db.create_all()
-            logger.info("Database created successfully with correct schema!")
-            return
-
-        # Check if courses table exists and has all required columns
-        if 'courses' in table_names:
-            course_columns = [col['name'] for col in inspector.get_columns('courses')]
-            missing_columns = []
-
-            if 'duration' not in course_columns:
-                missing_columns.append('duration')
-            if 'color' not in course_columns:
-                missing_columns.append('color')
-
-            # Add missing columns based on database type
-            if missing_columns:
-                try:
-                    if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
-                        # SQLite syntax
-                        for col in missing_columns:
-                            if col == 'duration':
-                                db.session.execute(text('ALTER TABLE courses ADD COLUMN duration INTEGER DEFAULT 60'))
-                            elif col == 'color':
-                                db.session.execute(
-                                    text('ALTER TABLE courses ADD COLUMN color VARCHAR(7) DEFAULT "#3B82F6"'))
-                    else:
-                        # PostgreSQL syntax
-                        for col in missing_columns:
-                            if col == 'duration':
-                                db.session.execute(text('ALTER TABLE courses ADD COLUMN duration INTEGER DEFAULT 60'))
-                            elif col == 'color':
-                                db.session.execute(
-                                    text('ALTER TABLE courses ADD COLUMN color VARCHAR(7) DEFAULT \'#3B82F6\''))
-
-                    db.session.commit()
-                    logger.info(f"Added missing columns to courses table: {missing_columns}")
-                except Exception as e:
-                    logger.error(f"Error adding columns to courses table: {e}")
-                    # If ALTER TABLE fails, recreate the table
-                    try:
-                        db.session.execute(text('DROP TABLE IF EXISTS courses CASCADE'))
-                        db.create_all()
-                        logger.info("Recreated courses table with correct schema")
-                    except Exception as e2:
-                        logger.error(f"Error recreating courses table: {e2}")
-
-        # Check payments table
-        if 'payments' in table_names:
-            payment_columns = [col['name'] for col in inspector.get_columns('payments')]
-            missing_payment_columns = []
-
-            if 'course_id' not in payment_columns or 'amount' not in payment_columns:
-                # Drop and recreate the payments table
-                try:
-                    db.session.execute(text('DROP TABLE IF EXISTS payments CASCADE'))
-                    db.create_all()
-                    logger.info("Payment table recreated successfully!")
-                except Exception as e:
-                    logger.error(f"Error recreating payments table: {e}")
-            elif 'payment_method' not in payment_columns:
-                # Add payment_method column
-                try:
-                    if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
-                        db.session.execute(text('ALTER TABLE payments ADD COLUMN payment_method VARCHAR(20)'))
-                    else:
-                        db.session.execute(text('ALTER TABLE payments ADD COLUMN payment_method VARCHAR(20)'))
-                    db.session.commit()
-                    logger.info("Added payment_method column to existing payments table")
-                except Exception as e:
-                    logger.error(f"Error adding payment_method column: {e}")
-
-        # Ensure all tables exist
-        db.create_all()
-
-        # Ensure coaches table exists for existing DBs without running full migrations in prod
-        try:
-            inspector = db.inspect(db.engine)
-            if 'coaches' not in inspector.get_table_names():
-                Coach.__table__.create(db.engine)
-                logger.info("Created missing 'coaches' table")
-        except Exception as e:
-            logger.error(f"Error ensuring coaches table exists: {e}")
-        logger.info("Database migration completed successfully!")
-
-
 def compute_schedule_metrics(weekdays_str: str, sessions_count: int):
     """
     Return (sessions_per_week, total_weeks) derived from weekdays_str and sessions_count.
@@ -430,6 +1088,847 @@ def compute_schedule_metrics(weekdays_str: str, sessions_count: int):
     return sessions_per_week, total_weeks
 
 
+# ---------------- Schedule engine ----------------
+MAX_CALENDAR_RANGE_DAYS = 366
+
+
+def parse_weekdays(weekdays_str: str):
+    """Return the sorted set of Sunday-based weekdays (0=Sunday, 6=Saturday) in weekdays_str."""
+    return sorted({int(d) for d in (weekdays_str or "").split(",") if d.strip() != ""})
+
+
+def sunday_weekday(d):
+    """Python weekday() is Monday=0; the frontend and Course.weekdays use Sunday=0."""
+    return (d.weekday() + 1) % 7
+
+
+def sessions_before(start_date, weekdays, target_date):
+    """
+    Number of scheduled sessions on or after start_date and strictly before target_date.
+    Computed as full weeks * sessions per week plus the sessions in the trailing partial week,
+    so the cost does not depend on how long the course has been running.
+    """
+    days = (target_date - start_date).days
+    if days <= 0 or not weekdays:
+        return 0
+    full_weeks, partial_days = divmod(days, 7)
+    first = sunday_weekday(start_date)
+    partial = sum(1 for w in weekdays if (w - first) % 7 < partial_days)
+    return full_weeks * len(weekdays) + partial
+
+
+def iter_course_occurrences(course, range_start, range_end):
+    """
+    Yield (date, ordinal) for every occurrence of course between range_start and range_end (inclusive).
+    ordinal is the 0-based index of the session counted from course.start_date.
+    """
+    weekdays = parse_weekdays(course.weekdays)
+    lo = max(course.start_date, range_start)
+    hi = min(course.end_date, range_end)
+    if lo > hi or not weekdays:
+        return
+    first = sunday_weekday(lo)
+    dates = []
+    for w in weekdays:
+        d = lo + timedelta(days=(w - first) % 7)
+        while d <= hi:
+            dates.append(d)
+            d += timedelta(days=7)
+    dates.sort()
+    base = sessions_before(course.start_date, weekdays, lo)
+    for i, d in enumerate(dates):
+        yield d, base + i
+
+
+def regenerate_course_sessions(course):
+    """
+    Rebuild the course_sessions rows of a single course and relink its meetings to them.
+    Runs inside the caller's transaction; the caller commits.
+    """
+    # Unlink the meetings first so deleting their sessions doesn't violate course_meetings.session_id
+    CourseMeeting.query.filter_by(course_id=course.id).update({CourseMeeting.session_id: None},
+                                                              synchronize_session=False)
+    CourseSession.query.filter_by(course_id=course.id).delete(synchronize_session=False)
+    rows = [
+        {'course_id': course.id, 'date': occurrence_date, 'time': course.time,
+         'duration': course.duration, 'ordinal': ordinal}
+        for occurrence_date, ordinal in iter_course_occurrences(course, course.start_date, course.end_date)
+    ]
+    if rows:
+        db.session.execute(db.insert(CourseSession), rows)
+    CourseMeeting.query.filter_by(course_id=course.id).update({
+        CourseMeeting.session_id: db.session.query(CourseSession.id).filter(
+            CourseSession.course_id == CourseMeeting.course_id,
+            CourseSession.date == CourseMeeting.date
+        ).scalar_subquery()
+    }, synchronize_session=False)
+
+
+def backfill_course_sessions():
+    """Materialize sessions for every existing course (used when course_sessions is first created)."""
+    # Only the schedule columns: this runs in a migration, before later steps add newer Course columns
+    courses = Course.query.options(load_only(Course.id, Course.start_date, Course.end_date, Course.time,
+                                             Course.duration, Course.weekdays)).all()
+    for course in courses:
+        regenerate_course_sessions(course)
+    db.session.commit()
+    logger.info(f"Materialized course sessions for {len(courses)} courses")
+
+
+def build_calendar_events(range_start, range_end, coach_id=None, course_ids=None):
+    """
+    Return the calendar events between range_start and range_end (inclusive), sorted by date and time.
+
+    Events are an indexed range scan over course_sessions. Enrollment and meeting aggregates for the
+    visible courses are joined in from grouped subqueries, and the recorded meeting dates inside the
+    range come from a second query, so the statement count does not grow with the number of events.
+
+    classes_remaining follows real meetings where a course has any: sessions up to the last recorded
+    meeting are counted from CourseMeeting rows, later ones are projected from the weekday schedule.
+    """
+    enrollment_counts = db.session.query(
+        Enrollment.course_id.label('course_id'),
+        db.func.count(Enrollment.id).label('enrolled_count')
+    ).group_by(Enrollment.course_id).subquery()
+    meeting_counts = db.session.query(
+        CourseMeeting.course_id.label('course_id'),
+        db.func.count(CourseMeeting.id).label('meeting_count'),
+        db.func.sum(db.case((CourseMeeting.date < range_start, 1), else_=0)).label('meetings_before_range'),
+        db.func.max(CourseMeeting.date).label('last_meeting_date')
+    ).group_by(CourseMeeting.course_id).subquery()
+
+    query = db.session.query(
+        CourseSession,
+        Course,
+        db.func.coalesce(enrollment_counts.c.enrolled_count, 0),
+        db.func.coalesce(meeting_counts.c.meeting_count, 0),
+        db.func.coalesce(meeting_counts.c.meetings_before_range, 0),
+        meeting_counts.c.last_meeting_date
+    ).join(
+        Course, Course.id == CourseSession.course_id
+    ).outerjoin(
+        enrollment_counts, enrollment_counts.c.course_id == Course.id
+    ).outerjoin(
+        meeting_counts, meeting_counts.c.course_id == Course.id
+    ).filter(
+        CourseSession.date >= range_start,
+        CourseSession.date <= range_end
+    )
+    if coach_id is not None:
+        query = query.filter(Course.coach_id == coach_id)
+    if course_ids:
+        query = query.filter(Course.id.in_(course_ids))
+    rows = query.all()
+
+    # Recorded meeting dates inside the range, only needed for courses that have meetings there
+    meeting_dates = {}
+    if any(last_meeting_date and last_meeting_date >= range_start for *_, last_meeting_date in rows):
+        in_range = db.session.query(CourseMeeting.course_id, CourseMeeting.date).filter(
+            CourseMeeting.date >= range_start,
+            CourseMeeting.date <= range_end,
+            CourseMeeting.course_id.in_({row[1].id for row in rows})
+        ).order_by(CourseMeeting.date)
+        for course_id, meeting_date in in_range:
+            meeting_dates.setdefault(course_id, []).append(meeting_date)
+
+    calendar_data = []
+    for course_session, course, enrolled_count, meeting_count, meetings_before_range, last_meeting_date in rows:
+        if not meeting_count:
+            classes_completed = course_session.ordinal
+        elif course_session.date <= last_meeting_date:
+            classes_completed = meetings_before_range + bisect_left(
+                meeting_dates.get(course.id, []), course_session.date)
+        else:
+            # All recorded meetings are in the past; project the schedule from the day after the last one
+            classes_completed = meeting_count + course_session.ordinal - sessions_before(
+                course.start_date, parse_weekdays(course.weekdays), last_meeting_date + timedelta(days=1))
+        calendar_data.append({
+            'id': course.id,
+            'title': course.name,
+            'date': course_session.date.strftime('%Y-%m-%d'),
+            'time': course_session.time,
+            'duration': course_session.duration,
+            'teacher': course.teacher,
+            'color': course.color,
+            'enrolled_count': enrolled_count,
+            'classes_remaining': max(0, course.sessions_count - classes_completed)
+        })
+    calendar_data.sort(key=lambda x: (x['date'], x['time']))
+    return calendar_data
+
+
+# ---------------- Calendar response cache ----------------
+SCHEDULE_SCOPE = 'schedule'  # Course, Enrollment, CourseMeeting (and coach names used by the coach filter)
+COURSES_SCOPE = 'courses'  # Course definitions and coach names only, for the iCalendar feeds
+STUDENTS_SCOPE = 'students'  # Student rows, for the search index
+PAYMENTS_SCOPE = 'payments'  # Payment rows, for deduplicating export jobs
+DATA_VERSION_TTL_SECONDS = float(os.getenv('DATA_VERSION_TTL_SECONDS', '5'))
+DATA_CHANGE_RETENTION = int(os.getenv('DATA_CHANGE_RETENTION', '10000'))  # versions of a scope kept in data_changes
+
+_version_snapshots = {}
+
+
+def get_data_version(scope):
+    return db.session.query(DataVersion.version).filter_by(scope=scope).scalar() or 0
+
+
+def cached_data_version(scope):
+    """
+    Return (version, updated_at) of scope, re-reading the database at most every DATA_VERSION_TTL_SECONDS.
+    Writes from other workers become visible after at most that delay.
+    """
+    now = time.monotonic()
+    snapshot = _version_snapshots.get(scope)
+    if snapshot is None or now - snapshot[2] > DATA_VERSION_TTL_SECONDS:
+        row = db.session.query(DataVersion.version, DataVersion.updated_at).filter_by(scope=scope).first()
+        version, updated_at = row if row else (0, None)
+        snapshot = (version, updated_at, now)
+        _version_snapshots[scope] = snapshot
+    return snapshot[0], snapshot[1]
+
+
+def bump_data_version(*scopes, changed=None):
+    """
+    Increment the version of each scope inside the caller's transaction and return {scope: new version};
+    the caller commits. An upsert, so concurrent first writes to a scope don't collide on its primary key.
+
+    changed maps a scope to the keys (row ids) this write touched; they are logged in data_changes under
+    the new version so VersionedIndex can catch up on just those rows. A bump without keys makes indexes
+    over that scope rebuild.
+    """
+    now = datetime.utcnow()
+    insert = postgresql_insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+    versions = {}
+    for scope in scopes:
+        stmt = insert(DataVersion).values(scope=scope, version=1, updated_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['scope'],
+            set_={'version': DataVersion.version + 1, 'updated_at': now}).returning(DataVersion.version)
+        version = versions[scope] = db.session.execute(stmt).scalar_one()
+        _version_snapshots.pop(scope, None)
+        keys = (changed or {}).get(scope)
+        if keys:
+            db.session.execute(db.insert(DataChange),
+                               [{'scope': scope, 'version': version, 'key': key} for key in keys])
+            if version % 100 == 0:
+                DataChange.query.filter(DataChange.scope == scope,
+                                        DataChange.version <= version - DATA_CHANGE_RETENTION).delete()
+    return versions
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of rendered response bodies with hit/miss counters."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+calendar_cache = ResponseCache(int(os.getenv('CALENDAR_CACHE_MAX_ENTRIES', '256')))
+
+
+def calendar_response(view, range_start, range_end, coach_id=None, course_ids=None):
+    """Serve calendar events from calendar_cache, keyed by the view, its filters and the schedule data version."""
+    key = (view, range_start.isoformat(), range_end.isoformat(), coach_id, tuple(sorted(course_ids or ())),
+           get_data_version(SCHEDULE_SCOPE))
+    body = calendar_cache.get(key)
+    cache_status = 'HIT'
+    if body is None:
+        cache_status = 'MISS'
+        body = jsonify(build_calendar_events(range_start, range_end, coach_id=coach_id,
+                                             course_ids=course_ids)).get_data()
+        calendar_cache.put(key, body)
+    response = app.response_class(body, mimetype='application/json')
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+# ---------------- iCalendar feeds ----------------
+CALENDAR_TIMEZONE = os.getenv('CALENDAR_TIMEZONE', 'Asia/Jerusalem')
+ICS_MAX_AGE_SECONDS = 300
+ICS_WEEKDAYS = ['SU', 'MO', 'TU', 'WE', 'TH', 'FR', 'SA']  # indexed Sunday-based like Course.weekdays
+
+ics_cache = ResponseCache(int(os.getenv('ICS_CACHE_MAX_ENTRIES', '512')))
+
+
+def _ics_escape(value):
+    return (str(value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _ics_fold(line):
+    """Fold a content line at 75 octets (RFC 5545 3.1) without splitting UTF-8 sequences."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    start = 0
+    limit = 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode('utf-8'))
+        start = end
+        limit = 74  # continuation lines start with a space
+    return '\r\n '.join(parts)
+
+
+def _ics_utc_offset(offset):
+    minutes = int(offset.total_seconds()) // 60
+    return f"{'-' if minutes < 0 else '+'}{abs(minutes) // 60:02d}{abs(minutes) % 60:02d}"
+
+
+def _ics_observance(kind, onset, offset_from, offset_to, name):
+    return [f'BEGIN:{kind}', f'DTSTART:{onset.strftime("%Y%m%dT%H%M%S")}',
+            f'TZOFFSETFROM:{_ics_utc_offset(offset_from)}', f'TZOFFSETTO:{_ics_utc_offset(offset_to)}',
+            f'TZNAME:{_ics_escape(name)}', f'END:{kind}']
+
+
+def render_ics_timezone(first_year, last_year):
+    """
+    VTIMEZONE for CALENDAR_TIMEZONE (RFC 5545 3.6.5) listing each UTC offset change from first_year to
+    last_year, found by a daily scan of the tz database and narrowed to the minute.
+    """
+    zone = dateutil_tz.gettz(CALENDAR_TIMEZONE)
+    if zone is None:
+        raise ValueError(f"Unknown CALENDAR_TIMEZONE {CALENDAR_TIMEZONE!r}")
+    utc = dateutil_tz.UTC
+    moment = datetime(first_year, 1, 1, tzinfo=utc)
+    local = moment.astimezone(zone)
+    offset = local.utcoffset()
+    # The observance in force when the range starts, so events before the first change are covered too
+    lines = ['BEGIN:VTIMEZONE', f'TZID:{CALENDAR_TIMEZONE}']
+    lines += _ics_observance('DAYLIGHT' if local.dst() else 'STANDARD', datetime(1970, 1, 1), offset, offset,
+                             local.tzname())
+    end = datetime(last_year + 1, 1, 1, tzinfo=utc)
+    while moment < end:
+        next_day = moment + timedelta(days=1)
+        if next_day.astimezone(zone).utcoffset() != offset:
+            low, high = moment, next_day  # offset changes in (low, high]
+            while high - low > timedelta(minutes=1):
+                middle = low + timedelta(minutes=(high - low) // timedelta(minutes=1) // 2)
+                if middle.astimezone(zone).utcoffset() == offset:
+                    low = middle
+                else:
+                    high = middle
+            local = high.astimezone(zone)
+            # An observance starts at the local wall-clock time of the change, under the previous offset
+            lines += _ics_observance('DAYLIGHT' if local.dst() else 'STANDARD',
+                                     (high + offset).replace(tzinfo=None), offset, local.utcoffset(),
+                                     local.tzname())
+            offset = local.utcoffset()
+        moment = next_day
+    lines.append('END:VTIMEZONE')
+    return lines
+
+
+def render_ics_calendar(calendar_name, courses, stamp):
+    """Render courses as one recurring VEVENT each (RRULE over Course.weekdays) instead of expanded sessions."""
+    dtstamp = (stamp or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Nest Solutions//Sports Club Calendar//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{_ics_escape(calendar_name)}',
+        f'X-WR-TIMEZONE:{CALENDAR_TIMEZONE}',
+    ]
+    if courses:
+        # DTSTART;TZID= must refer to a VTIMEZONE in the same calendar
+        lines += render_ics_timezone(min(course.start_date for course in courses).year,
+                                     max(course.end_date or course.start_date for course in courses).year)
+    for course in courses:
+        weekdays = parse_weekdays(course.weekdays)
+        if not weekdays:
+            continue
+        first = sunday_weekday(course.start_date)
+        first_session = course.start_date + timedelta(days=min((w - first) % 7 for w in weekdays))
+        hours, minutes = (course.time or '00:00').split(':')[:2]
+        lines += [
+            'BEGIN:VEVENT',
+            f'UID:course-{course.id}@nest-sports',
+            f'DTSTAMP:{dtstamp}',
+            f'DTSTART;TZID={CALENDAR_TIMEZONE}:{first_session.strftime("%Y%m%d")}T{int(hours):02d}{int(minutes):02d}00',
+            f'DURATION:PT{course.duration}M',
+            f'RRULE:FREQ=WEEKLY;BYDAY={",".join(ICS_WEEKDAYS[w] for w in weekdays)};COUNT={course.sessions_count}',
+            f'SUMMARY:{_ics_escape(course.name)}',
+            f'DESCRIPTION:{_ics_escape("Coach: " + course.teacher)}',
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(_ics_fold(line) for line in lines) + '\r\n').encode('utf-8')
+
+
+def ics_response(feed_key, load_feed):
+    """
+    Serve a pre-rendered feed with a strong ETag and Last-Modified.
+    load_feed() returns (calendar_name, courses) and is only called when the cached rendering is stale,
+    so a conditional poll against a fresh cache entry is answered without a database query.
+    """
+    version, updated_at = cached_data_version(COURSES_SCOPE)
+    key = (feed_key, version)
+    entry = ics_cache.get(key)
+    if entry is None:
+        calendar_name, courses = load_feed()
+        body = render_ics_calendar(calendar_name, courses, updated_at)
+        entry = (body, hashlib.sha1(body).hexdigest(), updated_at or datetime.utcnow())
+        ics_cache.put(key, entry)
+    body, etag, last_modified = entry
+    response = app.response_class(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = ICS_MAX_AGE_SECONDS
+    return response.make_conditional(request)
+
+
+# ---------------- Coach schedule index ----------------
+def time_to_minutes(time_str):
+    hours, minutes = (time_str or '00:00').split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def minutes_to_time(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class VersionedIndex(ABC):
+    """
+    Base for in-memory indexes derived from one data scope.
+
+    The index remembers the data version it reflects and catches up on newer versions, whichever worker
+    or thread wrote them, by reloading only the keys logged in data_changes for those versions. When the
+    log doesn't cover the gap (a write that logged no keys, or versions pruned from the log) the index is
+    rebuilt instead. Only one thread catches up or rebuilds at a time; the others keep reading the current
+    contents meanwhile. Subclasses implement _reset, _load, _load_keys, _add and _remove; rows carry `id`.
+    """
+    scope = None
+    catch_up_max_keys = 5000  # a larger gap is cheaper to rebuild
+
+    def __init__(self):
+        self._lock = threading.Lock()  # guards the contents
+        self._refresh_lock = threading.Lock()  # held by the thread catching up or rebuilding
+        self.version = None
+        self._reset()
+
+    @abstractmethod
+    def _reset(self):
+        """Empty the contents."""
+
+    @abstractmethod
+    def _load(self):
+        """Return every row the index covers."""
+
+    @abstractmethod
+    def _load_keys(self, keys):
+        """Return the rows with these keys that still exist."""
+
+    @abstractmethod
+    def _add(self, row):
+        """Index one row."""
+
+    @abstractmethod
+    def _remove(self, key):
+        """Drop the row with this key, if indexed."""
+
+    def _changed_keys(self, since, version):
+        """Keys written after version `since` up to `version`, or None when data_changes doesn't cover them."""
+        if version - since > self.catch_up_max_keys:
+            return None
+        rows = db.session.query(DataChange.version, DataChange.key).filter(
+            DataChange.scope == self.scope, DataChange.version > since,
+            DataChange.version <= version).limit(self.catch_up_max_keys + 1).all()
+        # Every bump logs at least one key, so a version missing from the log was a write that logged none
+        if len(rows) > self.catch_up_max_keys or len({row.version for row in rows}) != version - since:
+            return None
+        return {row.key for row in rows}
+
+    def _refresh(self, version):
+        # Without contents to serve, wait for the thread already building them
+        if not self._refresh_lock.acquire(blocking=self.version is None):
+            return
+        try:
+            if self.version is not None and self.version >= version:
+                return
+            # A caller may hold uncommitted edits (a course being checked for conflicts); they must not be
+            # flushed into the rows read here, or a rejected edit would stay indexed after its rollback
+            with db.session.no_autoflush:
+                keys = self._changed_keys(self.version, version) if self.version is not None else None
+                if keys is None:
+                    rows = self._load()
+                else:
+                    rows = {row.id: row for row in self._load_keys(keys)} if keys else {}
+            if keys is None:
+                with self._lock:
+                    self._reset()
+                    for row in rows:
+                        self._add(row)
+                    self.version = version
+                return
+            with self._lock:
+                for key in keys:
+                    self._remove(key)
+                    if key in rows:
+                        self._add(rows[key])
+                self.version = version
+        finally:
+            self._refresh_lock.release()
+
+    def ensure_fresh(self):
+        """Catch up with the scope's version, as seen through cached_data_version."""
+        version, _ = cached_data_version(self.scope)
+        if self.version is None or version > self.version:
+            self._refresh(version)
+
+    def refresh(self):
+        """Catch up with the scope's current version; called after a commit so this worker sees its own write."""
+        self._refresh(get_data_version(self.scope))
+
+
+class CoachScheduleIndex(VersionedIndex):
+    """
+    Interval index of (coach, weekday) -> sorted (start minute, end minute, course) entries for active
+    courses, used for conflict checks and free-slot search. Courses are filed under their coach_id; only
+    legacy courses linked to no coach fall back to their normalized teacher name.
+    """
+    scope = COURSES_SCOPE
+
+    def _reset(self):
+        self._intervals = {}  # (coach key, weekday) -> sorted [(start, end, course_id)]
+        self._courses = {}  # course_id -> (coach key, weekdays, start, end, start_date, end_date, name)
+
+    # Plain column rows rather than Course entities: the identity map would hand back a course the caller is
+    # editing, with its unsaved values
+    _columns = (Course.id, Course.coach_id, Course.teacher, Course.weekdays, Course.time, Course.duration,
+                Course.start_date, Course.end_date, Course.name)
+
+    @staticmethod
+    def coach_key(coach_id, teacher):
+        return coach_id if coach_id is not None else normalize_coach_name(teacher)
+
+    def _load(self):
+        return db.session.query(*self._columns).filter(Course.end_date >= datetime.now().date()).all()
+
+    def _load_keys(self, course_ids):
+        return db.session.query(*self._columns).filter(Course.id.in_(course_ids)).all()
+
+    def _add(self, course):
+        if course.end_date < datetime.now().date():
+            return
+        weekdays = parse_weekdays(course.weekdays)
+        start = time_to_minutes(course.time)
+        end = min(start + (course.duration or 0), 24 * 60)
+        key = self.coach_key(course.coach_id, course.teacher)
+        self._courses[course.id] = (key, weekdays, start, end, course.start_date, course.end_date, course.name)
+        for weekday in weekdays:
+            insort(self._intervals.setdefault((key, weekday), []), (start, end, course.id))
+
+    def _remove(self, course_id):
+        entry = self._courses.pop(course_id, None)
+        if entry is None:
+            return
+        key, weekdays, start, end = entry[:4]
+        for weekday in weekdays:
+            intervals = self._intervals.get((key, weekday), [])
+            position = bisect_left(intervals, (start, end, course_id))
+            if position < len(intervals) and intervals[position] == (start, end, course_id):
+                del intervals[position]
+
+    def find_conflicts(self, coach_id, teacher, weekdays, start, end, start_date, end_date, exclude_course_id=None):
+        """Active courses of the coach overlapping [start, end) minutes on any of weekdays within the date range."""
+        self.ensure_fresh()
+        key = self.coach_key(coach_id, teacher)
+        conflicts = []
+        with self._lock:
+            for weekday in weekdays:
+                intervals = self._intervals.get((key, weekday), [])
+                # Entries are sorted by start, so only those starting before `end` can overlap
+                for other_start, other_end, course_id in intervals[:bisect_left(intervals, (end,))]:
+                    if other_end <= start or course_id == exclude_course_id:
+                        continue
+                    other = self._courses[course_id]
+                    if other[4] <= end_date and other[5] >= start_date:
+                        conflicts.append({
+                            'course_id': course_id,
+                            'course_name': other[6],
+                            'weekday': weekday,
+                            'time': minutes_to_time(other_start),
+                            'end_time': minutes_to_time(other_end)
+                        })
+        return conflicts
+
+    def conflicts_for(self, course):
+        start = time_to_minutes(course.time)
+        return self.find_conflicts(course.coach_id, course.teacher, parse_weekdays(course.weekdays), start,
+                                   min(start + (course.duration or 0), 24 * 60), course.start_date, course.end_date,
+                                   exclude_course_id=course.id)
+
+    def free_slots(self, coach_id, teacher, duration, day_start, day_end, weekdays=range(7)):
+        """Gaps of at least `duration` minutes between day_start and day_end, per weekday."""
+        self.ensure_fresh()
+        key = self.coach_key(coach_id, teacher)
+        today = datetime.now().date()
+        slots = []
+        with self._lock:
+            for weekday in weekdays:
+                cursor = day_start
+                for start, end, course_id in self._intervals.get((key, weekday), []):
+                    if self._courses[course_id][5] < today:
+                        continue
+                    gap_end = min(start, day_end)
+                    if gap_end - cursor >= duration:
+                        slots.append({'weekday': weekday, 'start': minutes_to_time(cursor),
+                                      'end': minutes_to_time(gap_end)})
+                    cursor = max(cursor, end)
+                    if cursor >= day_end:
+                        break
+                if day_end - cursor >= duration:
+                    slots.append({'weekday': weekday, 'start': minutes_to_time(cursor),
+                                  'end': minutes_to_time(day_end)})
+        return slots
+
+
+coach_schedule_index = CoachScheduleIndex()
+
+
+# ---------------- Student search index ----------------
+SEARCH_RESULTS_MAX = 100
+
+# Arabic/Hebrew letter variants folded to one form so spelling differences still match
+_SEARCH_LETTER_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    'ך': 'כ', 'ם': 'מ', 'ן': 'נ', 'ף': 'פ', 'ץ': 'צ',
+    **{chr(0x0660 + d): str(d) for d in range(10)},  # Arabic-Indic digits
+    **{chr(0x06F0 + d): str(d) for d in range(10)},  # Extended Arabic-Indic digits
+})
+# Latin combining accents; Arabic tashkeel, hamza marks, superscript alef, Quranic marks and tatweel;
+# Hebrew niqqud, cantillation, geresh and gershayim
+_SEARCH_MARKS_RE = re.compile('[\u0300-\u036F\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640'
+                              '\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7\u05F3\u05F4]')
+_SEARCH_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+_NON_DIGITS_RE = re.compile(r'\D')
+
+
+def normalize_search_text(value):
+    """Casefold, strip diacritics and fold Arabic/Hebrew letter variants; returns whitespace-separated tokens."""
+    value = _SEARCH_MARKS_RE.sub('', unicodedata.normalize('NFKD', str(value or '')))
+    return _SEARCH_PUNCTUATION_RE.sub('', value.translate(_SEARCH_LETTER_MAP).casefold()).split()
+
+
+def normalize_search_digits(value):
+    """Phone numbers and national IDs are matched on their digits alone, ignoring dashes and spaces."""
+    return _NON_DIGITS_RE.sub('', str(value or '').translate(_SEARCH_LETTER_MAP))
+
+
+def _trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class StudentSearchIndex(VersionedIndex):
+    """
+    Prefix and trigram index over normalized first_name, fathers_name, phone and national_id.
+
+    Each query term must match every result (AND). A term scores 3 for an exact token match, 2 for a
+    token prefix and 1 for a substring found through the trigram index; results are ranked by total
+    score, then by name. Trigrams point at distinct tokens rather than students, so common names are
+    indexed once.
+    """
+    scope = STUDENTS_SCOPE
+
+    def _reset(self):
+        self._postings = {}  # token -> set of student ids
+        self._sorted_tokens = None  # distinct tokens for prefix ranges; sorted once after a rebuild
+        self._trigram_tokens = {}  # trigram -> set of tokens containing it
+        self._docs = {}  # student id -> (tokens, sort key)
+
+    def _load(self):
+        return db.session.query(Student.id, Student.first_name, Student.fathers_name, Student.phone,
+                                Student.national_id).all()
+
+    def _load_keys(self, student_ids):
+        return db.session.query(Student.id, Student.first_name, Student.fathers_name, Student.phone,
+                                Student.national_id).filter(Student.id.in_(student_ids)).all()
+
+    @staticmethod
+    def _tokens(student):
+        tokens = normalize_search_text(student.first_name) + normalize_search_text(student.fathers_name)
+        for number in (student.phone, student.national_id):
+            digits = normalize_search_digits(number)
+            if digits:
+                tokens.append(digits)
+        return tuple(dict.fromkeys(tokens))
+
+    def _add(self, student):
+        tokens = self._tokens(student)
+        self._docs[student.id] = (tokens, ' '.join(tokens))
+        for token in tokens:
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = set()
+                if self._sorted_tokens is not None:
+                    insort(self._sorted_tokens, token)
+                for trigram in _trigrams(token):
+                    self._trigram_tokens.setdefault(trigram, set()).add(token)
+            posting.add(student.id)
+
+    def _remove(self, student_id):
+        doc = self._docs.pop(student_id, None)
+        if doc is None:
+            return
+        for token in doc[0]:
+            posting = self._postings[token]
+            posting.discard(student_id)
+            if posting:
+                continue
+            del self._postings[token]
+            if self._sorted_tokens is not None:
+                del self._sorted_tokens[bisect_left(self._sorted_tokens, token)]
+            for trigram in _trigrams(token):
+                trigram_tokens = self._trigram_tokens[trigram]
+                trigram_tokens.discard(token)
+                if not trigram_tokens:
+                    del self._trigram_tokens[trigram]
+
+    def _matching_tokens(self, term):
+        """Yield (token, score) for every indexed token the term matches."""
+        position = bisect_left(self._sorted_tokens, term)
+        while position < len(self._sorted_tokens) and self._sorted_tokens[position].startswith(term):
+            token = self._sorted_tokens[position]
+            yield token, 3 if token == term else 2
+            position += 1
+        if len(term) >= 3:
+            candidates = sorted((self._trigram_tokens.get(t, set()) for t in _trigrams(term)), key=len)
+            for token in set.intersection(*candidates) if candidates[0] else ():
+                if term in token and not token.startswith(term):
+                    yield token, 1
+
+    def _term_scores(self, term):
+        scores = {}
+        for token, score in self._matching_tokens(term):
+            for student_id in self._postings[token]:
+                if scores.get(student_id, 0) < score:
+                    scores[student_id] = score
+        return scores
+
+    def search(self, query, limit=20):
+        """Return the ids of the best matching students, best first."""
+        terms = normalize_search_text(query)
+        if not terms:
+            return []
+        self.ensure_fresh()
+        with self._lock:
+            if self._sorted_tokens is None:
+                self._sorted_tokens = sorted(self._postings)
+            # Start from the most selective term so later terms only filter a small candidate set
+            per_term = sorted((self._term_scores(term) for term in terms), key=len)
+            totals = per_term[0]
+            for scores in per_term[1:]:
+                totals = {sid: total + scores[sid] for sid, total in totals.items() if sid in scores}
+            docs = self._docs
+            return [sid for sid, _ in heapq.nsmallest(
+                limit, totals.items(), key=lambda item: (-item[1], docs[item[0]][1], item[0]))]
+
+
+student_search_index = StudentSearchIndex()
+
+
+# ---------------- Pagination ----------------
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def paginated_response(query, key_column, serialize):
+    """
+    Serialize query ordered by key_column (an indexed, unique column).
+
+    Without a `limit` parameter every row is returned as a bare JSON array, the original shape of the
+    list endpoints. With `limit`, one keyset page is returned as {items, next_cursor, has_more}; pass the
+    opaque next_cursor back as `after` for the following page. `order=desc` walks the key backwards and
+    `include_total=1` adds the total row count.
+    """
+    descending = request.args.get('order') == 'desc'
+    ordering = key_column.desc() if descending else key_column
+    if 'limit' not in request.args:
+        return jsonify([serialize(row) for row in query.order_by(ordering).all()])
+
+    limit = request.args.get('limit', type=int)
+    if not limit or limit < 1:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    page_query = query
+    after = request.args.get('after')
+    if after:
+        try:
+            last_key = decode_cursor(after)['k']
+        except (ValueError, KeyError, TypeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        page_query = page_query.filter(key_column < last_key if descending else key_column > last_key)
+    rows = page_query.order_by(ordering).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    body = {
+        'items': [serialize(row) for row in rows],
+        'next_cursor': encode_cursor({'k': getattr(rows[-1], key_column.key)}) if has_more else None,
+        'has_more': has_more
+    }
+    if request.args.get('include_total') in ('1', 'true'):
+        body['total'] = query.order_by(None).count()
+    return jsonify(body)
+
+
 # Routes
 @app.route('/')
 def home():
@@ -528,33 +2027,12 @@ def course_profile(course_id):
         return redirect(url_for('login', next=request.path))
     course = Course.query.get_or_404(course_id)
     # Get enrolled students
-    enrollments = Enrollment.query.filter_by(course_id=course_id).all()
-    students = []
-    for enrollment in enrollments:
-        student_info = enrollment.student.to_dict()
-        student_info['enrollment_id'] = enrollment.id
-        students.append(student_info)
+    students = course_students_data(course_id)
     # Get meetings (with attendance)
-    meetings = CourseMeeting.query.filter_by(course_id=course_id).order_by(CourseMeeting.date.desc()).all()
-    meetings_data = []
-    for meeting in meetings:
-        attendance = Attendance.query.filter_by(meeting_id=meeting.id).all()
-        attendance_list = [
-            {
-                'student_id': a.student_id,
-                'student_name': a.student.first_name + ' ' + a.student.fathers_name,
-                'present': a.present
-            } for a in attendance
-        ]
-        meetings_data.append({
-            'id': meeting.id,
-            'date': meeting.date.strftime('%Y-%m-%d'),
-            'notes': meeting.notes,
-            'attendance': attendance_list
-        })
+    meetings_data = course_meetings_data(course_id)
     # Calculate meetings left
     total_meetings = course.sessions_count
-    meetings_left = max(0, total_meetings - len(meetings))
+    meetings_left = max(0, total_meetings - len(meetings_data))
     return render_template(
         'course_profile.html',
         course_id=course.id,
@@ -568,8 +2046,51 @@ def course_profile(course_id):
 
 @app.route('/api/courses')
 def get_courses():
-    courses = Course.query.all()
-    return jsonify([course.to_dict() for course in courses])
+    return paginated_response(Course.query, Course.id, Course.to_dict)
+
+
+def normalize_coach_name(name):
+    """Coach names match ignoring case and repeated spaces."""
+    return ' '.join((name or '').split()).casefold()
+
+
+def resolve_course_coach(data):
+    """
+    (coach_id, teacher) for a course payload. coach_id links that coach and takes its name as the teacher;
+    a bare teacher name (older clients) links the coach of that name when exactly one matches, the same
+    rule the coach_id migration used.
+    """
+    if data.get('coach_id') not in (None, ''):
+        try:
+            coach_id = int(data['coach_id'])
+        except (TypeError, ValueError):
+            raise ValueError('coach_id must be an integer')
+        coach = db.session.get(Coach, coach_id)
+        if coach is None:
+            raise ValueError('Coach not found')
+        return coach.id, coach.full_name
+    teacher = (data.get('teacher') or '').strip()
+    if not teacher:
+        raise ValueError('teacher or coach_id is required')
+    name = normalize_coach_name(teacher)
+    matches = [coach for coach in Coach.query.options(load_only(Coach.id, Coach.first_name, Coach.last_name))
+               if normalize_coach_name(coach.full_name) == name]
+    if len(matches) == 1:
+        return matches[0].id, matches[0].full_name
+    return None, teacher
+
+
+def parse_monthly_fee(value):
+    """A course's monthly_fee from a request: a non-negative number, or None when left empty."""
+    if value in (None, ''):
+        return None
+    try:
+        fee = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('monthly_fee must be a number')
+    if fee < 0:
+        raise ValueError('monthly_fee must not be negative')
+    return fee
 
 
 @app.route('/api/courses', methods=['POST'])
@@ -591,9 +2112,16 @@ def create_course():
 
     end_date = start_date + timedelta(weeks=total_weeks)
 
+    try:
+        coach_id, teacher = resolve_course_coach(data)
+        monthly_fee = parse_monthly_fee(data.get('monthly_fee'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     course = Course(
         name=data['name'],
-        teacher=data['teacher'],
+        teacher=teacher,
+        coach_id=coach_id,
         start_date=start_date,
         time=data['time'],
         duration=duration,
@@ -601,15 +2129,26 @@ def create_course():
         sessions_per_week=sessions_per_week,  # stored but auto-computed
         weekdays=weekdays_str,
         end_date=end_date,
-        color=color
+        color=color,
+        monthly_fee=monthly_fee
     )
+    conflicts = coach_schedule_index.conflicts_for(course)
+    if conflicts and not data.get('allow_conflicts'):
+        return jsonify({'error': 'Coach is already booked at this time', 'conflicts': conflicts}), 409
     try:
         db.session.add(course)
+        db.session.flush()
+        regenerate_course_sessions(course)
+        bump_data_version(SCHEDULE_SCOPE, COURSES_SCOPE, changed={COURSES_SCOPE: [course.id]})
         db.session.commit()
     except IntegrityError:
         db.session.rollback()
         return jsonify({'error': 'Course name must be unique'}), 409
-    return jsonify(course.to_dict()), 201
+    coach_schedule_index.refresh()
+    result = course.to_dict()
+    if conflicts:
+        result['conflicts'] = conflicts
+    return jsonify(result), 201
 
 
 @app.route('/api/courses/<int:course_id>', methods=['DELETE'])
@@ -630,8 +2169,9 @@ def delete_course(course_id):
         # 1. Delete all enrollments for this course
         Enrollment.query.filter_by(course_id=course_id).delete()
 
-        # 2. Delete all payments for this course
+        # 2. Delete all payments for this course, and their revenue
         Payment.query.filter_by(course_id=course_id).delete()
+        RevenueRollup.query.filter_by(course_id=course_id).delete()
 
         # 3. Delete all course meetings and attendance
         meetings = CourseMeeting.query.filter_by(course_id=course_id).all()
@@ -641,9 +2181,15 @@ def delete_course(course_id):
             # Delete the meeting
             db.session.delete(meeting)
 
-        # 4. Now delete the course
+        # 4. Delete the materialized sessions (after the meetings that reference them)
+        db.session.flush()
+        CourseSession.query.filter_by(course_id=course_id).delete()
+
+        # 5. Now delete the course
         db.session.delete(course)
+        bump_data_version(SCHEDULE_SCOPE, COURSES_SCOPE, PAYMENTS_SCOPE, changed={COURSES_SCOPE: [course_id]})
         db.session.commit()
+        coach_schedule_index.refresh()
 
         logger.info(f"Course {course_id} deleted successfully")
         return '', 204
@@ -661,7 +2207,17 @@ def update_course(course_id):
 
     # Basic fields
     course.name = data.get('name', course.name)
-    course.teacher = data.get('teacher', course.teacher)
+    try:
+        # Edit forms send the teacher name back unchanged; only a new coach or name re-links the course
+        teacher_changed = ('teacher' in data and
+                           normalize_coach_name(data['teacher']) != normalize_coach_name(course.teacher))
+        if 'coach_id' in data or teacher_changed:
+            course.coach_id, course.teacher = resolve_course_coach(data)
+        if 'monthly_fee' in data:
+            course.monthly_fee = parse_monthly_fee(data['monthly_fee'])
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     course.time = data.get('time', course.time)
     course.color = data.get('color', course.color)
 
@@ -679,15 +2235,27 @@ def update_course(course_id):
     course.sessions_per_week = sessions_per_week
     course.end_date = course.start_date + timedelta(weeks=total_weeks)
 
+    # The edit is still unflushed; the check must not write it to the database the index reads
+    with db.session.no_autoflush:
+        conflicts = coach_schedule_index.conflicts_for(course)
+    if conflicts and not data.get('allow_conflicts'):
+        db.session.rollback()
+        return jsonify({'error': 'Coach is already booked at this time', 'conflicts': conflicts}), 409
+
+    regenerate_course_sessions(course)
+    bump_data_version(SCHEDULE_SCOPE, COURSES_SCOPE, changed={COURSES_SCOPE: [course.id]})
     db.session.commit()
-    return jsonify(course.to_dict())
+    coach_schedule_index.refresh()
+    result = course.to_dict()
+    if conflicts:
+        result['conflicts'] = conflicts
+    return jsonify(result)
 
 
 # ---------------- Coaches API ----------------
 @app.route('/api/coaches')
 def get_coaches():
-    coaches = Coach.query.all()
-    return jsonify([c.to_dict() for c in coaches])
+    return paginated_response(Coach.query, Coach.id, Coach.to_dict)
 
 
 @app.route('/api/coaches/<int:coach_id>', methods=['GET'])
@@ -723,6 +2291,10 @@ def update_coach(coach_id):
     coach.last_name = data.get('last_name', coach.last_name)
     coach.phone = data.get('phone', coach.phone)
     try:
+        # Linked courses show the coach's current name
+        Course.query.filter_by(coach_id=coach.id).update({Course.teacher: coach.full_name},
+                                                         synchronize_session=False)
+        bump_data_version(SCHEDULE_SCOPE, COURSES_SCOPE)
         db.session.commit()
         return jsonify(coach.to_dict())
     except IntegrityError:
@@ -733,7 +2305,10 @@ def update_coach(coach_id):
 @app.route('/api/coaches/<int:coach_id>', methods=['DELETE'])
 def delete_coach(coach_id):
     coach = Coach.query.get_or_404(coach_id)
+    # Courses keep the coach's name as their teacher but are no longer linked
+    Course.query.filter_by(coach_id=coach.id).update({Course.coach_id: None}, synchronize_session=False)
     db.session.delete(coach)
+    bump_data_version(SCHEDULE_SCOPE, COURSES_SCOPE)
     db.session.commit()
     return '', 204
 
@@ -744,10 +2319,7 @@ def coach_profile(coach_id):
         return redirect(url_for('login', next=request.path))
 
     coach = Coach.query.get_or_404(coach_id)
-    full_name = f"{coach.first_name} {coach.last_name}".strip()
-
-    # Find courses taught by this coach by matching the teacher field to full name
-    courses = Course.query.filter(Course.teacher == full_name).all()
+    courses = Course.query.filter_by(coach_id=coach.id).all()
 
     # Prepare course dicts for template
     courses_data = [c.to_dict() for c in courses]
@@ -761,21 +2333,36 @@ def get_course(course_id):
     return jsonify(course.to_dict())
 
 
-@app.route('/api/courses/<int:course_id>/students')
-def get_course_students(course_id):
-    enrollments = Enrollment.query.filter_by(course_id=course_id).all()
+def course_students_data(course_id):
+    """Enrolled students of a course with their enrollment_id, in one joined query."""
+    enrollments = Enrollment.query.options(joinedload(Enrollment.student)).filter_by(course_id=course_id).all()
     students = []
     for enrollment in enrollments:
         student_data = enrollment.student.to_dict()
         student_data['enrollment_id'] = enrollment.id
         students.append(student_data)
-    return jsonify(students)
+    return students
+
+
+@app.route('/api/courses/<int:course_id>/students')
+def get_course_students(course_id):
+    return jsonify(course_students_data(course_id))
 
 
 @app.route('/api/students')
 def get_students():
-    students = Student.query.all()
-    return jsonify([student.to_dict() for student in students])
+    return paginated_response(Student.query, Student.id, Student.to_dict)
+
+
+@app.route('/api/students/search')
+def search_students():
+    """Ranked name/phone/national ID search, tolerant of Arabic and Hebrew diacritics and letter forms."""
+    limit = min(max(request.args.get('limit', 20, type=int) or 20, 1), SEARCH_RESULTS_MAX)
+    ids = student_search_index.search(request.args.get('q', ''), limit)
+    if not ids:
+        return jsonify([])
+    students = {s.id: s for s in Student.query.filter(Student.id.in_(ids))}
+    return jsonify([students[sid].to_dict() for sid in ids if sid in students])
 
 
 @app.route('/api/students', methods=['POST'])
@@ -792,10 +2379,13 @@ def create_student():
     )
     try:
         db.session.add(student)
+        db.session.flush()
+        bump_data_version(STUDENTS_SCOPE, changed={STUDENTS_SCOPE: [student.id]})
         db.session.commit()
     except IntegrityError:
         db.session.rollback()
         return jsonify({'error': 'Student phone or national ID must be unique'}), 409
+    student_search_index.refresh()
     return jsonify(student.to_dict()), 201
 
 
@@ -817,7 +2407,8 @@ def delete_student(student_id):
         # 1. Delete all enrollments for this student
         Enrollment.query.filter_by(student_id=student_id).delete()
 
-        # 2. Delete all payments for this student
+        # 2. Delete all payments for this student, taking them out of the revenue rollup
+        remove_payments_revenue(Payment.student_id == student_id)
         Payment.query.filter_by(student_id=student_id).delete()
 
         # 3. Delete all attendance records for this student
@@ -825,7 +2416,9 @@ def delete_student(student_id):
 
         # 4. Now delete the student
         db.session.delete(student)
+        bump_data_version(SCHEDULE_SCOPE, STUDENTS_SCOPE, PAYMENTS_SCOPE, changed={STUDENTS_SCOPE: [student_id]})
         db.session.commit()
+        student_search_index.refresh()
 
         logger.info(f"Student {student_id} deleted successfully")
         return '', 204
@@ -846,7 +2439,9 @@ def update_student(student_id):
     if 'date_of_birth' in data:
         student.date_of_birth = datetime.strptime(data['date_of_birth'], '%Y-%m-%d').date()
     student.national_id = (data.get('national_id') if data.get('national_id') not in [None, '', ' '] else None)
+    bump_data_version(STUDENTS_SCOPE, changed={STUDENTS_SCOPE: [student.id]})
     db.session.commit()
+    student_search_index.refresh()
     return jsonify(student.to_dict())
 
 
@@ -873,41 +2468,203 @@ def add_payment(student_id):
         payment_method=method  # normalized
     )
     db.session.add(payment)
+    db.session.flush()
+    record_payment_revenue(payment)
+    bump_data_version(PAYMENTS_SCOPE)
     db.session.commit()
     return jsonify({'month': payment.month}), 201
 
 
 @app.route('/api/students/<int:student_id>/courses')
 def get_student_courses(student_id):
-    enrollments = Enrollment.query.filter_by(student_id=student_id).all()
+    enrollments = Enrollment.query.options(joinedload(Enrollment.course)).filter_by(student_id=student_id).all()
     courses = [enrollment.course.to_dict() for enrollment in enrollments]
     return jsonify(courses)
 
 
 @app.route('/api/enrollments', methods=['POST'])
 def enroll_student():
-    data = request.json
+    data = request.get_json(silent=True) or {}
+    try:
+        course_id, student_id = int(data['course_id']), int(data['student_id'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'course_id and student_id must be integer ids'}), 400
+    # Checked up front, so the IntegrityError below can only be the unique (course, student) index
+    if db.session.get(Course, course_id) is None:
+        return jsonify({'error': 'Course not found'}), 404
+    if db.session.get(Student, student_id) is None:
+        return jsonify({'error': 'Student not found'}), 404
     enrollment = Enrollment(
-        course_id=data['course_id'],
-        student_id=data['student_id']
+        course_id=course_id,
+        student_id=student_id
     )
-    db.session.add(enrollment)
-    db.session.commit()
+    try:
+        db.session.add(enrollment)
+        bump_data_version(SCHEDULE_SCOPE)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Student is already enrolled in this course'}), 409
     return jsonify({'id': enrollment.id}), 201
 
 
+MAX_BULK_ENROLLMENTS = 5000  # pairs per request, keeping one multi-row INSERT under SQLite's parameter limit
+
+
+def bulk_enrollment_pairs(data):
+    """
+    The (course_id, student_id) pairs of a bulk request: every student in student_ids with every course in
+    course_ids (or the single course_id). Raises ValueError for malformed, oversized or unknown ids.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Send a JSON object with student_ids and course_id or course_ids')
+    course_ids = data.get('course_ids', [data['course_id']] if 'course_id' in data else [])
+    student_ids = data.get('student_ids', [])
+    for name, ids in (('course_ids', course_ids), ('student_ids', student_ids)):
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise ValueError(f'{name} must be a non-empty list of ids')
+    course_ids, student_ids = sorted(set(course_ids)), sorted(set(student_ids))
+    if len(course_ids) * len(student_ids) > MAX_BULK_ENROLLMENTS:
+        raise ValueError(f'At most {MAX_BULK_ENROLLMENTS} enrollments per request')
+    for name, model, ids in (('course', Course, course_ids), ('student', Student, student_ids)):
+        found = {row_id for row_id, in db.session.query(model.id).filter(model.id.in_(ids))}
+        missing = [i for i in ids if i not in found]
+        if missing:
+            raise ValueError(f"Unknown {name} ids: {', '.join(map(str, missing))}")
+    return course_ids, student_ids
+
+
+@app.route('/api/enrollments/bulk', methods=['POST'])
+def bulk_enroll_students():
+    """
+    Enroll {"student_ids": [...]} in {"course_id": id} or {"course_ids": [...]} with one INSERT that skips
+    students already enrolled. Returns the created enrollments and how many pairs were skipped.
+    """
+    try:
+        course_ids, student_ids = bulk_enrollment_pairs(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    today = datetime.now().date()
+    rows = [{'course_id': course_id, 'student_id': student_id, 'enrollment_date': today}
+            for course_id in course_ids for student_id in student_ids]
+    insert = postgresql_insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+    stmt = insert(Enrollment).values(rows).on_conflict_do_nothing(index_elements=['course_id', 'student_id'])
+    created = db.session.execute(
+        stmt.returning(Enrollment.id, Enrollment.course_id, Enrollment.student_id)).all()
+    if created:
+        bump_data_version(SCHEDULE_SCOPE)
+    db.session.commit()
+    return jsonify({
+        'created': [{'id': row.id, 'course_id': row.course_id, 'student_id': row.student_id} for row in created],
+        'skipped': len(rows) - len(created)
+    }), 201 if created else 200
+
+
+@app.route('/api/enrollments/bulk', methods=['DELETE'])
+def bulk_unenroll_students():
+    """Remove every enrollment of student_ids in course_id/course_ids with one DELETE; returns the removed ids."""
+    try:
+        course_ids, student_ids = bulk_enrollment_pairs(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    removed = db.session.execute(db.delete(Enrollment).where(
+        Enrollment.course_id.in_(course_ids), Enrollment.student_id.in_(student_ids)
+    ).returning(Enrollment.id)).scalars().all()
+    if removed:
+        bump_data_version(SCHEDULE_SCOPE)
+    db.session.commit()
+    return jsonify({'removed': sorted(removed)})
+
+
 @app.route('/api/enrollments/<int:enrollment_id>', methods=['DELETE'])
 def remove_enrollment(enrollment_id):
     enrollment = Enrollment.query.get_or_404(enrollment_id)
     db.session.delete(enrollment)
+    bump_data_version(SCHEDULE_SCOPE)
     db.session.commit()
     return '', 204
 
 
 @app.route('/api/enrollments')
 def get_enrollments():
-    enrollments = Enrollment.query.all()
-    return jsonify([{'course_id': e.course_id, 'student_id': e.student_id} for e in enrollments])
+    return paginated_response(Enrollment.query, Enrollment.id,
+                              lambda e: {'course_id': e.course_id, 'student_id': e.student_id})
+
+
+@app.route('/api/calendar/range')
+def get_calendar_range():
+    """
+    Return calendar events between start and end (inclusive, YYYY-MM-DD).
+    Optional filters: coach_id, and course_id (may be repeated).
+    """
+    try:
+        range_start = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        range_end = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'start and end are required in YYYY-MM-DD format'}), 400
+    if range_end < range_start:
+        return jsonify({'error': 'end must not be before start'}), 400
+    if (range_end - range_start).days > MAX_CALENDAR_RANGE_DAYS:
+        return jsonify({'error': f'range must not exceed {MAX_CALENDAR_RANGE_DAYS} days'}), 400
+
+    coach_id = request.args.get('coach_id', type=int)
+    course_ids = request.args.getlist('course_id', type=int)
+    return calendar_response('range', range_start, range_end, coach_id=coach_id, course_ids=course_ids)
+
+
+@app.route('/api/calendar/cache-stats')
+def get_calendar_cache_stats():
+    stats = calendar_cache.stats()
+    stats['data_version'] = get_data_version(SCHEDULE_SCOPE)
+    return jsonify(stats)
+
+
+@app.route('/calendar/coach/<int:coach_id>.ics')
+def coach_calendar_feed(coach_id):
+    def load_feed():
+        coach = Coach.query.get_or_404(coach_id)
+        return coach.full_name, Course.query.filter_by(coach_id=coach.id).order_by(Course.id).all()
+
+    return ics_response(('coach', coach_id), load_feed)
+
+
+@app.route('/calendar/course/<int:course_id>.ics')
+def course_calendar_feed(course_id):
+    def load_feed():
+        course = Course.query.get_or_404(course_id)
+        return course.name, [course]
+
+    return ics_response(('course', course_id), load_feed)
+
+
+@app.route('/api/schedule/free-slots')
+def get_free_slots():
+    """
+    Weekly time windows in which a coach has no active course.
+    Params: coach (coach id or teacher name), duration (minutes), optional weekday (0=Sunday),
+    day_start/day_end (HH:MM, default 08:00-22:00). A name is resolved to its coach the way course payloads
+    are; one that matches no single coach covers the legacy courses filed under that name.
+    """
+    coach_param = (request.args.get('coach') or '').strip()
+    duration = request.args.get('duration', type=int)
+    if not coach_param or not duration or duration <= 0:
+        return jsonify({'error': 'coach and a positive duration are required'}), 400
+    try:
+        day_start = time_to_minutes(request.args.get('day_start', '08:00'))
+        day_end = time_to_minutes(request.args.get('day_end', '22:00'))
+    except ValueError:
+        return jsonify({'error': 'day_start and day_end must be in HH:MM format'}), 400
+
+    if coach_param.isdigit():
+        coach = Coach.query.get_or_404(int(coach_param))
+        coach_id, teacher = coach.id, coach.full_name
+    else:
+        coach_id, teacher = resolve_course_coach({'teacher': coach_param})
+
+    weekday = request.args.get('weekday', type=int)
+    weekdays = [weekday] if weekday is not None else range(7)
+    slots = coach_schedule_index.free_slots(coach_id, teacher, duration, day_start, day_end, weekdays)
+    return jsonify({'coach': teacher, 'coach_id': coach_id, 'duration': duration, 'slots': slots})
 
 
 @app.route('/api/calendar/weekly')
@@ -916,64 +2673,7 @@ def get_weekly_calendar():
     start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
     end_date = start_date + timedelta(days=6)
 
-    courses = Course.query.filter(
-        Course.start_date <= end_date,
-        Course.end_date >= start_date
-    ).all()
-
-    calendar_data = []
-    for course in courses:
-        # Parse weekdays (frontend sends Sunday-based: 0=Sunday, 1=Monday, ..., 6=Saturday)
-        weekdays = [int(day) for day in course.weekdays.split(',')]
-
-        # Generate course sessions for the week based on weekdays
-        current_date = max(course.start_date, start_date)
-        while current_date <= min(course.end_date, end_date):
-            # Get the weekday in Sunday-based format (0=Sunday, 6=Saturday)
-            # Python weekday(): Monday=0, Sunday=6
-            # We need: Sunday=0, Saturday=6
-            weekday = current_date.weekday()
-            sunday_based_weekday = (weekday + 1) % 7
-
-            if sunday_based_weekday in weekdays:
-                # Calculate classes remaining correctly
-                # Parse weekdays to get the specific days this course runs on
-                course_weekdays = [int(day) for day in course.weekdays.split(',')]
-
-                # Count how many classes have already occurred
-                classes_completed = 0
-                temp_date = course.start_date
-
-                # Count classes from start date up to (but not including) current date
-                while temp_date < current_date:
-                    # Convert to Sunday-based weekday (0=Sunday, 1=Monday, etc.)
-                    temp_weekday = (temp_date.weekday() + 1) % 7  # Convert Monday=0 to Sunday=0
-                    if temp_weekday in course_weekdays:
-                        classes_completed += 1
-                    temp_date += timedelta(days=1)
-
-                classes_remaining = max(0, course.sessions_count - classes_completed)
-
-                # Get number of enrolled students
-                enrolled_count = db.session.query(Enrollment).filter_by(course_id=course.id).count()
-
-                calendar_data.append({
-                    'id': course.id,
-                    'title': course.name,
-                    'date': current_date.strftime('%Y-%m-%d'),
-                    'time': course.time,
-                    'duration': course.duration,
-                    'teacher': course.teacher,
-                    'color': course.color,
-                    'enrolled_count': enrolled_count,
-                    'classes_remaining': classes_remaining
-                })
-            current_date += timedelta(days=1)
-
-    # Sort calendar data by date and time
-    calendar_data.sort(key=lambda x: (x['date'], x['time']))
-
-    return jsonify(calendar_data)
+    return calendar_response('weekly', start_date, end_date)
 
 
 @app.route('/api/calendar/daily')
@@ -982,44 +2682,7 @@ def get_daily_calendar():
     date_str = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
     target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
 
-    courses = Course.query.filter(
-        Course.start_date <= target_date,
-        Course.end_date >= target_date
-    ).all()
-
-    calendar_data = []
-    for course in courses:
-        weekdays = [int(day) for day in course.weekdays.split(',') if day != '']
-        weekday = (target_date.weekday() + 1) % 7  # Convert Monday=0 to Sunday=0
-
-        if weekday in weekdays:
-            # Calculate remaining classes up to the target date
-            course_weekdays = weekdays
-            classes_completed = 0
-            temp_date = course.start_date
-            while temp_date < target_date:
-                temp_weekday = (temp_date.weekday() + 1) % 7
-                if temp_weekday in course_weekdays:
-                    classes_completed += 1
-                temp_date += timedelta(days=1)
-
-            classes_remaining = max(0, course.sessions_count - classes_completed)
-            enrolled_count = db.session.query(Enrollment).filter_by(course_id=course.id).count()
-
-            calendar_data.append({
-                'id': course.id,
-                'title': course.name,
-                'date': target_date.strftime('%Y-%m-%d'),
-                'time': course.time,
-                'duration': course.duration,
-                'teacher': course.teacher,
-                'color': course.color,
-                'enrolled_count': enrolled_count,
-                'classes_remaining': classes_remaining
-            })
-
-    calendar_data.sort(key=lambda x: x['time'])
-    return jsonify(calendar_data)
+    return calendar_response('daily', target_date, target_date)
 
 
 @app.route('/api/whatsapp/send')
@@ -1030,10 +2693,28 @@ def send_whatsapp():
     return jsonify({'url': whatsapp_url})
 
 
+def payment_search_filter(term):
+    """Payments whose student name, course, coach, month or method contains every word of term."""
+    conditions = []
+    for word in term.split():
+        conditions.append(db.or_(
+            Payment.student.has(db.or_(Student.first_name.icontains(word, autoescape=True),
+                                       Student.fathers_name.icontains(word, autoescape=True))),
+            Payment.course.has(db.or_(Course.name.icontains(word, autoescape=True),
+                                      Course.teacher.icontains(word, autoescape=True))),
+            Payment.month.icontains(word, autoescape=True),
+            Payment.payment_method.icontains(word, autoescape=True)))
+    return db.and_(*conditions)
+
+
 @app.route('/api/payments')
 def get_payments():
-    payments = Payment.query.all()
-    return jsonify([payment.to_dict() for payment in payments])
+    query = Payment.query.options(*Payment.listing_options())
+    term = request.args.get('q', '').strip()
+    if term:
+        # Applied before the keyset cursor, so `after` pages through the matches only
+        query = query.filter(payment_search_filter(term))
+    return paginated_response(query, Payment.id, Payment.to_dict)
 
 
 @app.route('/api/payments', methods=['POST'])
@@ -1052,6 +2733,9 @@ def create_payment():
         payment_method=method  # normalized
     )
     db.session.add(payment)
+    db.session.flush()
+    record_payment_revenue(payment)
+    bump_data_version(PAYMENTS_SCOPE)
     db.session.commit()
     return jsonify(payment.to_dict()), 201
 
@@ -1059,114 +2743,295 @@ def create_payment():
 @app.route('/api/payments/<int:payment_id>', methods=['DELETE'])
 def delete_payment(payment_id):
     payment = Payment.query.get_or_404(payment_id)
+    record_payment_revenue(payment, sign=-1)
     db.session.delete(payment)
+    bump_data_version(PAYMENTS_SCOPE)
     db.session.commit()
     return '', 204
 
 
-@app.route('/api/analysis/coach-income')
-def get_coach_income():
-    period = request.args.get('period', 'all')
+# ---------------- Billing ----------------
+OUTSTANDING_STATUSES = ('outstanding', 'unpaid', 'partial', 'paid', 'all')
+OUTSTANDING_CSV_HEADER = ['Student', 'Phone', 'Course', 'Coach', 'Month', 'Due', 'Paid', 'Balance', 'Status']
 
-    # Build date filter based on period
-    if period == 'month':
-        start_date = datetime.now().replace(day=1).date()
-    elif period == 'quarter':
-        current_month = datetime.now().month
-        quarter_start_month = ((current_month - 1) // 3) * 3 + 1
-        start_date = datetime.now().replace(month=quarter_start_month, day=1).date()
-    elif period == 'year':
-        start_date = datetime.now().replace(month=1, day=1).date()
-    else:  # all
-        start_date = None
-
-    # Query payments with course and teacher info
-    query = db.session.query(
-        Course.teacher,
-        db.func.sum(Payment.amount).label('total_income'),
+
+def outstanding_query(month, status='outstanding'):
+    """
+    One row per (student, course) enrolled by the end of month ("YYYY-MM") in a course running during it,
+    with what was paid for that month; enrollments without a date count as enrolled. A single statement:
+    payments for the month are summed per (student, course) and outer joined to the enrollments, so the
+    cost doesn't depend on how many payments other months hold.
+    status narrows the rows: unpaid (no payment), partial (paid less than the course's monthly_fee), paid,
+    outstanding (unpaid or partial) or all.
+    """
+    month_start = datetime.strptime(month, '%Y-%m').date()
+    month_end = month_start + relativedelta(months=1) - timedelta(days=1)
+    payments = db.session.query(
+        Payment.student_id,
+        Payment.course_id,
+        db.func.sum(Payment.amount).label('paid'),
         db.func.count(Payment.id).label('payment_count')
-    ).join(Payment.course).group_by(Course.teacher)
+    ).filter(Payment.month == month).group_by(Payment.student_id, Payment.course_id).subquery()
+    paid = db.func.coalesce(payments.c.paid, 0.0)
+    payment_count = db.func.coalesce(payments.c.payment_count, 0)
+    query = db.session.query(
+        Student.id.label('student_id'), Student.first_name, Student.fathers_name, Student.phone,
+        Course.id.label('course_id'), Course.name.label('course_name'), Course.teacher, Course.monthly_fee,
+        paid.label('paid'), payment_count.label('payment_count')
+    ).select_from(Enrollment).join(
+        Student, Student.id == Enrollment.student_id
+    ).join(
+        Course, Course.id == Enrollment.course_id
+    ).outerjoin(
+        payments, (payments.c.student_id == Enrollment.student_id) & (payments.c.course_id == Enrollment.course_id)
+    ).filter(
+        Course.start_date <= month_end,
+        Course.end_date >= month_start,
+        db.or_(Enrollment.enrollment_date.is_(None), Enrollment.enrollment_date <= month_end)
+    )
+    unpaid = payment_count == 0
+    partial = db.and_(payment_count > 0, Course.monthly_fee.isnot(None), paid < Course.monthly_fee)
+    conditions = {
+        'unpaid': unpaid,
+        'partial': partial,
+        'paid': db.not_(db.or_(unpaid, partial)),
+        'outstanding': db.or_(unpaid, partial),
+    }
+    if status in conditions:
+        query = query.filter(conditions[status])
+    return query.order_by(Course.name, Student.first_name, Student.fathers_name, Student.id)
+
+
+def outstanding_row(row):
+    due = row.monthly_fee
+    paid = float(row.paid or 0)
+    if not row.payment_count:
+        status = 'unpaid'
+    elif due is not None and paid < due:
+        status = 'partial'
+    else:
+        status = 'paid'
+    return {
+        'student_id': row.student_id,
+        'student_name': f"{row.first_name} {row.fathers_name}",
+        'phone': row.phone,
+        'course_id': row.course_id,
+        'course_name': row.course_name,
+        'teacher': row.teacher,
+        'due': due,
+        'paid': round(paid, 2),
+        'balance': round(due - paid, 2) if due is not None else None,
+        'payment_count': row.payment_count,
+        'status': status
+    }
 
-    if start_date:
-        query = query.filter(Payment.payment_date >= start_date)
 
-    results = query.all()
+def stream_csv(header, rows, filename):
+    """
+    Stream a CSV download row by row, so memory stays flat however many rows the query yields. The BOM lets
+    Excel detect UTF-8 for Arabic and Hebrew names.
+    """
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')
+        writer.writerow(header)
+        for i, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if i % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+def stream_ndjson(keys, rows, filename):
+    """Stream rows as newline-delimited JSON objects with the given keys; dates are written as YYYY-MM-DD."""
+    def generate():
+        lines = []
+        for row in rows:
+            lines.append(json.dumps(dict(zip(keys, row)), default=str, ensure_ascii=False, separators=(',', ':')))
+            if len(lines) == 500:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.route('/api/billing/outstanding')
+def get_outstanding_balances():
+    """
+    Who owes what for a month: ?month=YYYY-MM (default: this month), status=outstanding|unpaid|partial|paid|all
+    (default outstanding), format=json|csv. CSV streams the rows for the front desk to work through.
+    """
+    month = request.args.get('month') or datetime.now().strftime('%Y-%m')
+    status = request.args.get('status', 'outstanding')
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        return jsonify({'error': 'month must be YYYY-MM'}), 400
+    if status not in OUTSTANDING_STATUSES:
+        return jsonify({'error': f"status must be one of {', '.join(OUTSTANDING_STATUSES)}"}), 400
+    query = outstanding_query(month, status)
+
+    if request.args.get('format') == 'csv':
+        rows = (outstanding_row(row) for row in query.yield_per(1000))
+        return stream_csv(OUTSTANDING_CSV_HEADER, (
+            [r['student_name'], r['phone'], r['course_name'], r['teacher'], month,
+             '' if r['due'] is None else r['due'], r['paid'], '' if r['balance'] is None else r['balance'],
+             r['status']] for r in rows), f'outstanding_{month}.csv')
+
+    items = [outstanding_row(row) for row in query]
+    return jsonify({
+        'month': month,
+        'status': status,
+        'items': items,
+        'totals': {
+            'count': len(items),
+            'due': round(sum(item['due'] or 0 for item in items), 2),
+            'paid': round(sum(item['paid'] for item in items), 2),
+            'balance': round(sum(item['balance'] or 0 for item in items), 2),
+        }
+    })
+
 
-    return jsonify([{
-        'teacher': result.teacher,
-        'total_income': float(result.total_income or 0),
-        'payment_count': result.payment_count
-    } for result in results])
+# ---------------- Revenue rollup ----------------
 
+def revenue_rollup_key(payment_date, course_id, payment_method):
+    return payment_date.strftime('%Y-%m') if payment_date else '', course_id, payment_method or ''
 
-@app.route('/api/analysis/course-income')
-def get_course_income():
-    period = request.args.get('period', 'all')
 
-    # Build date filter based on period
+def apply_revenue_deltas(deltas):
+    """
+    Add {(month, course_id, payment_method): (amount, count)} to revenue_rollup with one upsert statement.
+    Runs inside the caller's transaction; the caller commits.
+    """
+    rows = [{'month': month, 'course_id': course_id, 'payment_method': method,
+             'total_amount': amount, 'payment_count': count}
+            for (month, course_id, method), (amount, count) in deltas.items() if count]
+    if not rows:
+        return
+    insert = postgresql_insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+    stmt = insert(RevenueRollup)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['month', 'course_id', 'payment_method'],
+        set_={'total_amount': RevenueRollup.total_amount + stmt.excluded.total_amount,
+              'payment_count': RevenueRollup.payment_count + stmt.excluded.payment_count})
+    db.session.execute(stmt, rows)
+
+
+def record_payment_revenue(payment, sign=1):
+    """Count a flushed payment into the rollup (sign=-1 takes it out again)."""
+    key = revenue_rollup_key(payment.payment_date, payment.course_id, payment.payment_method)
+    apply_revenue_deltas({key: (sign * (payment.amount or 0.0), sign)})
+
+
+def _payment_revenue(payment_rows):
+    totals = {}
+    for payment_date, course_id, method, amount in payment_rows:
+        key = revenue_rollup_key(payment_date, course_id, method)
+        total, count = totals.get(key, (0.0, 0))
+        totals[key] = (total + (amount or 0.0), count + 1)
+    return totals
+
+
+def remove_payments_revenue(payment_filter):
+    """Take the payments matching payment_filter out of the rollup, before the caller bulk-deletes them."""
+    rows = db.session.query(Payment.payment_date, Payment.course_id, Payment.payment_method,
+                            Payment.amount).filter(payment_filter)
+    apply_revenue_deltas({key: (-amount, -count) for key, (amount, count) in _payment_revenue(rows).items()})
+
+
+def rebuild_revenue_rollup():
+    """Recompute revenue_rollup from payments: the backfill, and a repair for payments edited outside the app."""
+    rows = db.session.query(Payment.payment_date, Payment.course_id, Payment.payment_method,
+                            Payment.amount).yield_per(5000)
+    totals = _payment_revenue(rows)
+    RevenueRollup.query.delete()
+    apply_revenue_deltas(totals)
+    db.session.commit()
+    logger.info(f"Rebuilt revenue rollup: {len(totals)} rows")
+    return len(totals)
+
+
+def analysis_period_start(period):
+    """First day of the current 'month', 'quarter' or 'year'; None for 'all'."""
+    today = datetime.now().date()
     if period == 'month':
-        start_date = datetime.now().replace(day=1).date()
-    elif period == 'quarter':
-        current_month = datetime.now().month
-        quarter_start_month = ((current_month - 1) // 3) * 3 + 1
-        start_date = datetime.now().replace(month=quarter_start_month, day=1).date()
-    elif period == 'year':
-        start_date = datetime.now().replace(month=1, day=1).date()
-    else:  # all
-        start_date = None
-
-    # Query payments with course info
+        return today.replace(day=1)
+    if period == 'quarter':
+        return today.replace(month=((today.month - 1) // 3) * 3 + 1, day=1)
+    if period == 'year':
+        return today.replace(month=1, day=1)
+    return None
+
+
+def revenue_dashboard(period):
+    """
+    Coach income, course income and the summary of payments dated in the period, from one query over the
+    rollup. Periods start on the first of a month, so filtering rollup months equals filtering payment dates.
+    """
     query = db.session.query(
         Course.name,
-        db.func.sum(Payment.amount).label('total_income'),
-        db.func.count(Payment.id).label('payment_count')
-    ).join(Payment.course).group_by(Course.name)
-
+        Course.teacher,
+        Course.coach_id,
+        db.func.sum(RevenueRollup.total_amount).label('total_income'),
+        db.func.sum(RevenueRollup.payment_count).label('payment_count')
+    ).join(Course, Course.id == RevenueRollup.course_id).group_by(Course.id, Course.name, Course.teacher,
+                                                                  Course.coach_id)
+    start_date = analysis_period_start(period)
     if start_date:
-        query = query.filter(Payment.payment_date >= start_date)
+        query = query.filter(RevenueRollup.month >= start_date.strftime('%Y-%m'))
+    rows = [row for row in query.having(db.func.sum(RevenueRollup.payment_count) > 0).order_by(Course.name)]
+
+    # Linked courses group by coach; courses without a coach record fall back to their teacher name
+    coaches = {}
+    for row in rows:
+        key = (row.coach_id, None if row.coach_id else row.teacher)
+        teacher, total, count = coaches.get(key, (row.teacher, 0.0, 0))
+        coaches[key] = (teacher, total + row.total_income, count + row.payment_count)
+    total_revenue = sum(row.total_income for row in rows)
+    total_payments = sum(row.payment_count for row in rows)
+    return {
+        'period': period,
+        'coach_income': [{'coach_id': coach_id, 'teacher': teacher, 'total_income': round(total, 2),
+                          'payment_count': count}
+                         for (coach_id, _), (teacher, total, count)
+                         in sorted(coaches.items(), key=lambda item: item[1][0] or '')],
+        'course_income': [{'course_name': row.name, 'total_income': round(row.total_income, 2),
+                           'payment_count': row.payment_count} for row in rows],
+        'summary': {
+            'total_revenue': round(total_revenue, 2),
+            'total_payments': total_payments,
+            'average_payment': total_revenue / total_payments if total_payments else 0.0
+        }
+    }
 
-    results = query.all()
 
-    return jsonify([{
-        'course_name': result.name,
-        'total_income': float(result.total_income or 0),
-        'payment_count': result.payment_count
-    } for result in results])
+@app.route('/api/analysis/dashboard')
+def get_analysis_dashboard():
+    return jsonify(revenue_dashboard(request.args.get('period', 'all')))
 
 
-@app.route('/api/analysis/summary')
-def get_analysis_summary():
-    period = request.args.get('period', 'all')
+@app.route('/api/analysis/coach-income')
+def get_coach_income():
+    return jsonify(revenue_dashboard(request.args.get('period', 'all'))['coach_income'])
 
-    # Build date filter based on period
-    if period == 'month':
-        start_date = datetime.now().replace(day=1).date()
-    elif period == 'quarter':
-        current_month = datetime.now().month
-        quarter_start_month = ((current_month - 1) // 3) * 3 + 1
-        start_date = datetime.now().replace(month=quarter_start_month, day=1).date()
-    elif period == 'year':
-        start_date = datetime.now().replace(month=1, day=1).date()
-    else:  # all
-        start_date = None
-
-    # Query summary statistics
-    query = db.session.query(
-        db.func.sum(Payment.amount).label('total_revenue'),
-        db.func.count(Payment.id).label('total_payments'),
-        db.func.avg(Payment.amount).label('average_payment')
-    )
 
-    if start_date:
-        query = query.filter(Payment.payment_date >= start_date)
+@app.route('/api/analysis/course-income')
+def get_course_income():
+    return jsonify(revenue_dashboard(request.args.get('period', 'all'))['course_income'])
 
-    result = query.first()
 
-    return jsonify({
-        'total_revenue': float(result.total_revenue or 0),
-        'total_payments': result.total_payments or 0,
-        'average_payment': float(result.average_payment or 0)
-    })
+@app.route('/api/analysis/summary')
+def get_analysis_summary():
+    return jsonify(revenue_dashboard(request.args.get('period', 'all'))['summary'])
 
 
 @app.route('/api/invoice/<int:payment_id>')
@@ -1238,7 +3103,8 @@ def create_green_invoice(payment_id: int):
             'sendEmail': GI_SEND_EMAIL
         }
 
-        r = requests.post(f'{GI_API_BASE}/documents', headers=_gi_headers(token), json=payload, timeout=30)
+        r = outbound_request('green_invoice', 'POST', f'{GI_API_BASE}/documents', headers=_gi_headers(token),
+                             json=payload, timeout=30)
         if not r.ok:
             return jsonify(
                 {'error': 'green_invoice_create_failed', 'status': r.status_code, 'details': r.text}), r.status_code
@@ -1247,8 +3113,8 @@ def create_green_invoice(payment_id: int):
 
         # Try issuing (some accounts require it)
         try:
-            requests.post(f'{GI_API_BASE}/documents/issue', headers=_gi_headers(token), json={'ids': [doc_id]},
-                          timeout=20)
+            outbound_request('green_invoice', 'POST', f'{GI_API_BASE}/documents/issue', headers=_gi_headers(token),
+                             json={'ids': [doc_id]}, timeout=20)
         except Exception:
             pass
 
@@ -1260,7 +3126,8 @@ def create_green_invoice(payment_id: int):
         # Try fetching PDF (base64) as a fallback
         pdf_data = None
         try:
-            pr = requests.get(f'{GI_API_BASE}/documents/{doc_id}/pdf', headers=_gi_headers(token), timeout=30)
+            pr = outbound_request('green_invoice', 'GET', f'{GI_API_BASE}/documents/{doc_id}/pdf',
+                                  headers=_gi_headers(token), timeout=30)
             if pr.ok and pr.headers.get('Content-Type', '').startswith('application/json'):
                 pdf_data = pr.json().get('data')
         except Exception:
@@ -1272,18 +3139,24 @@ def create_green_invoice(payment_id: int):
         return jsonify({'error': 'green_invoice_error', 'message': str(e)}), 500
 
 
-@app.route('/api/courses/<int:course_id>/meetings', methods=['GET'])
-def get_course_meetings(course_id):
-    meetings = CourseMeeting.query.filter_by(course_id=course_id).order_by(CourseMeeting.date.desc()).all()
+def course_meetings_data(course_id):
+    """
+    Meetings of a course, newest first, each with its attendance list.
+    Two statements regardless of size: the meetings, then every attendance row joined to its student.
+    """
+    meetings = (CourseMeeting.query
+                .options(selectinload(CourseMeeting.attendances).joinedload(Attendance.student))
+                .filter_by(course_id=course_id)
+                .order_by(CourseMeeting.date.desc())
+                .all())
     result = []
     for meeting in meetings:
-        attendance = Attendance.query.filter_by(meeting_id=meeting.id).all()
         attendance_list = [
             {
                 'student_id': a.student_id,
                 'student_name': a.student.first_name + ' ' + a.student.fathers_name,
                 'present': a.present
-            } for a in attendance
+            } for a in meeting.attendances
         ]
         result.append({
             'id': meeting.id,
@@ -1291,40 +3164,192 @@ def get_course_meetings(course_id):
             'notes': meeting.notes,
             'attendance': attendance_list
         })
-    return jsonify(result)
+    return result
+
+
+@app.route('/api/courses/<int:course_id>/meetings', methods=['GET'])
+def get_course_meetings(course_id):
+    return jsonify(course_meetings_data(course_id))
+
+
+def _pack_bits(indexes, size):
+    """Base64 of a bitset with the given indexes set; bit i is bit (i % 8), least significant first, of byte i // 8."""
+    bits = 0
+    for index in indexes:
+        bits |= 1 << index
+    return base64.b64encode(bits.to_bytes((size + 7) // 8, 'little')).decode('ascii')
+
+
+@app.route('/api/courses/<int:course_id>/attendance-matrix')
+def get_attendance_matrix(course_id):
+    """
+    Attendance of a course as a student index, a meeting index (oldest first) and two bitsets per meeting
+    over the student index: `present`, and `recorded` (the student had an attendance row, i.e. was enrolled
+    at the time). Per-student and per-meeting totals are included. Built from a single query.
+    """
+    rows = (db.session.query(CourseMeeting.id, CourseMeeting.date, Attendance.student_id, Attendance.present,
+                             Student.first_name, Student.fathers_name)
+            .outerjoin(Attendance, Attendance.meeting_id == CourseMeeting.id)
+            .outerjoin(Student, Student.id == Attendance.student_id)
+            .filter(CourseMeeting.course_id == course_id)
+            .order_by(CourseMeeting.date, CourseMeeting.id)
+            .all())
+    if not rows and db.session.get(Course, course_id) is None:
+        return jsonify({'error': 'Course not found'}), 404
+
+    names = {}
+    meetings = {}  # meeting id -> (date, present student ids, recorded student ids), in date order
+    for meeting_id, meeting_date, student_id, present, first_name, fathers_name in rows:
+        _, present_ids, recorded_ids = meetings.setdefault(meeting_id, (meeting_date, [], []))
+        if student_id is None or first_name is None:
+            continue
+        names[student_id] = f"{first_name} {fathers_name}"
+        recorded_ids.append(student_id)
+        if present:
+            present_ids.append(student_id)
+
+    students = sorted(names.items(), key=lambda item: (item[1], item[0]))
+    position = {student_id: index for index, (student_id, _) in enumerate(students)}
+    student_present = [0] * len(students)
+    student_recorded = [0] * len(students)
+    present_bits, recorded_bits, meeting_present, meeting_recorded = [], [], [], []
+    for _, present_ids, recorded_ids in meetings.values():
+        present_idx = [position[sid] for sid in present_ids]
+        recorded_idx = [position[sid] for sid in recorded_ids]
+        for index in present_idx:
+            student_present[index] += 1
+        for index in recorded_idx:
+            student_recorded[index] += 1
+        present_bits.append(_pack_bits(present_idx, len(students)))
+        recorded_bits.append(_pack_bits(recorded_idx, len(students)))
+        meeting_present.append(len(present_idx))
+        meeting_recorded.append(len(recorded_idx))
+
+    return jsonify({
+        'course_id': course_id,
+        'students': [{'id': student_id, 'name': name} for student_id, name in students],
+        'meetings': [{'id': meeting_id, 'date': meeting_date.strftime('%Y-%m-%d')}
+                     for meeting_id, (meeting_date, _, _) in meetings.items()],
+        'present': present_bits,
+        'recorded': recorded_bits,
+        'totals': {
+            'student_present': student_present,
+            'student_recorded': student_recorded,
+            'meeting_present': meeting_present,
+            'meeting_recorded': meeting_recorded
+        }
+    })
+
+
+def upsert_attendance(records):
+    """
+    Insert or update {meeting_id, student_id, present} records with one INSERT ... ON CONFLICT statement on
+    the (meeting_id, student_id) unique index, executed for all records as an executemany; the caller commits.
+    Later duplicates in records win.
+    """
+    records = list({(r['meeting_id'], r['student_id']): r for r in records}.values())
+    if not records:
+        return 0
+    insert = postgresql_insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+    stmt = insert(Attendance)
+    stmt = stmt.on_conflict_do_update(index_elements=['meeting_id', 'student_id'],
+                                      set_={'present': stmt.excluded.present})
+    db.session.execute(stmt, records)
+    return len(records)
+
+
+def parse_attendance_records(items, meeting_id=None):
+    """
+    Validate a list of {meeting_id, student_id, present} items; a missing present means absent. A caller
+    that fixes meeting_id has already checked that meeting exists. Returns (records, error message);
+    unknown meetings and students are reported, not skipped.
+    """
+    if not isinstance(items, list):
+        return None, 'attendance must be a list'
+    records = []
+    for item in items:
+        try:
+            present = item.get('present', False)
+            if not isinstance(present, bool):  # "false" or 0 would otherwise count as present
+                raise TypeError
+            records.append({
+                'meeting_id': int(meeting_id if meeting_id is not None else item['meeting_id']),
+                'student_id': int(item['student_id']),
+                'present': present
+            })
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None, 'Each record needs integer meeting_id and student_id and a boolean present'
+    meeting_ids = {r['meeting_id'] for r in records} if meeting_id is None else set()
+    student_ids = {r['student_id'] for r in records}
+    missing_meetings = meeting_ids and meeting_ids - {
+        row[0] for row in db.session.query(CourseMeeting.id).filter(CourseMeeting.id.in_(meeting_ids))}
+    missing_students = student_ids - {row[0] for row in
+                                      db.session.query(Student.id).filter(Student.id.in_(student_ids))}
+    if missing_meetings or missing_students:
+        return None, (f'Unknown meetings {sorted(missing_meetings)}' if missing_meetings else
+                      f'Unknown students {sorted(missing_students)}')
+    return records, None
 
 
 @app.route('/api/courses/<int:course_id>/meetings', methods=['POST'])
 def create_course_meeting(course_id):
-    data = request.json
-    date = data.get('date')
+    data = request.get_json(silent=True) or {}
     notes = data.get('notes', '')
-    attendance_ids = data.get('attendance', [])
-    # Create meeting
-    meeting = CourseMeeting(course_id=course_id, date=datetime.strptime(date, '%Y-%m-%d').date(), notes=notes)
+    try:
+        meeting_date = datetime.strptime(data.get('date') or '', '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return jsonify({'error': 'date must be in YYYY-MM-DD format'}), 400
+    # attendance: ids of the students present, or [{student_id, present}]
+    attendance = data.get('attendance', [])
+    if isinstance(attendance, list):
+        attendance = [a if isinstance(a, dict) else {'student_id': a, 'present': True} for a in attendance]
+    # Create meeting, linked to the planned session on that date if there is one
+    planned_session = CourseSession.query.filter_by(course_id=course_id, date=meeting_date).first()
+    meeting = CourseMeeting(course_id=course_id, date=meeting_date, notes=notes,
+                            session_id=planned_session.id if planned_session else None)
     db.session.add(meeting)
+    db.session.flush()
+    records, error = parse_attendance_records(attendance, meeting_id=meeting.id)
+    if error:
+        db.session.rollback()
+        return jsonify({'error': error}), 400
+    present_ids = {record['student_id'] for record in records if record['present']}
+    # Create attendance records for all students enrolled in the course, in the same transaction
+    enrolled_ids = [row[0] for row in db.session.query(Enrollment.student_id).filter_by(course_id=course_id)]
+    upsert_attendance([{'meeting_id': meeting.id, 'student_id': student_id, 'present': student_id in present_ids}
+                       for student_id in enrolled_ids])
+    bump_data_version(SCHEDULE_SCOPE)
     db.session.commit()
-    # Create attendance records for all students enrolled in the course
-    enrollments = Enrollment.query.filter_by(course_id=course_id).all()
-    for enrollment in enrollments:
-        present = enrollment.student_id in attendance_ids
-        attendance = Attendance(meeting_id=meeting.id, student_id=enrollment.student_id, present=present)
-        db.session.add(attendance)
-    db.session.commit()
-    return jsonify({'id': meeting.id, 'date': meeting.date.strftime('%Y-%m-%d'), 'notes': meeting.notes}), 201
+    return jsonify({'id': meeting.id, 'date': meeting.date.strftime('%Y-%m-%d'), 'notes': meeting.notes,
+                    'session_id': meeting.session_id}), 201
 
 
 @app.route('/api/meetings/<int:meeting_id>/attendance', methods=['POST'])
 def save_attendance(meeting_id):
-    data = request.json  # list of {student_id, present}
-    for att in data['attendance']:
-        attendance = Attendance.query.filter_by(meeting_id=meeting_id, student_id=att['student_id']).first()
-        if attendance:
-            attendance.present = att['present']
+    CourseMeeting.query.get_or_404(meeting_id)
+    data = request.get_json(silent=True) or {}  # {"attendance": [{student_id, present}, ...]}
+    records, error = parse_attendance_records(data.get('attendance'), meeting_id=meeting_id)
+    if error:
+        return jsonify({'error': error}), 400
+    upsert_attendance(records)
     db.session.commit()
     return jsonify({'message': 'Attendance saved'}), 200
 
 
+@app.route('/api/attendance/bulk', methods=['POST'])
+def save_attendance_bulk():
+    """
+    Save attendance for any number of meetings and students in one transaction.
+    Body: {"records": [{"meeting_id": 1, "student_id": 2, "present": true}, ...]}
+    """
+    records, error = parse_attendance_records((request.get_json(silent=True) or {}).get('records'))
+    if error:
+        return jsonify({'error': error}), 400
+    saved = upsert_attendance(records)
+    db.session.commit()
+    return jsonify({'saved': saved}), 200
+
+
 @app.route('/api/meetings/<int:meeting_id>', methods=['DELETE'])
 def delete_meeting(meeting_id):
     try:
@@ -1332,6 +3357,7 @@ def delete_meeting(meeting_id):
         # remove attendance entries first
         Attendance.query.filter_by(meeting_id=meeting.id).delete()
         db.session.delete(meeting)
+        bump_data_version(SCHEDULE_SCOPE)
         db.session.commit()
         return '', 204
     except Exception as e:
@@ -1353,43 +3379,7 @@ def get_monthly_calendar():
         next_month = month_start.replace(month=month_start.month + 1, day=1)
     month_end = next_month - timedelta(days=1)
 
-    courses = Course.query.filter(
-        Course.start_date <= month_end,
-        Course.end_date >= month_start
-    ).all()
-
-    calendar_data = []
-    for course in courses:
-        weekdays = [int(day) for day in course.weekdays.split(',')]
-        current_date = max(course.start_date, month_start)
-        while current_date <= min(course.end_date, month_end):
-            weekday = current_date.weekday()
-            sunday_based_weekday = (weekday + 1) % 7
-            if sunday_based_weekday in weekdays:
-                course_weekdays = [int(day) for day in course.weekdays.split(',')]
-                classes_completed = 0
-                temp_date = course.start_date
-                while temp_date < current_date:
-                    temp_weekday = (temp_date.weekday() + 1) % 7
-                    if temp_weekday in course_weekdays:
-                        classes_completed += 1
-                    temp_date += timedelta(days=1)
-                classes_remaining = max(0, course.sessions_count - classes_completed)
-                enrolled_count = db.session.query(Enrollment).filter_by(course_id=course.id).count()
-                calendar_data.append({
-                    'id': course.id,
-                    'title': course.name,
-                    'date': current_date.strftime('%Y-%m-%d'),
-                    'time': course.time,
-                    'duration': course.duration,
-                    'teacher': course.teacher,
-                    'color': course.color,
-                    'enrolled_count': enrolled_count,
-                    'classes_remaining': classes_remaining
-                })
-            current_date += timedelta(days=1)
-    calendar_data.sort(key=lambda x: (x['date'], x['time']))
-    return jsonify(calendar_data)
+    return calendar_response('monthly', month_start, month_end)
 
 
 @app.route('/api/students/<int:student_id>', methods=['GET'])
@@ -1404,7 +3394,7 @@ def student_profile(student_id):
         return redirect(url_for('login', next=request.path))
     student = Student.query.get_or_404(student_id)
     # Get all enrollments and courses
-    enrollments = Enrollment.query.filter_by(student_id=student_id).all()
+    enrollments = Enrollment.query.options(joinedload(Enrollment.course)).filter_by(student_id=student_id).all()
     courses = [
         {
             **enrollment.course.to_dict(),
@@ -1414,7 +3404,7 @@ def student_profile(student_id):
         for enrollment in enrollments
     ]
     # Get all payments for this student
-    payments = Payment.query.filter_by(student_id=student_id).all()
+    payments = Payment.query.options(joinedload(Payment.course)).filter_by(student_id=student_id).all()
     # Group payments by course and month
     payments_by_course = {}
     for payment in payments:
@@ -1436,244 +3426,1201 @@ def student_profile(student_id):
     )
 
 
+PAYMENT_EXPORT_HEADER = ['Invoice Number', 'Payment Date', 'Student Name', 'Course Name', 'Teacher Name', 'Month',
+                         'Amount (₪)', 'Payment Method']
+PAYMENT_EXPORT_CHUNK = 1000
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def payments_export_filename(period):
+    period_text = period.replace('_', ' ').title() if period != 'all' else 'All Time'
+    return f'payments_{period_text.replace(" ", "_").lower()}_{datetime.now().strftime("%Y%m%d")}.xlsx'
+
+
+def payment_export_styles():
+    thin = Side(style='thin')
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    center = Alignment(horizontal="center", vertical="center")
+    return [
+        NamedStyle('export_title', font=Font(bold=True, size=14), alignment=center,
+                   fill=PatternFill(start_color="F3F4F6", end_color="F3F4F6", fill_type="solid")),
+        NamedStyle('export_meta', font=Font(size=10), alignment=center,
+                   fill=PatternFill(start_color="F3F4F6", end_color="F3F4F6", fill_type="solid")),
+        NamedStyle('export_header', font=Font(bold=True, size=12), alignment=center, border=border,
+                   fill=PatternFill(start_color="90EE90", end_color="90EE90", fill_type="solid")),
+        NamedStyle('export_cell', border=border),
+        NamedStyle('export_total', font=Font(bold=True), alignment=center, border=border,
+                   fill=PatternFill(start_color="E5E7EB", end_color="E5E7EB", fill_type="solid")),
+        NamedStyle('export_section', font=Font(bold=True, size=12)),
+        NamedStyle('export_stat', border=border,
+                   fill=PatternFill(start_color="F9FAFB", end_color="F9FAFB", fill_type="solid")),
+        NamedStyle('export_stat_label', font=Font(bold=True), border=border,
+                   fill=PatternFill(start_color="F9FAFB", end_color="F9FAFB", fill_type="solid")),
+    ]
+
+
+def write_payments_workbook(fileobj, period, start_date, progress=None):
+    """
+    Write the payments export to fileobj and return the number of payments written (0 writes nothing).
+    The workbook is write-only, so openpyxl spills rows to disk as they are appended, and payments are read
+    with a joined query in keyset chunks of PAYMENT_EXPORT_CHUNK: memory stays flat however many rows there
+    are, and no statement stays open between chunks. progress(rows_done, rows_total) is called after each.
+    Write-only sheets need their column widths before the first row, so they come from a MAX(LENGTH())
+    pre-pass; the totals and the payment method breakdown are summed while the rows go out.
+    """
+    date_filter = [Payment.payment_date >= start_date] if start_date else []
+    count, student_width, course_width, teacher_width, method_width = db.session.query(
+        db.func.count(Payment.id),
+        db.func.max(db.func.length(Student.first_name) + db.func.length(Student.fathers_name) + 1),
+        db.func.max(db.func.length(Course.name)),
+        db.func.max(db.func.length(Course.teacher)),
+        db.func.max(db.func.length(Payment.payment_method))
+    ).outerjoin(Student, Student.id == Payment.student_id).outerjoin(
+        Course, Course.id == Payment.course_id
+    ).filter(*date_filter).one()
+    if not count:
+        return 0
+
+    wb = Workbook(write_only=True)
+    for style in payment_export_styles():
+        wb.add_named_style(style)
+    ws = wb.create_sheet("Payments")
+    widths = [len(f"INV-{0:06d}"), len('YYYY-MM-DD'), max(student_width or 0, len("Unknown Student")),
+              max(course_width or 0, len("Unknown Course")), max(teacher_width or 0, len("Unknown Teacher")),
+              len('YYYY-MM'), 12, max(method_width or 0, len('N/A'))]
+    for col, (title, width) in enumerate(zip(PAYMENT_EXPORT_HEADER, widths), start=1):
+        ws.column_dimensions[get_column_letter(col)].width = (max(width, len(title)) + 2) * 1.2
+
+    def styled(value, style):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        return cell
+
+    def merged_row(row, value, style):
+        ws.merged_cells.add(f'A{row}:H{row}')
+        ws.append([styled(value, style)] + [styled(None, style) for _ in range(7)])
+
+    period_text = period.replace('_', ' ').title() if period != 'all' else 'All Time'
+    merged_row(1, "Sports Club Management System - Payment Export", 'export_title')
+    merged_row(2, f"Export Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 'export_meta')
+    merged_row(3, f"Period: {period_text}", 'export_meta')
+    ws.append([styled(title, 'export_header') for title in PAYMENT_EXPORT_HEADER])
+
+    chunk_query = db.session.query(
+        Payment.id, Payment.payment_date, Payment.month, Payment.amount, Payment.payment_method,
+        Student.first_name, Student.fathers_name, Course.name, Course.teacher
+    ).outerjoin(Student, Student.id == Payment.student_id).outerjoin(
+        Course, Course.id == Payment.course_id
+    ).filter(*date_filter)
+
+    def rows():
+        last_id = 0
+        while True:
+            chunk = chunk_query.filter(Payment.id > last_id).order_by(Payment.id).limit(PAYMENT_EXPORT_CHUNK).all()
+            yield from chunk
+            if progress:
+                progress(written, count)
+            if len(chunk) < PAYMENT_EXPORT_CHUNK:
+                return
+            last_id = chunk[-1][0]
+
+    # append() serializes the row before returning, so one styled cell per column is refilled for every row
+    cells = [styled(None, 'export_cell') for _ in PAYMENT_EXPORT_HEADER]
+    total_amount = 0
+    payment_methods = {}
+    written = 0
+    for (payment_id, payment_date, month, amount, method,
+         first_name, fathers_name, course_name, teacher) in rows():
+        amount = amount or 0
+        for cell, value in zip(cells, (
+            f"INV-{payment_id:06d}",
+            payment_date.strftime('%Y-%m-%d') if payment_date else 'Unknown',
+            f"{first_name} {fathers_name}" if first_name is not None else "Unknown Student",
+            course_name if course_name is not None else "Unknown Course",
+            teacher if course_name is not None else "Unknown Teacher",
+            month or 'Unknown',
+            amount,
+            method or 'N/A'
+        )):
+            cell.value = value
+        ws.append(cells)
+        total_amount += amount
+        stats = payment_methods.setdefault(method or 'Unknown', {'count': 0, 'amount': 0})
+        stats['count'] += 1
+        stats['amount'] += amount
+        written += 1
+
+    # Data starts on row 5; the total, a blank row and the breakdown heading follow it
+    ws.append([styled(value, 'export_total') for value in ("TOTAL", None, None, None, None, None, total_amount, None)])
+    ws.append([])
+    merged_row(written + 7, "Payment Method Breakdown", 'export_section')
+    for method, stats in payment_methods.items():
+        percentage = stats['amount'] / total_amount * 100 if total_amount > 0 else 0
+        ws.append([styled(method, 'export_stat_label'), styled(stats['count'], 'export_stat'),
+                   styled(stats['amount'], 'export_stat'), styled(f"{percentage:.1f}%", 'export_stat')])
+    wb.save(fileobj)
+    return written
+
+
 @app.route('/api/payments/export', methods=['GET'])
 def export_payments_to_excel():
+    """
+    Download the payments dated in ?period=month|quarter|year|all as an .xlsx file. The workbook is built in a
+    temporary file, which is then streamed to the client in blocks and deleted when the response closes.
+    """
+    export_started = time.perf_counter()
+    period = request.args.get('period', 'all')
+    excel_data = tempfile.TemporaryFile()
     try:
-        period = request.args.get('period', 'all')
-
-        # Build date filter based on period
-        if period == 'month':
-            start_date = datetime.now().replace(day=1).date()
-        elif period == 'quarter':
-            current_month = datetime.now().month
-            quarter_start_month = ((current_month - 1) // 3) * 3 + 1
-            start_date = datetime.now().replace(month=quarter_start_month, day=1).date()
-        elif period == 'year':
-            start_date = datetime.now().replace(month=1, day=1).date()
-        else:  # all
-            start_date = None
-
-        # Query payments with optional date filtering
-        if start_date:
-            payments = Payment.query.filter(Payment.payment_date >= start_date).all()
-        else:
-            payments = Payment.query.all()
-
-        logger.info(f"Found {len(payments)} payments for export")
-
-        # Check if there are any payments to export
-        if not payments:
-            logger.info("No payments found for export")
-            return jsonify({'error': 'No payments found for the selected period'}), 404
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Payments"
-
-        # Define styles
-        header_font = Font(bold=True, size=12)
-        header_fill = PatternFill(start_color="90EE90", end_color="90EE90", fill_type="solid")
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        border = Border(left=Side(style='thin'),
-                        right=Side(style='thin'),
-                        top=Side(style='thin'),
-                        bottom=Side(style='thin'))
-
-        # Add export metadata FIRST (rows 1-3)
-        ws.cell(row=1, column=1, value="Sports Club Management System - Payment Export").font = Font(bold=True, size=14)
-        ws.cell(row=2, column=1, value=f"Export Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}").font = Font(
-            size=10)
-        ws.cell(row=3, column=1,
-                value=f"Period: {period.replace('_', ' ').title() if period != 'all' else 'All Time'}").font = Font(
-            size=10)
-
-        # Merge metadata cells
-        ws.merge_cells('A1:H1')
-        ws.merge_cells('A2:H2')
-        ws.merge_cells('A3:H3')
-
-        # Style metadata rows
-        for row in range(1, 4):
-            for col in range(1, 9):
-                cell = ws.cell(row=row, column=col)
-                cell.fill = PatternFill(start_color="F3F4F6", end_color="F3F4F6", fill_type="solid")
-                cell.alignment = Alignment(horizontal="center", vertical="center")
-
-        # Write header at row 4
-        ws.cell(row=4, column=1, value="Invoice Number").font = header_font
-        ws.cell(row=4, column=2, value="Payment Date").font = header_font
-        ws.cell(row=4, column=3, value="Student Name").font = header_font
-        ws.cell(row=4, column=4, value="Course Name").font = header_font
-        ws.cell(row=4, column=5, value="Teacher Name").font = header_font
-        ws.cell(row=4, column=6, value="Month").font = header_font
-        ws.cell(row=4, column=7, value="Amount (₪)").font = header_font
-        ws.cell(row=4, column=8, value="Payment Method").font = header_font
-
-        # Apply styles to header
-        for row in ws.iter_rows(min_row=4, max_row=4):
-            for cell in row:
-                cell.fill = header_fill
-                cell.alignment = header_alignment
-                cell.border = border
-
-        # Write data
-        for i, payment in enumerate(payments, start=5):  # Start from row 5 (after metadata)
+        written = write_payments_workbook(excel_data, period, analysis_period_start(period))
+    except Exception as e:
+        excel_data.close()
+        logger.error(f"Error exporting payments to Excel: {str(e)}")
+        return jsonify({'error': f'Error exporting payments: {str(e)}'}), 500
+    if not written:
+        excel_data.close()
+        logger.info("No payments found for export")
+        return jsonify({'error': 'No payments found for the selected period'}), 404
+    EXPORT_DURATION.labels('payments_xlsx').observe(time.perf_counter() - export_started)
+    EXPORT_ROWS.labels('payments_xlsx').inc(written)
+    excel_data.seek(0)
+
+    filename = payments_export_filename(period)
+    logger.info(f"Exported {written} payments to {filename}")
+    return send_file(excel_data, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=filename)
+
+
+# ---------------- Export jobs ----------------
+# Exports too slow for a request run as jobs: POST /api/export-jobs queues one, a thread pool in the worker
+# process builds the file into the EXPORT_DIR config directory and records its progress on the job row, and the
+# file can be downloaded until the job expires. Job rows live in the database, so any worker can report on or
+# serve any job; with several machines EXPORT_DIR must be storage they share.
+app.config['EXPORT_DIR'] = os.getenv('EXPORT_DIR', os.path.join(app.instance_path, 'exports'))
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '2'))
+EXPORT_JOB_TTL_SECONDS = int(os.getenv('EXPORT_JOB_TTL_SECONDS', str(24 * 3600)))
+# A queued or running job without progress for this long belongs to a worker that died
+EXPORT_JOB_STALE_SECONDS = int(os.getenv('EXPORT_JOB_STALE_SECONDS', '600'))
+EXPORT_PERIODS = ('month', 'quarter', 'year', 'all')
+ACTIVE_EXPORT_STATUSES = ('queued', 'running')
+# kind -> (writer(fileobj, period, start_date, progress), data scopes the file is built from, filename(period))
+EXPORT_JOB_KINDS = {
+    'payments_xlsx': (write_payments_workbook, (PAYMENTS_SCOPE, STUDENTS_SCOPE, COURSES_SCOPE),
+                      payments_export_filename),
+}
+
+_export_pool = None
+_export_pool_lock = threading.Lock()
+
+
+def export_job_path(job_id):
+    return os.path.join(app.config['EXPORT_DIR'], job_id)
+
+
+def export_cache_key(kind, period):
+    """Jobs with the same key build identical files: same kind and period start, and no write in between."""
+    scopes = EXPORT_JOB_KINDS[kind][1]
+    versions = dict(db.session.query(DataVersion.scope, DataVersion.version).filter(DataVersion.scope.in_(scopes)))
+    start_date = analysis_period_start(period)
+    return ':'.join([kind, period, start_date.isoformat() if start_date else '-']
+                    + [f'{scope}={versions.get(scope, 0)}' for scope in scopes])
+
+
+def cleanup_export_jobs():
+    """Delete expired jobs with their files, fail jobs whose worker died, and remove files no job owns."""
+    now = datetime.utcnow()
+    for job_id, in db.session.query(ExportJob.id).filter(ExportJob.expires_at < now):
+        try:
+            os.remove(export_job_path(job_id))
+        except FileNotFoundError:
+            pass
+    ExportJob.query.filter(ExportJob.expires_at < now).delete(synchronize_session=False)
+    ExportJob.query.filter(
+        ExportJob.status.in_(ACTIVE_EXPORT_STATUSES),
+        ExportJob.updated_at < now - timedelta(seconds=EXPORT_JOB_STALE_SECONDS)
+    ).update({ExportJob.status: 'failed', ExportJob.error: 'The export was interrupted', ExportJob.finished_at: now},
+             synchronize_session=False)
+    db.session.commit()
+    export_dir = app.config['EXPORT_DIR']
+    if os.path.isdir(export_dir):
+        cutoff = time.time() - EXPORT_JOB_TTL_SECONDS
+        for name in os.listdir(export_dir):
+            path = os.path.join(export_dir, name)
             try:
-                # Check if relationships exist
-                if not payment.student:
-                    logger.warning(f"Payment {payment.id} has no student relationship")
-                    student_name = "Unknown Student"
-                else:
-                    student_name = f"{payment.student.first_name} {payment.student.fathers_name}"
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass  # removed by another worker's cleanup
 
-                if not payment.course:
-                    logger.warning(f"Payment {payment.id} has no course relationship")
-                    course_name = "Unknown Course"
-                    teacher_name = "Unknown Teacher"
-                else:
-                    course_name = payment.course.name
-                    teacher_name = payment.course.teacher
-
-                ws.cell(row=i, column=1, value=f"INV-{payment.id:06d}")
-                try:
-                    payment_date = payment.payment_date.strftime('%Y-%m-%d') if payment.payment_date else 'Unknown'
-                except:
-                    payment_date = 'Unknown'
-                ws.cell(row=i, column=2, value=payment_date)
-                ws.cell(row=i, column=3, value=student_name)
-                ws.cell(row=i, column=4, value=course_name)
-                ws.cell(row=i, column=5, value=teacher_name)
-                ws.cell(row=i, column=6, value=payment.month or 'Unknown')
-                ws.cell(row=i, column=7, value=payment.amount or 0)
-
-                # Safely get payment_method - handle case where column might not exist
-                try:
-                    payment_method = payment.payment_method or 'N/A'
-                except AttributeError:
-                    # If payment_method attribute doesn't exist, use 'N/A'
-                    payment_method = 'N/A'
-
-                ws.cell(row=i, column=8, value=payment_method)
-
-                # Add borders to data cells
-                for col in range(1, 9):
-                    ws.cell(row=i, column=col).border = border
-            except Exception as e:
-                logger.error(f"Error processing payment {payment.id}: {str(e)}")
-                # Fill with error data
-                ws.cell(row=i, column=1, value=f"INV-{payment.id:06d}")
-                ws.cell(row=i, column=2, value="Error")
-                ws.cell(row=i, column=3, value="Error")
-                ws.cell(row=i, column=4, value="Error")
-                ws.cell(row=i, column=5, value="Error")
-                ws.cell(row=i, column=6, value="Error")
-                ws.cell(row=i, column=7, value="Error")
-                ws.cell(row=i, column=8, value="Error")
-
-        # Add summary row
-        if payments:
-            try:
-                summary_row = len(payments) + 5  # After data rows (starting from row 5)
-                ws.cell(row=summary_row, column=1, value="TOTAL").font = Font(bold=True)
-                total_amount = sum(p.amount for p in payments if p.amount is not None)
-                ws.cell(row=summary_row, column=7, value=total_amount).font = Font(bold=True)
-
-                # Style the summary row
-                for col in range(1, 9):
-                    cell = ws.cell(row=summary_row, column=col)
-                    cell.fill = PatternFill(start_color="E5E7EB", end_color="E5E7EB", fill_type="solid")
-                    cell.alignment = Alignment(horizontal="center", vertical="center")
-                    cell.border = border
-
-                # Add payment method breakdown
-                stats_row = summary_row + 2
-                ws.cell(row=stats_row, column=1, value="Payment Method Breakdown").font = Font(bold=True, size=12)
-                ws.merge_cells(f'A{stats_row}:H{stats_row}')
-
-                # Calculate payment method statistics
-                payment_methods = {}
-                for payment in payments:
-                    try:
-                        method = payment.payment_method or 'Unknown'
-                    except AttributeError:
-                        # If payment_method attribute doesn't exist, use 'Unknown'
-                        method = 'Unknown'
-
-                    if method not in payment_methods:
-                        payment_methods[method] = {'count': 0, 'amount': 0}
-                    payment_methods[method]['count'] += 1
-                    payment_methods[method]['amount'] += payment.amount or 0
-
-                # Write payment method statistics
-                for i, (method, stats) in enumerate(payment_methods.items()):
-                    row = stats_row + 1 + i
-                    ws.cell(row=row, column=1, value=method).font = Font(bold=True)
-                    ws.cell(row=row, column=2, value=stats['count'])
-                    ws.cell(row=row, column=3, value=stats['amount'])
-                    if total_amount > 0:
-                        percentage = (stats['amount'] / total_amount * 100)
-                        ws.cell(row=row, column=4, value=f"{percentage:.1f}%")
-                    else:
-                        ws.cell(row=row, column=4, value="0.0%")
 
-                    # Style the statistics rows
-                    for col in range(1, 5):
-                        cell = ws.cell(row=row, column=col)
-                        cell.fill = PatternFill(start_color="F9FAFB", end_color="F9FAFB", fill_type="solid")
-                        cell.border = border
-            except Exception as e:
-                logger.error(f"Error creating summary: {str(e)}")
-                # Continue without summary if there's an error
+def run_export_job(job_id):
+    """Build the file of a queued job, committing progress after every chunk the writer reports."""
+    with app.app_context():
+        job = db.session.get(ExportJob, job_id)
+        if job is None or job.status != 'queued':
+            return
+        writer = EXPORT_JOB_KINDS[job.kind][0]
+        job.status = 'running'
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
 
-        # Auto-size columns
-        try:
-            for column in ws.columns:
-                max_length = 0
-                column = [cell for cell in column]
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2) * 1.2
-                ws.column_dimensions[column[0].column_letter].width = adjusted_width
-        except Exception as e:
-            logger.error(f"Error auto-sizing columns: {str(e)}")
-            # Continue with default column widths if auto-sizing fails
+        def progress(rows_done, rows_total):
+            job.rows_done, job.rows_total, job.updated_at = rows_done, rows_total, datetime.utcnow()
+            db.session.commit()
 
-        # Create a BytesIO object to hold the Excel file
+        path = export_job_path(job_id)
+        partial = path + '.part'
+        started = time.perf_counter()
         try:
-            excel_data = BytesIO()
-            wb.save(excel_data)
-            excel_data.seek(0)
+            os.makedirs(app.config['EXPORT_DIR'], exist_ok=True)
+            with open(partial, 'wb') as fileobj:
+                written = writer(fileobj, job.period, analysis_period_start(job.period), progress)
+            if written:
+                os.replace(partial, path)
+                job.status, job.rows_done, job.rows_total = 'done', written, written
+                EXPORT_DURATION.labels(job.kind).observe(time.perf_counter() - started)
+                EXPORT_ROWS.labels(job.kind).inc(written)
+            else:
+                os.remove(partial)
+                job.status, job.error = 'failed', 'Nothing to export for the selected period'
         except Exception as e:
-            logger.error(f"Error saving Excel file: {str(e)}")
-            return jsonify({'error': f'Error creating Excel file: {str(e)}'}), 500
+            db.session.rollback()
+            logger.error(f"Export job {job_id} failed: {e}")
+            if os.path.exists(partial):
+                os.remove(partial)
+            job.status, job.error = 'failed', str(e)
+        now = datetime.utcnow()
+        job.updated_at = job.finished_at = now
+        job.expires_at = now + timedelta(seconds=EXPORT_JOB_TTL_SECONDS)
+        db.session.commit()
+        logger.info(f"Export job {job_id} {job.status} after {time.perf_counter() - started:.1f}s")
+        cleanup_export_jobs()
 
-        # Generate filename with period
-        try:
-            period_text = period.replace('_', ' ').title() if period != 'all' else 'All Time'
-            filename = f'payments_{period_text.replace(" ", "_").lower()}_{datetime.now().strftime("%Y%m%d")}.xlsx'
-        except Exception as e:
-            logger.error(f"Error generating filename: {str(e)}")
-            filename = f'payments_{datetime.now().strftime("%Y%m%d")}.xlsx'
 
-        logger.info(f"Export completed successfully. Filename: {filename}")
-        try:
-            return send_file(excel_data, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                             as_attachment=True, download_name=filename)
-        except Exception as e:
-            logger.error(f"Error sending file: {str(e)}")
-            return jsonify({'error': f'Error sending file: {str(e)}'}), 500
-    except Exception as e:
-        logger.error(f"Error exporting payments to Excel: {str(e)}")
-        return jsonify({'error': f'Error exporting payments: {str(e)}'}), 500
+def submit_export_job(job_id):
+    global _export_pool
+    if db.engine.url.database in (None, '', ':memory:'):
+        run_export_job(job_id)  # every thread gets its own in-memory database, so the job can't leave this one
+        return
+    with _export_pool_lock:
+        if _export_pool is None:  # created lazily, so each gunicorn worker starts its own after the fork
+            _export_pool = ThreadPoolExecutor(EXPORT_JOB_WORKERS, thread_name_prefix='export-job')
+    _export_pool.submit(run_export_job, job_id)
 
 
-if __name__ == '__main__':
-    import sys
+@app.route('/api/export-jobs', methods=['POST'])
+def create_export_job():
+    """
+    Queue an export: {"kind": "payments_xlsx", "period": "month|quarter|year|all"}. Returns 202 with the new
+    job, or 200 with an unexpired job that was queued for the same period since the data last changed.
+    """
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind', 'payments_xlsx')
+    period = data.get('period', 'all')
+    if kind not in EXPORT_JOB_KINDS:
+        return jsonify({'error': f"kind must be one of {', '.join(EXPORT_JOB_KINDS)}"}), 400
+    if period not in EXPORT_PERIODS:
+        return jsonify({'error': f"period must be one of {', '.join(EXPORT_PERIODS)}"}), 400
+    cleanup_export_jobs()
+
+    cache_key = export_cache_key(kind, period)
+    job = ExportJob.query.filter(
+        ExportJob.cache_key == cache_key, ExportJob.status.in_(ACTIVE_EXPORT_STATUSES + ('done',))
+    ).order_by(ExportJob.created_at.desc()).first()
+    if job is not None:
+        return jsonify(job.to_dict()), 200
+
+    job = ExportJob(id=uuid.uuid4().hex, kind=kind, period=period, cache_key=cache_key,
+                    filename=EXPORT_JOB_KINDS[kind][2](period),
+                    expires_at=datetime.utcnow() + timedelta(seconds=EXPORT_JOB_TTL_SECONDS))
+    db.session.add(job)
+    db.session.commit()
+    submit_export_job(job.id)
+    db.session.refresh(job)
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/api/export-jobs/<job_id>')
+def get_export_job(job_id):
+    """
+    Status and progress (rows_done of rows_total) of a job; download_url is set once it is done. Polled
+    every second, so it only reads: cleanup_export_jobs runs when a job is queued and when one finishes.
+    """
+    job = db.session.get(ExportJob, job_id)
+    now = datetime.utcnow()
+    if job is None or job.expires_at < now:
+        return jsonify({'error': 'Export job not found or expired'}), 404
+    body = job.to_dict()
+    if job.status in ACTIVE_EXPORT_STATUSES and job.updated_at < now - timedelta(seconds=EXPORT_JOB_STALE_SECONDS):
+        # Reported as the next cleanup will record it, so pollers stop waiting on a worker that died
+        body.update(status='failed', error='The export was interrupted')
+    return jsonify(body)
+
+
+@app.route('/api/export-jobs/<job_id>/download')
+def download_export_job(job_id):
+    job = db.session.get(ExportJob, job_id)
+    if job is None or job.expires_at < datetime.utcnow():
+        return jsonify({'error': 'Export job not found or expired'}), 404
+    if job.status != 'done':
+        return jsonify({'error': f'Export job is {job.status}'}), 409
+    return send_file(export_job_path(job_id), mimetype=XLSX_MIMETYPE, as_attachment=True,
+                     download_name=job.filename)
+
+
+# ---------------- Raw exports ----------------
+# /api/export/<entity>.csv and .ndjson stream plain rows for the accountant and BI scripts. Rows are read as
+# tuples from a server-side cursor, RAW_EXPORT_BATCH at a time, and written out as they arrive: no ORM objects
+# are built and memory doesn't grow with the row count.
+RAW_EXPORT_BATCH = 2000
+
+
+def raw_payments_export():
+    return db.select(
+        Payment.id, Payment.payment_date, Payment.month, Payment.amount, Payment.payment_method,
+        Payment.student_id, Student.first_name, Student.fathers_name,
+        Payment.course_id, Course.name.label('course_name'), Course.teacher
+    ).select_from(Payment).outerjoin(Student, Student.id == Payment.student_id).outerjoin(
+        Course, Course.id == Payment.course_id
+    ).order_by(Payment.id), Payment.payment_date
+
+
+def raw_students_export():
+    return db.select(
+        Student.id, Student.first_name, Student.fathers_name, Student.phone, Student.national_id,
+        Student.date_of_birth
+    ).order_by(Student.id), None
+
+
+def raw_attendance_export():
+    return db.select(
+        CourseMeeting.date, CourseMeeting.id.label('meeting_id'), CourseMeeting.course_id,
+        Course.name.label('course_name'), Attendance.student_id, Student.first_name, Student.fathers_name,
+        Attendance.present
+    ).select_from(Attendance).join(CourseMeeting, CourseMeeting.id == Attendance.meeting_id).join(
+        Course, Course.id == CourseMeeting.course_id
+    ).outerjoin(Student, Student.id == Attendance.student_id).order_by(
+        CourseMeeting.date, CourseMeeting.id, Attendance.student_id
+    ), CourseMeeting.date
+
+
+# entity -> () returning (select statement, date column filtered by period/start/end, or None)
+RAW_EXPORTS = {
+    'payments': raw_payments_export,
+    'students': raw_students_export,
+    'attendance': raw_attendance_export,
+}
+
+
+@app.route('/api/export/<any(payments, students, attendance):entity>.<any(csv, ndjson):fmt>')
+def export_raw_rows(entity, fmt):
+    """
+    Stream every row of entity as CSV or NDJSON. Payments (by payment date) and attendance (by meeting date)
+    take ?period=month|quarter|year|all or an explicit ?start=YYYY-MM-DD&end=YYYY-MM-DD, both inclusive;
+    start/end override period.
+    """
+    statement, date_column = RAW_EXPORTS[entity]()
+    period = request.args.get('period', 'all')
+    if period not in EXPORT_PERIODS:
+        return jsonify({'error': f"period must be one of {', '.join(EXPORT_PERIODS)}"}), 400
+    try:
+        start_date, end_date = (datetime.strptime(request.args[name], '%Y-%m-%d').date()
+                                if request.args.get(name) else None for name in ('start', 'end'))
+    except ValueError:
+        return jsonify({'error': 'start and end must be YYYY-MM-DD'}), 400
+    if not start_date and not end_date:
+        start_date = analysis_period_start(period)
+    if start_date or end_date:
+        if date_column is None:
+            return jsonify({'error': f'{entity} cannot be filtered by date'}), 400
+        if start_date:
+            statement = statement.where(date_column >= start_date)
+        if end_date:
+            statement = statement.where(date_column <= end_date)
+
+    result = db.session.execute(statement.execution_options(stream_results=True, yield_per=RAW_EXPORT_BATCH))
+    keys = list(result.keys())
+    label = f'{entity}_{fmt}'
+    started = time.perf_counter()
+
+    def rows():
+        count = 0
+        for partition in result.partitions():
+            yield from partition
+            count += len(partition)
+        EXPORT_DURATION.labels(label).observe(time.perf_counter() - started)
+        EXPORT_ROWS.labels(label).inc(count)
+
+    filename = f'{entity}_{datetime.now().strftime("%Y%m%d")}.{fmt}'
+    if fmt == 'csv':
+        return stream_csv(keys, rows(), filename)
+    return stream_ndjson(keys, rows(), filename)
+
+
+# ---------------- Bulk import ----------------
+# POST /api/import/<entity> and `python app.py --import <entity> <file>` load students, enrollments or payments
+# from an .xlsx or .csv file. Rows are read as a stream and checked against the table's constraints, with the
+# unique and foreign keys looked up in sets preloaded once. Valid rows are inserted IMPORT_BATCH at a time in one
+# transaction, which is committed only if every row is valid, so a fixed file can simply be imported again.
+IMPORT_BATCH = 1000
+IMPORT_MAX_REPORTED_ERRORS = 1000
+PAYMENT_METHODS = ('cash', 'check', 'transfer')
+
+
+def read_import_rows(fileobj, filename):
+    """
+    Return (header, rows) for an .xlsx (first sheet) or UTF-8 .csv file, where rows yields (row number,
+    {column: value}) without loading the whole file. Column names are lower-cased with spaces turned into
+    underscores, and blank rows are skipped.
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.xlsx':
+        workbook = load_workbook(fileobj, read_only=True, data_only=True)
+        lines = workbook.worksheets[0].iter_rows(values_only=True)
+    elif extension == '.csv':
+        workbook = None
+        lines = csv.reader(TextIOWrapper(fileobj, encoding='utf-8-sig', newline=''))
+    else:
+        raise ValueError('Upload an .xlsx or .csv file')
+    header = [str(name or '').strip().lower().replace(' ', '_') for name in next(lines, ())]
+
+    def rows():
+        for number, values in enumerate(lines, start=2):
+            if any(value not in (None, '') for value in values):
+                yield number, dict(zip(header, values))
+        if workbook is not None:
+            workbook.close()
+
+    return header, rows()
+
+
+def import_text(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # numbers typed into Excel cells, such as phone numbers and IDs
+    return str(value).strip()
+
+
+def import_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(import_text(value), '%Y-%m-%d').date()
+
+
+def import_month(value):
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%Y-%m')
+    value = import_text(value)
+    datetime.strptime(value, '%Y-%m')
+    return value
+
+
+def import_amount(value):
+    amount = float(value)
+    if amount < 0:
+        raise ValueError('negative')
+    return amount
+
+
+def import_field(row, name, problems, parse=import_text, required=True, max_length=None):
+    """Parse row[name], appending to problems and returning None when it is missing or invalid."""
+    value = row.get(name)
+    if isinstance(value, str):
+        value = value.strip()
+    if value in (None, ''):
+        if required:
+            problems.append(f'{name} is required')
+        return None
+    try:
+        parsed = parse(value)
+    except (TypeError, ValueError):
+        problems.append(f'{name} {value!r} is invalid')
+        return None
+    if max_length and len(parsed) > max_length:
+        problems.append(f'{name} is longer than {max_length} characters')
+        return None
+    return parsed
+
+
+class BulkImporter(ABC):
+    """
+    Turns import rows into records of one model and inserts them in batches. Subclasses preload the keys they
+    check in __init__ and implement parse(row_number, row), which returns the record, returns None for a row
+    that is already in the database, or raises ValueError listing the row's problems.
+    """
+    model = None
+    scopes = ()
+    required_columns = ()  # each entry is a column name or a tuple of alternatives
+
+    def __init__(self, write=True):
+        self.write = write
+        self.pending = []
+        self.valid = 0
+        self.skipped = 0
+
+    def check_header(self, header):
+        missing = [' or '.join(names) if isinstance(names, tuple) else names for names in self.required_columns
+                   if not set(names if isinstance(names, tuple) else (names,)) & set(header)]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    @abstractmethod
+    def parse(self, row_number, row):
+        """The record for row, None to skip it, or ValueError listing its problems."""
+
+    def add(self, row_number, row):
+        record = self.parse(row_number, row)
+        if record is None:
+            self.skipped += 1
+            return
+        self.valid += 1
+        if self.write:
+            self.pending.append(record)
+            if len(self.pending) >= IMPORT_BATCH:
+                self.flush()
+
+    def flush(self):
+        if self.pending:
+            db.session.execute(db.insert(self.model), self.pending)
+            self.pending = []
+
+    def finish(self):
+        """Insert the last batch and bump the data versions; the caller commits."""
+        self.flush()
+        bump_data_version(*self.scopes)
+
+
+class StudentImporter(BulkImporter):
+    model = Student
+    scopes = (STUDENTS_SCOPE,)
+    required_columns = ('first_name', 'fathers_name', 'phone', 'date_of_birth')
+
+    def __init__(self, write=True):
+        super().__init__(write)
+        # value -> row number that used it, 0 for students already in the database
+        self.phones = {phone: 0 for phone, in db.session.query(Student.phone)}
+        self.national_ids = {national_id: 0 for national_id, in
+                             db.session.query(Student.national_id).filter(Student.national_id.isnot(None))}
+
+    def claim(self, keys, name, value, row_number, problems):
+        if value is None:
+            return
+        owner = keys.get(value)
+        if owner == 0:
+            problems.append(f'{name} {value} already belongs to a student')
+        elif owner:
+            problems.append(f'{name} {value} is also on row {owner}')
+
+    def parse(self, row_number, row):
+        problems = []
+        record = {
+            'first_name': import_field(row, 'first_name', problems, max_length=50),
+            'fathers_name': import_field(row, 'fathers_name', problems, max_length=50),
+            'phone': import_field(row, 'phone', problems, max_length=20),
+            'date_of_birth': import_field(row, 'date_of_birth', problems, import_date),
+            'national_id': import_field(row, 'national_id', problems, required=False, max_length=20),
+        }
+        self.claim(self.phones, 'phone', record['phone'], row_number, problems)
+        self.claim(self.national_ids, 'national_id', record['national_id'], row_number, problems)
+        if problems:
+            raise ValueError('; '.join(problems))
+        self.phones[record['phone']] = row_number
+        if record['national_id']:
+            self.national_ids[record['national_id']] = row_number
+        return record
+
+
+class StudentCourseImporter(BulkImporter):
+    """Rows that point at a student (student_id or phone) and a course (course_id or its name)."""
+    required_columns = (('student_id', 'phone'), ('course_id', 'course'))
+
+    def __init__(self, write=True):
+        super().__init__(write)
+        self.student_by_phone = dict(db.session.query(Student.phone, Student.id))
+        self.student_ids = set(self.student_by_phone.values())
+        self.course_ids = set()
+        self.courses_by_name = {}
+        for course_id, name in db.session.query(Course.id, Course.name):
+            self.course_ids.add(course_id)
+            self.courses_by_name.setdefault(name.strip().casefold(), []).append(course_id)
+
+    def resolve(self, row, problems):
+        """Return (student_id, course_id), either None when the row doesn't identify one."""
+        reported = len(problems)
+        student_id = import_field(row, 'student_id', problems, int, required=False)
+        phone = import_field(row, 'phone', problems, required=False)
+        if student_id is not None:
+            if student_id not in self.student_ids:
+                problems.append(f'student_id {student_id} does not exist')
+                student_id = None
+        elif phone is not None:
+            student_id = self.student_by_phone.get(phone)
+            if student_id is None:
+                problems.append(f'no student has phone {phone}')
+        elif len(problems) == reported:
+            problems.append('student_id or phone is required')
+
+        reported = len(problems)
+        course_id = import_field(row, 'course_id', problems, int, required=False)
+        name = import_field(row, 'course', problems, required=False)
+        if course_id is not None:
+            if course_id not in self.course_ids:
+                problems.append(f'course_id {course_id} does not exist')
+                course_id = None
+        elif name is not None:
+            matches = self.courses_by_name.get(name.casefold(), [])
+            if len(matches) == 1:
+                course_id = matches[0]
+            elif matches:
+                problems.append(f'{len(matches)} courses are named {name!r}; use course_id')
+            else:
+                problems.append(f'no course is named {name!r}')
+        elif len(problems) == reported:
+            problems.append('course_id or course is required')
+        return student_id, course_id
+
+
+class EnrollmentImporter(StudentCourseImporter):
+    model = Enrollment
+    scopes = (SCHEDULE_SCOPE,)
+
+    def __init__(self, write=True):
+        super().__init__(write)
+        self.enrolled = set(db.session.query(Enrollment.course_id, Enrollment.student_id))
+
+    def parse(self, row_number, row):
+        problems = []
+        student_id, course_id = self.resolve(row, problems)
+        enrollment_date = import_field(row, 'enrollment_date', problems, import_date, required=False)
+        if problems:
+            raise ValueError('; '.join(problems))
+        if (course_id, student_id) in self.enrolled:
+            return None  # already enrolled, by an earlier import or row
+        self.enrolled.add((course_id, student_id))
+        return {'course_id': course_id, 'student_id': student_id,
+                'enrollment_date': enrollment_date or datetime.now().date()}
+
+
+class PaymentImporter(StudentCourseImporter):
+    model = Payment
+    scopes = (PAYMENTS_SCOPE,)
+    required_columns = StudentCourseImporter.required_columns + ('month', 'amount')
+
+    def __init__(self, write=True):
+        super().__init__(write)
+        self.revenue = {}
+
+    def parse(self, row_number, row):
+        problems = []
+        student_id, course_id = self.resolve(row, problems)
+        method = import_field(row, 'payment_method', problems, lambda value: import_text(value).lower(),
+                              required=False) or 'cash'
+        if method not in PAYMENT_METHODS:
+            problems.append(f"payment_method must be one of {', '.join(PAYMENT_METHODS)}")
+        record = {
+            'student_id': student_id,
+            'course_id': course_id,
+            'month': import_field(row, 'month', problems, import_month),
+            'amount': import_field(row, 'amount', problems, import_amount),
+            'payment_date': import_field(row, 'payment_date', problems, import_date, required=False)
+            or datetime.now().date(),
+            'payment_method': method,
+        }
+        if problems:
+            raise ValueError('; '.join(problems))
+        key = revenue_rollup_key(record['payment_date'], course_id, method)
+        amount, count = self.revenue.get(key, (0.0, 0))
+        self.revenue[key] = (amount + record['amount'], count + 1)
+        return record
+
+    def finish(self):
+        super().finish()
+        apply_revenue_deltas(self.revenue)
+
+
+IMPORTERS = {
+    'students': StudentImporter,
+    'enrollments': EnrollmentImporter,
+    'payments': PaymentImporter,
+}
+
+
+def import_rows(entity, header, rows, dry_run=False):
+    """
+    Validate every row and, if all are valid and this isn't a dry run, commit them. Returns the report:
+    row counts and the first IMPORT_MAX_REPORTED_ERRORS errors as {'row': row number, 'error': message}.
+    Raises ValueError when the header lacks a required column.
+    """
+    started = time.perf_counter()
+    importer = IMPORTERS[entity](write=not dry_run)
+    importer.check_header(header)
+    errors = []
+    error_count = 0
+    try:
+        for row_number, row in rows:
+            try:
+                importer.add(row_number, row)
+            except ValueError as e:
+                error_count += 1
+                importer.write = False  # nothing will be committed, so stop inserting
+                if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                    errors.append({'row': row_number, 'error': str(e)})
+        if error_count or dry_run:
+            db.session.rollback()
+        else:
+            importer.finish()
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    imported = importer.valid if not (error_count or dry_run) else 0
+    logger.info(f"Import of {entity}: {imported} imported, {importer.skipped} skipped, {error_count} errors "
+                f"in {time.perf_counter() - started:.2f}s")
+    return {
+        'entity': entity,
+        'dry_run': dry_run,
+        'rows': importer.valid + importer.skipped + error_count,
+        'valid': importer.valid,
+        'imported': imported,
+        'skipped': importer.skipped,
+        'error_count': error_count,
+        'errors': errors,
+    }
+
+
+@app.route('/api/import/<any(students, enrollments, payments):entity>', methods=['POST'])
+def import_upload(entity):
+    """
+    Import the uploaded file (multipart field "file", .xlsx or .csv). Returns the report with 200 when the rows
+    were imported, or 422 when any row is invalid, in which case nothing was imported. ?dry_run=1 only validates.
+    Rows already in the database (an enrollment of the same student in the same course) are skipped.
+    """
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': 'Upload the file as the "file" field'}), 400
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    try:
+        header, rows = read_import_rows(upload.stream, upload.filename)
+        report = import_rows(entity, header, rows, dry_run)
+    except UnicodeDecodeError:
+        return jsonify({'error': 'CSV files must be saved as UTF-8'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except IntegrityError:
+        return jsonify({'error': 'The data changed while importing; nothing was imported, please try again'}), 409
+    return jsonify(report), 422 if report['error_count'] else 200
+
+
+def benchmark_calendar(courses_count=60, repeats=20):
+    """
+    Time /api/calendar/monthly for courses of increasing age.
+    With the closed-form session index the timings should stay flat as courses get older.
+    Destroys the configured database, so it refuses to run against anything but in-memory SQLite.
+    """
+    if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:
+        logger.error("Run the benchmark with DATABASE_URL=sqlite:///:memory:")
+        return False
+
+    client = app.test_client()
+    today = datetime.now().date()
+    month_start = today.replace(day=1).strftime('%Y-%m-%d')
+    for age_years in (1, 5, 10, 20):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            start_date = today - timedelta(days=365 * age_years)
+            for i in range(courses_count):
+                sessions_count = 3 * 52 * (age_years + 1)
+                db.session.add(Course(
+                    name=f'Course {i}', teacher=f'Coach {i % 7}', start_date=start_date, time='17:00',
+                    sessions_count=sessions_count, sessions_per_week=3, weekdays='0,2,4',
+                    end_date=start_date + timedelta(weeks=sessions_count // 3)
+                ))
+            db.session.commit()
+            backfill_course_sessions()
+        client.get(f'/api/calendar/monthly?start_date={month_start}')  # warm-up
+        started = time.perf_counter()
+        for _ in range(repeats):
+            events = client.get(f'/api/calendar/monthly?start_date={month_start}').get_json()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeats
+        print(f"course age {age_years:>2}y: {len(events):>4} events, {elapsed_ms:8.2f} ms per monthly view")
+    with app.app_context():
+        db.drop_all()
+    return True
+
+
+def benchmark_search(students_count=100000, repeats=50):
+    """
+    Time /api/students/search against a large synthetic roster, alongside the index build time.
+    Destroys the configured database, so it refuses to run against anything but in-memory SQLite.
+    """
+    if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:
+        logger.error("Run the benchmark with DATABASE_URL=sqlite:///:memory:")
+        return False
+
+    first_names = ['أحمد', 'محمد', 'فاطمة', 'ليلى', 'يوسف', 'سامي', 'إبراهيم', 'مريم', 'אברהם', 'שרה', 'דוד', 'Omar']
+    fathers_names = ['علي', 'حسن', 'خالد', 'عمر', 'كהן', 'לוי', 'Nasser', 'Saleh']
+    client = app.test_client()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(db.insert(Student), [{
+            'first_name': f'{first_names[i % len(first_names)]}{i % 997}',
+            'fathers_name': fathers_names[i % len(fathers_names)],
+            'phone': f'05{i:08d}',
+            'national_id': f'{i:09d}',
+            'date_of_birth': datetime(2010, 1, 1).date(),
+        } for i in range(students_count)])
+        bump_data_version(STUDENTS_SCOPE)
+        db.session.commit()
+        started = time.perf_counter()
+        student_search_index.ensure_fresh()
+        print(f"index build: {(time.perf_counter() - started) * 1000:8.2f} ms for {students_count} students")
+        # Writes by other workers are caught up on through data_changes instead of a rebuild
+        for changed in (1, 100):
+            for student in Student.query.filter(Student.id <= changed):
+                student.first_name = f'{student.first_name}x'
+            bump_data_version(STUDENTS_SCOPE, changed={STUDENTS_SCOPE: range(1, changed + 1)})
+            db.session.commit()
+            _version_snapshots.clear()
+            started = time.perf_counter()
+            student_search_index.ensure_fresh()
+            print(f"catch-up: {(time.perf_counter() - started) * 1000:8.2f} ms for {changed} changed students")
+    for query in ('احمد', 'محمد1', 'ابراهيم خالد', 'אברה', '0500001', '3456', 'omar5'):
+        started = time.perf_counter()
+        for _ in range(repeats):
+            results = client.get('/api/students/search', query_string={'q': query}).get_json()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeats
+        print(f"{query!r:>16}: {len(results):>3} results, {elapsed_ms:8.2f} ms per search")
+    with app.app_context():
+        db.drop_all()
+    return True
+
+
+def benchmark_indexes(students_count=15000, courses_count=300, repeats=9):
+    """
+    Time the calendar, profile, analysis and export routes on a large dataset, first without the
+    secondary indexes declared on the models and then with them.
+    Destroys the configured database, so it refuses to run against anything but in-memory SQLite.
+    """
+    if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:
+        logger.error("Run the benchmark with DATABASE_URL=sqlite:///:memory:")
+        return False
+
+    today = datetime.now().date()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        courses = []
+        for i in range(courses_count):
+            start_date = today - timedelta(days=(i * 7) % (6 * 365))
+            courses.append({'id': i + 1, 'name': f'Course {i}', 'teacher': f'Coach {i % 30}',
+                            'start_date': start_date, 'end_date': start_date + timedelta(weeks=24), 'time': '17:00',
+                            'duration': 60, 'sessions_count': 48, 'sessions_per_week': 2, 'weekdays': '0,3',
+                            'color': '#3B82F6'})
+        db.session.execute(db.insert(Course), courses)
+        db.session.execute(db.insert(Student), [{
+            'id': i + 1, 'first_name': f'Student{i}', 'fathers_name': 'Benchmark', 'phone': f'05{i:08d}',
+            'date_of_birth': datetime(2010, 1, 1).date()} for i in range(students_count)])
+        enrollments, payments = [], []
+        for student_id in range(1, students_count + 1):
+            for k in range(3):
+                course = courses[(student_id * 7 + k * 101) % courses_count]
+                enrollments.append({'course_id': course['id'], 'student_id': student_id,
+                                    'enrollment_date': course['start_date']})
+                for month in range(6):
+                    paid_on = course['start_date'] + timedelta(days=30 * month)
+                    payments.append({'student_id': student_id, 'course_id': course['id'],
+                                     'month': paid_on.strftime('%Y-%m'), 'amount': 150.0, 'payment_date': paid_on,
+                                     'payment_method': 'cash'})
+        db.session.execute(db.insert(Enrollment), enrollments)
+        db.session.execute(db.insert(Payment), payments)
+        enrolled = {}
+        for row in enrollments:
+            enrolled.setdefault(row['course_id'], []).append(row['student_id'])
+        meetings, attendances = [], []
+        for course in courses:
+            for n in range(10):
+                meeting_id = len(meetings) + 1
+                meetings.append({'id': meeting_id, 'course_id': course['id'],
+                                 'date': course['start_date'] + timedelta(days=7 * n), 'notes': ''})
+                attendances.extend({'meeting_id': meeting_id, 'student_id': student_id, 'present': student_id % 3 > 0}
+                                   for student_id in enrolled.get(course['id'], ()))
+        db.session.execute(db.insert(CourseMeeting), meetings)
+        db.session.execute(db.insert(Attendance), attendances)
+        db.session.commit()
+        backfill_course_sessions()
+        db.session.commit()
+        print(f"seeded {courses_count} courses, {students_count} students, {len(enrollments)} enrollments, "
+              f"{len(payments)} payments, {len(meetings)} meetings, {len(attendances)} attendance rows")
+
+        secondary = [index for table in db.metadata.sorted_tables for index in table.indexes
+                     if not index.unique and index.name != 'ix_course_sessions_date']
+        for index in secondary:
+            index.drop(db.engine)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user'] = ADMIN_USERNAME
+    course_id, student_id = courses_count // 2, students_count // 2
+    month = today.replace(day=1).strftime('%Y-%m-%d')
+    routes = [
+        f'/api/calendar/monthly?start_date={month}',
+        f'/api/calendar/range?start={today - timedelta(days=90)}&end={today}',
+        f'/course/{course_id}',
+        f'/api/courses/{course_id}/attendance-matrix',
+        f'/student/{student_id}',
+        '/api/analysis/coach-income?period=year',
+        '/api/analysis/summary?period=month',
+        '/api/payments/export?period=month',
+    ]
+
+    def timings():
+        result = {}
+        for url in routes:
+            samples = []
+            for _ in range(repeats):
+                calendar_cache.clear()
+                _version_snapshots.clear()
+                started = time.perf_counter()
+                status = client.get(url).status_code
+                samples.append((time.perf_counter() - started) * 1000)
+            result[url] = (sorted(samples)[len(samples) // 2], status)
+        return result
+
+    before = timings()
+    with app.app_context():
+        for index in secondary:
+            index.create(db.engine)
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+    after = timings()
+
+    print(f"{'route':<60} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for url in routes:
+        (old_ms, status), (new_ms, _) = before[url], after[url]
+        print(f"{url[:60]:<60} {old_ms:10.1f} {new_ms:10.1f} {old_ms / new_ms:7.1f}x" + ('' if status == 200 else f"  [{status}]"))
+    with app.app_context():
+        db.drop_all()
+    return True
+
+
+def benchmark_sqlite(writers=8, readers=4, seconds=5):
+    """
+    Front-desk style contention on a throwaway SQLite file, with SQLite's defaults and then with SQLITE_PRAGMAS.
+    Writer threads each commit a payment plus the shared data_versions bump; reader threads run the course
+    income aggregate. Uses its own files in the instance folder, so the configured database is never touched.
+    """
+    import shutil
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import OperationalError
+
+    workdir = tempfile.mkdtemp(prefix='sqlite-benchmark-', dir=app.instance_path)
+    print(f"{writers} writers, {readers} readers, {seconds} s per mode")
+    print(f"{'mode':<8} {'commits/s':>10} {'p95 commit ms':>14} {'reads/s':>8} {'locked errors':>14}")
+    try:
+        for mode in ('default', 'tuned'):
+            engine = create_engine(f"sqlite:///{os.path.join(workdir, f'{mode}.db')}",
+                                   pool_size=writers + readers, max_overflow=0)
+            if mode == 'tuned':
+                event.listen(engine, 'connect', tune_sqlite_connection)
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(db.insert(Course), [{
+                    'id': i, 'name': f'Course {i}', 'teacher': 'Coach', 'start_date': datetime(2025, 1, 1).date(),
+                    'end_date': datetime(2025, 6, 1).date(), 'time': '17:00', 'sessions_count': 40,
+                    'sessions_per_week': 2, 'weekdays': '0,3'} for i in range(1, 21)])
+                connection.execute(db.insert(Student), [{
+                    'id': i, 'first_name': f'Student{i}', 'fathers_name': 'Benchmark', 'phone': f'05{i:08d}',
+                    'date_of_birth': datetime(2010, 1, 1).date()} for i in range(1, 201)])
+                connection.execute(db.insert(DataVersion).values(scope=SCHEDULE_SCOPE, version=0))
+            deadline = time.perf_counter() + seconds
+
+            def write(n):
+                latencies, errors = [], 0
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        with engine.begin() as connection:
+                            connection.execute(db.insert(Payment).values(
+                                student_id=1 + (n * 37 + len(latencies)) % 200, course_id=1 + n % 20,
+                                month='2025-01', amount=150.0, payment_date=datetime(2025, 1, 5).date()))
+                            connection.execute(db.update(DataVersion).where(DataVersion.scope == SCHEDULE_SCOPE)
+                                               .values(version=DataVersion.version + 1))
+                        latencies.append((time.perf_counter() - started) * 1000)
+                    except OperationalError:
+                        errors += 1
+                return latencies, errors
+
+            def read(n):
+                count, errors = 0, 0
+                while time.perf_counter() < deadline:
+                    try:
+                        with engine.connect() as connection:
+                            connection.execute(db.select(Payment.course_id, db.func.sum(Payment.amount))
+                                               .group_by(Payment.course_id)).all()
+                        count += 1
+                    except OperationalError:
+                        errors += 1
+                return count, errors
+
+            with ThreadPoolExecutor(writers + readers) as pool:
+                write_results = [pool.submit(write, n) for n in range(writers)]
+                read_results = [pool.submit(read, n) for n in range(readers)]
+                write_results = [future.result() for future in write_results]
+                read_results = [future.result() for future in read_results]
+            engine.dispose()
+            latencies = sorted(ms for result, _ in write_results for ms in result)
+            errors = sum(e for _, e in write_results) + sum(e for _, e in read_results)
+            p95 = f"{latencies[int(len(latencies) * 0.95)]:14.1f}" if latencies else f"{'-':>14}"
+            print(f"{mode:<8} {len(latencies) / seconds:10.1f} {p95} "
+                  f"{sum(count for count, _ in read_results) / seconds:8.1f} {errors:14}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return True
+
+
+def load_test(duration=10, clients=16, invoice_clients=2, upstream_delay=0.3, students_count=300,
+              courses_count=20):
+    """
+    Serve a throwaway SQLite database with gunicorn under several workers x threads profiles and drive the read
+    endpoints from `clients` keep-alive client threads for `duration` seconds each. Meanwhile `invoice_clients`
+    of them keep creating Green Invoice documents against a local stub that answers each call after
+    `upstream_delay` seconds. The 1x1 row is the old single sync worker, where every invoice stalls the whole
+    site; read throughput should grow with threads, and with workers up to the machine's cores.
+    """
+    import shutil
+    import socket
+    import subprocess
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class SlowGreenInvoice(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(upstream_delay)
+            body = json.dumps({'token': 'load-test', 'id': 'doc', 'url': 'https://example.invalid/doc.pdf'}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), SlowGreenInvoice)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix='nest-loadtest-')
+    base_env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'loadtest.db')}",
+                    PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'metrics'),
+                    GI_API_BASE=f'http://127.0.0.1:{upstream.server_address[1]}', GI_CLIENT_ID='load-test',
+                    GI_CLIENT_SECRET='load-test')
+    base_env.pop('DB_POOL_SIZE', None)
+    cores = os.cpu_count() or 1
+    profiles = [(1, 1), (1, 4)] + [(workers, 4) for workers in sorted({2, cores, 2 * cores}) if workers > 1]
+
+    def start_server(workers, threads):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        env = dict(base_env, GUNICORN_WORKERS=str(workers), GUNICORN_THREADS=str(threads))
+        args = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', 'app:app']
+        if threads == 1:
+            args[3:3] = ['--worker-class', 'sync']
+        server = subprocess.Popen(args, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base_url = f'http://127.0.0.1:{port}'
+        for _ in range(100):
+            try:
+                requests.get(f'{base_url}/api/courses', timeout=1)
+                return server, base_url
+            except requests.RequestException:
+                time.sleep(0.2)
+        server.terminate()
+        raise RuntimeError('gunicorn did not start')
+
+    def seed(base_url):
+        http = requests.Session()
+        monday = datetime.now().date() - timedelta(days=datetime.now().weekday() + 28)
+        course_ids = [http.post(f'{base_url}/api/courses', json={
+            'name': f'Course {i}', 'teacher': f'Coach {i % 8}', 'start_date': monday.strftime('%Y-%m-%d'),
+            'time': f'{8 + i % 12:02d}:00', 'sessions_count': 24, 'weekdays': '0,3', 'allow_conflicts': True,
+        }).json()['id'] for i in range(courses_count)]
+        for i in range(students_count):
+            student_id = http.post(f'{base_url}/api/students', json={
+                'first_name': f'Student{i}', 'fathers_name': 'Load', 'phone': f'05{i:08d}',
+                'date_of_birth': '2012-01-01'}).json()['id']
+            course_id = course_ids[i % courses_count]
+            http.post(f'{base_url}/api/enrollments', json={'course_id': course_id, 'student_id': student_id})
+            http.post(f'{base_url}/api/payments', json={'student_id': student_id, 'course_id': course_id,
+                                                        'month': monday.strftime('%Y-%m'), 'amount': 150})
+        return course_ids
+
+    week_start = (datetime.now().date() - timedelta(days=datetime.now().weekday())).strftime('%Y-%m-%d')
+    urls = ['/api/courses', '/api/students?limit=50', f'/api/calendar/weekly?start_date={week_start}',
+            '/api/students/search?q=student1', '/api/payments', '/api/analysis/summary']
+
+    def drive(base_url, seconds):
+        def client(n):
+            latencies, errors = [], 0
+            deadline = time.perf_counter() + seconds
+            with requests.Session() as http:
+                i = 0
+                while time.perf_counter() < deadline:
+                    url = urls[i % len(urls)]
+                    i += 1
+                    started = time.perf_counter()
+                    try:
+                        if n < invoice_clients:
+                            ok = http.post(f'{base_url}/api/green-invoice/{payment_id}', timeout=30).ok
+                            invoices.append(ok)
+                            continue
+                        ok = http.get(base_url + url, timeout=30).status_code == 200
+                    except requests.RequestException:
+                        ok = False
+                    if ok:
+                        latencies.append((time.perf_counter() - started) * 1000)
+                    else:
+                        errors += 1
+            return latencies, errors
+
+        with ThreadPoolExecutor(clients) as pool:
+            results = list(pool.map(client, range(clients)))
+        latencies = sorted(ms for client_latencies, _ in results for ms in client_latencies)
+        return latencies, sum(errors for _, errors in results)
+
+    print(f"{cores} cores, {clients} clients ({invoice_clients} creating invoices, "
+          f"{upstream_delay * 1000:.0f} ms per upstream call), {duration} s per profile")
+    print(f"{'workers x threads':<18} {'reads/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7} {'invoices':>9}")
+    try:
+        for n, (workers, threads) in enumerate(profiles):
+            server, base_url = start_server(workers, threads)
+            try:
+                if n == 0:
+                    course_ids = seed(base_url)
+                    urls.append(f'/api/courses/{course_ids[0]}/students')
+                    payment_id = requests.get(f'{base_url}/api/payments').json()[0]['id']
+                invoices = []
+                drive(base_url, 2)  # warm up every worker's caches and search index
+                invoices = []
+                latencies, errors = drive(base_url, duration)
+            finally:
+                server.terminate()
+                server.wait()
+            if not latencies:
+                print(f"{workers:>2} x {threads:<13} {'-':>8} {'-':>8} {'-':>8} {errors:7} {sum(invoices):9}")
+                continue
+            print(f"{workers:>2} x {threads:<13} {len(latencies) / duration:8.1f} "
+                  f"{latencies[len(latencies) // 2]:8.1f} {latencies[int(len(latencies) * 0.95)]:8.1f} {errors:7} "
+                  f"{sum(invoices):9}")
+    finally:
+        upstream.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return True
 
+
+# `python app.py test` is handled after the test case is defined, at the end of the file
+if __name__ == '__main__' and 'test' not in sys.argv[1:]:
     if '--reset-db' in sys.argv:
         # Reset database completely
         with app.app_context():
@@ -1707,6 +4654,7 @@ if __name__ == '__main__':
                         weeks=(c['sessions_count'] // c['sessions_per_week'])), color=c['color']
                 ))
             db.session.commit()
+            backfill_course_sessions()
             # Add Arabic students
             students = [
                 {'first_name': 'محمد', 'fathers_name': 'سعيد', 'phone': '0501111111', 'date_of_birth': '2010-01-01',
@@ -1755,10 +4703,36 @@ if __name__ == '__main__':
             db.session.commit()
             logger.info('Test database populated with Arabic data and payments.')
         sys.exit(0)
+    elif '--rebuild-revenue-rollup' in sys.argv:
+        with app.app_context():
+            rebuild_revenue_rollup()
+        sys.exit(0)
+    elif '--import' in sys.argv:
+        # python app.py --import students|enrollments|payments <file.xlsx|file.csv> [--dry-run]
+        entity, path = sys.argv[sys.argv.index('--import') + 1:sys.argv.index('--import') + 3]
+        with app.app_context(), open(path, 'rb') as import_file:
+            run_migrations()
+            header, rows = read_import_rows(import_file, path)
+            report = import_rows(entity, header, rows, dry_run='--dry-run' in sys.argv)
+        for error in report['errors']:
+            print(f"row {error['row']}: {error['error']}")
+        print(f"{report['rows']} rows: {report['imported']} imported, {report['skipped']} skipped, "
+              f"{report['error_count']} errors" + (' (dry run)' if report['dry_run'] else ''))
+        sys.exit(1 if report['error_count'] else 0)
+    elif '--benchmark-calendar' in sys.argv:
+        sys.exit(0 if benchmark_calendar() else 1)
+    elif '--benchmark-search' in sys.argv:
+        sys.exit(0 if benchmark_search() else 1)
+    elif '--benchmark-indexes' in sys.argv:
+        sys.exit(0 if benchmark_indexes() else 1)
+    elif '--benchmark-sqlite' in sys.argv:
+        sys.exit(0 if benchmark_sqlite() else 1)
+    elif '--load-test' in sys.argv:
+        sys.exit(0 if load_test() else 1)
 
     # Initialize database
     with app.app_context():
-        migrate_existing_data()
+        run_migrations()
 
     # Only run the development server if not using gunicorn
     if not os.getenv('GUNICORN_CMD_ARGS'):
@@ -1774,8 +4748,19 @@ import unittest
 class APITestCase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        with app.app_context():
+            url = db.engine.url
+        # The engine is created at import, so only conftest.py or `python app.py test` can choose the database;
+        # refuse to drop tables anywhere but a throwaway one
+        if url.database not in (None, '', ':memory:') and not os.getenv('TEST_DATABASE_URL'):
+            raise RuntimeError(f"Tests would run against {url.render_as_string(hide_password=True)}; run them "
+                               "with pytest (conftest.py) or `python app.py test`, or set TEST_DATABASE_URL")
         self.app = app.test_client()
+        calendar_cache.clear()
+        _version_snapshots.clear()
+        ics_cache.clear()
+        coach_schedule_index.version = None
+        student_search_index.version = None
         with app.app_context():
             db.create_all()
 
@@ -1783,6 +4768,15 @@ class APITestCase(unittest.TestCase):
         with app.app_context():
             db.drop_all()
 
+    def assertQueryBudget(self, url, budget):
+        """GET url and fail if it runs more than `budget` SQL statements; returns the response."""
+        with record_queries() as stats:
+            resp = self.app.get(url)
+        self.assertLess(resp.status_code, 400, url)
+        if stats.count > budget:
+            self.fail(f"{url} ran {stats.count} queries, budget is {budget}:\n" + '\n'.join(stats.statements))
+        return resp
+
     def test_create_student_valid(self):
         resp = self.app.post('/api/students', json={
             'first_name': 'Ali',
@@ -1848,6 +4842,14 @@ class APITestCase(unittest.TestCase):
             'course_id': course_id
         })
         self.assertEqual(resp.status_code, 201)
+        # Unknown ids are reported as such, not as a duplicate enrollment
+        resp = self.app.post('/api/enrollments', json={'student_id': 12345, 'course_id': course_id})
+        self.assertEqual((resp.status_code, resp.get_json()), (404, {'error': 'Student not found'}))
+        self.assertEqual(self.app.post('/api/enrollments', json={'student_id': student_id, 'course_id': 999}
+                                       ).status_code, 404)
+        self.assertEqual(self.app.post('/api/enrollments').status_code, 400)
+        self.assertEqual(self.app.post('/api/enrollments', json={'student_id': student_id, 'course_id': course_id}
+                                       ).status_code, 409)
 
     def test_payment_and_invoice(self):
         self.test_enroll_student()
@@ -1891,30 +4893,778 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(resp2.status_code, 200)
         self.assertIn('Attendance saved', resp2.get_json()['message'])
 
+        # Meetings validate their attendance like the attendance endpoints: boolean present, known students
+        url = f'/api/courses/{course_id}/meetings'
+        marked = self.app.post(url, json={'date': '2025-01-12', 'attendance': [
+            {'student_id': student_id, 'present': True}]})
+        self.assertEqual(marked.status_code, 201)
+        meetings = {m['id']: m for m in self.app.get(url).get_json()}
+        self.assertEqual([a['present'] for a in meetings[marked.get_json()['id']]['attendance']], [True])
+        for body in ({'date': '2025-01-13', 'attendance': [{'student_id': student_id, 'present': 'false'}]},
+                     {'date': '2025-01-13', 'attendance': [{'present': True}]},
+                     {'date': '2025-01-13', 'attendance': [9999]},
+                     {'attendance': []}, {'date': '13/01/2025'}, None):
+            with self.subTest(body=body):
+                self.assertEqual(self.app.post(url, json=body).status_code, 400)
+        self.assertEqual(len(self.app.get(url).get_json()), 2)
+
+    def create_course_with_activity(self, students=4):
+        """A course with enrolled, paying students and three recorded meetings; returns (course_id, student_ids)."""
+        course_id = self.app.post('/api/courses', json={
+            'name': 'Judo', 'teacher': 'Coach Sam', 'start_date': '2025-01-05', 'time': '10:00',
+            'sessions_count': 8, 'weekdays': '0,2'}).get_json()['id']
+        student_ids = []
+        for i in range(students):
+            student_ids.append(self.app.post('/api/students', json={
+                'first_name': f'Student{i}', 'fathers_name': 'Hassan', 'phone': f'052000000{i}',
+                'date_of_birth': '2010-01-01'}).get_json()['id'])
+            self.app.post('/api/enrollments', json={'course_id': course_id, 'student_id': student_ids[-1]})
+            self.app.post('/api/payments', json={
+                'student_id': student_ids[-1], 'course_id': course_id, 'month': '2025-01', 'amount': 100})
+        for day in ('2025-01-05', '2025-01-07', '2025-01-12'):
+            self.app.post(f'/api/courses/{course_id}/meetings', json={'date': day, 'attendance': student_ids[:2]})
+        return course_id, student_ids
+
+    def test_listings_use_fixed_statement_counts(self):
+        course_id, student_ids = self.create_course_with_activity()
+
+        meetings = self.assertQueryBudget(f'/api/courses/{course_id}/meetings', 2).get_json()
+        self.assertEqual([m['date'] for m in meetings], ['2025-01-12', '2025-01-07', '2025-01-05'])
+        self.assertEqual([a['student_name'] for a in meetings[0]['attendance']],
+                         [f'Student{i} Hassan' for i in range(4)])
+        self.assertEqual([a['present'] for a in meetings[0]['attendance']], [True, True, False, False])
+
+        payments = self.assertQueryBudget('/api/payments', 1).get_json()
+        self.assertEqual(payments[0]['course_name'], 'Judo')
+        self.assertQueryBudget(f'/api/courses/{course_id}/students', 1)
+        self.assertQueryBudget(f'/api/students/{student_ids[0]}/courses', 1)
+
+        with self.app.session_transaction() as sess:
+            sess['user'] = 'admin'
+        self.assertQueryBudget(f'/course/{course_id}', 4)
+        self.assertQueryBudget(f'/student/{student_ids[0]}', 3)
+
+    def test_schema_migrations_upgrade_legacy_database(self):
+        course_id, student_ids = self.create_course_with_activity(students=1)
+        with app.app_context():
+            # A database from before versioned migrations: no version table, missing tables and indexes
+            db.session.execute(text('DROP INDEX uq_course_enrollments_course_student'))
+            db.session.add(Enrollment(course_id=course_id, student_id=student_ids[0]))  # enrolled twice
+            db.session.execute(text('DROP INDEX ix_payments_month'))
+            db.session.execute(text('DROP TABLE data_versions'))
+            db.session.execute(text('DROP TABLE schema_migrations'))
+            db.session.commit()
+            self.assertEqual(get_schema_version(), 0)
+
+            self.assertTrue(run_migrations())
+            self.assertEqual(get_schema_version(), SCHEMA_VERSION)
+            inspector = db.inspect(db.engine)
+            self.assertIn('data_versions', inspector.get_table_names())
+            self.assertIn('ix_payments_month', {ix['name'] for ix in inspector.get_indexes('payments')})
+            self.assertIn('uq_course_enrollments_course_student',
+                          {ix['name'] for ix in inspector.get_indexes('course_enrollments')})
+            self.assertEqual(Enrollment.query.count(), 1)
+
+            with record_queries() as stats:
+                self.assertTrue(run_migrations())
+            self.assertEqual(stats.count, 1)
+
+    def test_revenue_rollup_follows_payment_writes(self):
+        course_id, student_ids = self.create_course_with_activity()
+        payment = self.app.post('/api/payments', json={'student_id': student_ids[0], 'course_id': course_id,
+                                                       'month': '2025-02', 'amount': 50, 'payment_method': 'check'})
+        self.app.post(f'/api/students/{student_ids[1]}/payments', json={
+            'course_id': course_id, 'month': '2025-02', 'amount': 30})
+        self.app.delete(f"/api/payments/{payment.get_json()['id']}")
+        self.app.delete(f'/api/students/{student_ids[2]}')
+
+        dashboard = self.app.get('/api/analysis/dashboard?period=all').get_json()
+        self.assertEqual(dashboard['summary'], {'total_revenue': 330.0, 'total_payments': 4, 'average_payment': 82.5})
+        self.assertEqual(dashboard['coach_income'], [
+            {'coach_id': None, 'teacher': 'Coach Sam', 'total_income': 330.0, 'payment_count': 4}])
+        self.assertEqual(dashboard['course_income'], [{'course_name': 'Judo', 'total_income': 330.0, 'payment_count': 4}])
+        self.assertEqual(self.app.get('/api/analysis/summary?period=all').get_json(), dashboard['summary'])
 
-if __name__ == '__main__':
-    import sys
+        with app.app_context():
+            incremental = {(r.month, r.course_id, r.payment_method): (r.total_amount, r.payment_count)
+                           for r in RevenueRollup.query if r.payment_count}
+            rebuild_revenue_rollup()
+            rebuilt = {(r.month, r.course_id, r.payment_method): (r.total_amount, r.payment_count)
+                       for r in RevenueRollup.query}
+        self.assertEqual(incremental, rebuilt)
+
+        self.app.delete(f'/api/courses/{course_id}')
+        self.assertEqual(self.app.get('/api/analysis/coach-income').get_json(), [])
+
+    def test_courses_link_to_coaches(self):
+        coach_id = self.app.post('/api/coaches', json={
+            'first_name': 'Sam', 'last_name': 'Cohen', 'phone': '0541111111'}).get_json()['id']
+        course = {'name': 'Judo', 'start_date': '2025-01-05', 'time': '10:00', 'sessions_count': 8,
+                  'weekdays': '0,2'}
+        linked = self.app.post('/api/courses', json=dict(course, coach_id=coach_id)).get_json()
+        self.assertEqual((linked['coach_id'], linked['teacher']), (coach_id, 'Sam Cohen'))
+        by_name = self.app.post('/api/courses', json=dict(course, name='Boxing', teacher='Sam Cohen',
+                                                          time='12:00')).get_json()
+        self.assertEqual(by_name['coach_id'], coach_id)
+        self.assertEqual(self.app.post('/api/courses', json=dict(course, name='Karate', coach_id=999)).status_code, 400)
+
+        # Renaming the coach keeps the courses attached and updates their teacher name
+        self.app.put(f'/api/coaches/{coach_id}', json={'last_name': 'Levi'})
+        events = self.app.get(f'/api/calendar/range?start=2025-01-05&end=2025-01-07&coach_id={coach_id}').get_json()
+        self.assertEqual({e['teacher'] for e in events}, {'Sam Levi'})
+        self.assertEqual(len(events), 4)
+        self.assertIn(b'SUMMARY:Judo', self.app.get(f'/calendar/coach/{coach_id}.ics').data)
+
+        # Name matching ignores case and spacing
+        spaced = self.app.post('/api/courses', json=dict(course, name='Wrestling', teacher=' sam  LEVI ',
+                                                         time='14:00')).get_json()
+        self.assertEqual((spaced['coach_id'], spaced['teacher']), (coach_id, 'Sam Levi'))
+        self.assertEqual(self.app.put(f"/api/courses/{spaced['id']}", json={'coach_id': 'abc'}).get_json(),
+                         {'error': 'coach_id must be an integer'})
+
+        with app.app_context():
+            Course.query.update({Course.coach_id: None, Course.teacher: 'sam   levi'})
+            db.session.commit()
+            _migrate_course_coach_id()
+            self.assertEqual({(c.coach_id, c.teacher) for c in Course.query}, {(coach_id, 'Sam Levi')})
+            # Courses linked before the migration also took the coach's name get it from step 14
+            Course.query.update({Course.teacher: 'SAM LEVI'})
+            db.session.commit()
+            _migrate_course_teacher_names()
+            self.assertEqual({c.teacher for c in Course.query}, {'Sam Levi'})
+
+        # Saving an edit form, which sends the teacher name back, keeps the link
+        edit = {'name': 'Judo', 'teacher': 'sam levi', 'time': '10:00', 'sessions_count': 8, 'weekdays': '0,2',
+                'color': '#FF0000'}
+        self.assertEqual(self.app.put(f"/api/courses/{linked['id']}", json=edit).get_json()['coach_id'], coach_id)
+        # A second coach of the same name doesn't unlink courses already linked,
+        self.app.post('/api/coaches', json={'first_name': 'Sam', 'last_name': 'Levi', 'phone': '0542222222'})
+        self.assertEqual(self.app.put(f"/api/courses/{linked['id']}", json=edit).get_json()['coach_id'], coach_id)
+        # but make a typed name ambiguous, so a new course by that name links neither
+        self.assertIsNone(self.app.post('/api/courses', json=dict(course, name='Sumo', teacher='Sam Levi',
+                                                                  time='16:00')).get_json()['coach_id'])
+
+        self.app.delete(f'/api/coaches/{coach_id}')
+        self.assertEqual(self.app.get(f"/api/courses/{linked['id']}").get_json()['coach_id'], None)
+
+    def test_outstanding_balances(self):
+        course_id, student_ids = self.create_course_with_activity(students=3)  # each paid 100 for 2025-01
+        self.assertEqual(self.app.put(f'/api/courses/{course_id}', json={'monthly_fee': 150}).status_code, 200)
+        self.app.post('/api/payments', json={'student_id': student_ids[0], 'course_id': course_id,
+                                             'month': '2025-01', 'amount': 50})
+        late = self.app.post('/api/students', json={'first_name': 'Late', 'fathers_name': 'Joiner',
+                                                    'phone': '0529999999', 'date_of_birth': '2011-01-01'})
+        self.app.post('/api/enrollments', json={'course_id': course_id, 'student_id': late.get_json()['id']})
+        with app.app_context():
+            # Two students joined before the course started, one predates enrollment dates, one joined in February
+            Enrollment.query.filter(Enrollment.student_id.in_(student_ids[:2])).update(
+                {Enrollment.enrollment_date: date(2025, 1, 1)}, synchronize_session=False)
+            Enrollment.query.filter_by(student_id=student_ids[2]).update({Enrollment.enrollment_date: None})
+            Enrollment.query.filter_by(student_id=late.get_json()['id']).update(
+                {Enrollment.enrollment_date: date(2025, 2, 10)})
+            db.session.commit()
+
+        january = self.app.get('/api/billing/outstanding?month=2025-01').get_json()
+        self.assertEqual([(i['student_name'], i['status'], i['balance']) for i in january['items']], [
+            ('Student1 Hassan', 'partial', 50.0), ('Student2 Hassan', 'partial', 50.0)])
+        self.assertEqual(january['totals'], {'count': 2, 'due': 300.0, 'paid': 200.0, 'balance': 100.0})
+        paid = self.app.get('/api/billing/outstanding?month=2025-01&status=paid').get_json()['items']
+        self.assertEqual([(i['student_id'], i['paid'], i['payment_count']) for i in paid], [(student_ids[0], 150.0, 2)])
+        # The course ends 2025-02-02, so February is owed in full, by the late joiner too, and March not at all
+        february = self.app.get('/api/billing/outstanding?month=2025-02').get_json()['items']
+        self.assertEqual([i['student_name'] for i in february],
+                         ['Late Joiner', 'Student0 Hassan', 'Student1 Hassan', 'Student2 Hassan'])
+        self.assertEqual(self.app.get('/api/billing/outstanding?month=2025-03').get_json()['items'], [])
+
+        response = self.app.get('/api/billing/outstanding?month=2025-01&format=csv')
+        lines = response.get_data(as_text=True).lstrip('\ufeff').splitlines()
+        self.assertEqual(lines[0], 'Student,Phone,Course,Coach,Month,Due,Paid,Balance,Status')
+        self.assertEqual(lines[1], 'Student1 Hassan,0520000001,Judo,Coach Sam,2025-01,150.0,100.0,50.0,partial')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.app.get('/api/billing/outstanding?month=January').status_code, 400)
+
+    def test_payments_excel_export(self):
+        course_id, student_ids = self.create_course_with_activity(students=3)
+        self.app.post('/api/payments', json={'student_id': student_ids[0], 'course_id': course_id,
+                                             'month': '2025-02', 'amount': 50, 'payment_method': 'check'})
+        response = self.app.get('/api/payments/export?period=all')
+        self.assertEqual(response.status_code, 200)
+        sheet = load_workbook(BytesIO(response.get_data())).active
+        rows = [[cell.value for cell in row] for row in sheet.iter_rows()]
+        self.assertEqual(rows[3][:3], ['Invoice Number', 'Payment Date', 'Student Name'])
+        self.assertEqual(rows[4][2:], ['Student0 Hassan', 'Judo', 'Coach Sam', '2025-01', 100, 'cash'])
+        self.assertEqual(rows[8][0::6], ['TOTAL', 350])
+        self.assertEqual(rows[10][0], 'Payment Method Breakdown')
+        self.assertEqual(rows[11:], [['cash', 3, 300, '85.7%', None, None, None, None],
+                                     ['check', 1, 50, '14.3%', None, None, None, None]])
+        self.assertEqual({str(r) for r in sheet.merged_cells.ranges}, {'A1:H1', 'A2:H2', 'A3:H3', 'A11:H11'})
+        self.assertGreater(sheet.column_dimensions['C'].width, len('Student0 Hassan'))
+        self.assertEqual(sheet['A4'].font.b, True)
+        with app.app_context():
+            Payment.query.delete()
+            db.session.commit()
+        self.assertEqual(self.app.get('/api/payments/export?period=month').status_code, 404)
+
+    def test_export_jobs(self):
+        export_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(export_dir.cleanup)
+        self.addCleanup(app.config.__setitem__, 'EXPORT_DIR', app.config['EXPORT_DIR'])
+        app.config['EXPORT_DIR'] = export_dir.name
+        course_id, student_ids = self.create_course_with_activity(students=2)
+        created = self.app.post('/api/export-jobs', json={'period': 'all'})
+        self.assertEqual(created.status_code, 202)
+        job = created.get_json()
+        self.assertEqual((job['status'], job['rows_done'], job['rows_total'], job['progress']), ('done', 2, 2, 1.0))
+        sheet = load_workbook(BytesIO(self.app.get(job['download_url']).get_data())).active
+        self.assertEqual([sheet['C5'].value, sheet['C6'].value], ['Student0 Hassan', 'Student1 Hassan'])
+
+        # Nothing changed, so the finished job is handed out again
+        again = self.app.post('/api/export-jobs', json={'period': 'all'})
+        self.assertEqual((again.status_code, again.get_json()['id']), (200, job['id']))
+        self.app.post('/api/payments', json={'student_id': student_ids[0], 'course_id': course_id,
+                                             'month': '2025-02', 'amount': 50})
+        newer = self.app.post('/api/export-jobs', json={'period': 'all'})
+        self.assertEqual(newer.status_code, 202)
+        self.assertEqual(newer.get_json()['rows_total'], 3)
+
+        # Polling only reads; a job whose worker stopped reporting progress shows as failed
+        with app.app_context():
+            ExportJob.query.filter_by(id=newer.get_json()['id']).update({
+                ExportJob.status: 'running',
+                ExportJob.updated_at: datetime.utcnow() - timedelta(seconds=EXPORT_JOB_STALE_SECONDS + 1)})
+            db.session.commit()
+        with record_queries() as stats:
+            stale = self.app.get(newer.get_json()['status_url']).get_json()
+        self.assertEqual((stale['status'], stale['error']), ('failed', 'The export was interrupted'))
+        self.assertEqual([sql for sql in stats.statements if not sql.lstrip().upper().startswith('SELECT')], [])
+
+        with app.app_context():
+            ExportJob.query.update({ExportJob.expires_at: datetime.utcnow() - timedelta(seconds=1)})
+            db.session.commit()
+        self.assertEqual(self.app.get(job['status_url']).status_code, 404)
+        self.assertEqual(self.app.get(job['download_url']).status_code, 404)
+        # Queueing the next job deletes expired jobs and their files
+        self.assertEqual(self.app.post('/api/export-jobs', json={'period': 'month'}).status_code, 202)
+        self.assertFalse(os.path.exists(export_job_path(job['id'])))
+        with app.app_context():
+            live_jobs = {job_id for job_id, in db.session.query(ExportJob.id)}
+        self.assertLessEqual(set(os.listdir(export_dir.name)), live_jobs)
+        self.assertEqual(self.app.post('/api/export-jobs', json={'period': 'decade'}).status_code, 400)
+
+    def test_raw_exports(self):
+        course_id, student_ids = self.create_course_with_activity(students=2)
+        response = self.app.get('/api/export/payments.csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.get_data(as_text=True).lstrip('\ufeff').splitlines()
+        self.assertEqual(lines[0], 'id,payment_date,month,amount,payment_method,student_id,first_name,fathers_name,'
+                                   'course_id,course_name,teacher')
+        self.assertTrue(lines[1].endswith(f',2025-01,100.0,cash,{student_ids[0]},Student0,Hassan,{course_id},Judo,Coach Sam'))
+        self.assertEqual(len(lines), 3)
+
+        rows = [json.loads(line) for line in self.app.get('/api/export/attendance.ndjson?start=2025-01-06&end=2025-01-12')
+                .get_data(as_text=True).splitlines()]
+        self.assertEqual([(row['date'], row['student_id'], row['present']) for row in rows], [
+            ('2025-01-07', student_ids[0], True), ('2025-01-07', student_ids[1], True),
+            ('2025-01-12', student_ids[0], True), ('2025-01-12', student_ids[1], True)])
+        self.assertEqual(json.loads(self.app.get('/api/export/students.ndjson').get_data(as_text=True).splitlines()[0]),
+                         {'id': student_ids[0], 'first_name': 'Student0', 'fathers_name': 'Hassan',
+                          'phone': '0520000000', 'national_id': None, 'date_of_birth': '2010-01-01'})
+        self.assertEqual(self.app.get('/api/export/payments.csv?period=year&start=2030-01-01')
+                         .get_data(as_text=True).lstrip('\ufeff').count('\n'), 1)
+        self.assertEqual(self.app.get('/api/export/students.csv?period=month').status_code, 400)
+        self.assertEqual(self.app.get('/api/export/payments.csv?start=01/01/2025').status_code, 400)
+        self.assertEqual(self.app.get('/api/export/courses.csv').status_code, 404)
+
+    def test_bulk_import(self):
+        course_id, student_ids = self.create_course_with_activity(students=1)
+
+        def upload(entity, filename, content, query=''):
+            return self.app.post(f'/api/import/{entity}{query}', content_type='multipart/form-data',
+                                 data={'file': (BytesIO(content), filename)})
+
+        students_csv = ('First Name,Fathers Name,Phone,Date of Birth,National ID\n'
+                        'Rami,Saleh,0521111111,2012-03-04,\n'
+                        'Dana,Levi,0520000000,2013-05-06,\n'  # Student0's phone
+                        'Noa,Levi,0521111111,13/05/2013,555\n')
+        rejected = upload('students', 'students.csv', students_csv.encode())
+        self.assertEqual(rejected.status_code, 422)
+        self.assertEqual(rejected.get_json()['errors'], [
+            {'row': 3, 'error': 'phone 0520000000 already belongs to a student'},
+            {'row': 4, 'error': "date_of_birth '13/05/2013' is invalid; phone 0521111111 is also on row 2"}])
+        fixed = students_csv.replace('0520000000', '0522222222').replace('0521111111,13/05/2013', '0523333333,2013-05-13')
+        self.assertEqual(upload('students', 'students.csv', fixed.encode(), '?dry_run=1').get_json()['imported'], 0)
+        report = upload('students', 'students.csv', fixed.encode()).get_json()
+        self.assertEqual((report['rows'], report['imported'], report['error_count']), (3, 3, 0))
+        self.assertEqual([s['first_name'] for s in self.app.get('/api/students/search?q=Levi').get_json()],
+                         ['Dana', 'Noa'])
+
+        workbook = Workbook()
+        workbook.active.append(['phone', 'course'])
+        for phone in ('0522222222', '0523333333', '0520000000', '0523333333'):
+            workbook.active.append([phone, 'judo'])
+        enrollments = BytesIO()
+        workbook.save(enrollments)
+        report = upload('enrollments', 'enrollments.xlsx', enrollments.getvalue()).get_json()
+        self.assertEqual((report['imported'], report['skipped']), (2, 2))  # Student0 was enrolled; Noa is listed twice
+
+        payments = upload('payments', 'payments.csv', (
+            'student_id,course_id,month,amount,payment_method,payment_date\n'
+            f'{student_ids[0]},{course_id},2025-02,100,Transfer,2025-02-03\n'
+            f'{student_ids[0]},{course_id},2025-03,80,,2025-03-03\n').encode())
+        self.assertEqual(payments.get_json()['imported'], 2)
+        self.assertEqual(self.app.get('/api/analysis/summary?period=all').get_json()['total_revenue'], 280.0)
+        self.assertEqual(upload('payments', 'payments.csv', b'student_id,month\n1,2025-01\n').get_json(),
+                         {'error': 'Missing columns: course_id or course, amount'})
+        self.assertEqual(upload('students', 'students.txt', b'x').status_code, 400)
+
+    def test_bulk_enrollment(self):
+        course_id, student_ids = self.create_course_with_activity(students=1)
+        other_id = self.app.post('/api/courses', json={
+            'name': 'Swim', 'teacher': 'Coach Sam', 'start_date': '2025-01-06', 'time': '16:00',
+            'sessions_count': 8, 'weekdays': '1'}).get_json()['id']
+        for i in (1, 2):
+            student_ids.append(self.app.post('/api/students', json={
+                'first_name': f'Team{i}', 'fathers_name': 'Levi', 'phone': f'05300000{i}',
+                'date_of_birth': '2011-01-01'}).get_json()['id'])
+
+        body = {'course_ids': [course_id, other_id], 'student_ids': student_ids}
+        with record_queries() as stats:
+            response = self.app.post('/api/enrollments/bulk', json=body)
+        self.assertEqual(response.status_code, 201)
+        created = response.get_json()
+        self.assertEqual(created['skipped'], 1)  # student 0 was already in the first course
+        self.assertEqual(sorted((e['course_id'], e['student_id']) for e in created['created']),
+                         sorted((c, s) for c in (course_id, other_id) for s in student_ids)[1:])
+        self.assertEqual(sum('INSERT INTO course_enrollments' in sql for sql in stats.statements), 1)
+        again = self.app.post('/api/enrollments/bulk', json=body)
+        self.assertEqual((again.status_code, again.get_json()), (200, {'created': [], 'skipped': 6}))
+        self.assertEqual(self.app.post('/api/enrollments', json={
+            'course_id': course_id, 'student_id': student_ids[1]}).status_code, 409)
+        self.assertEqual(len(self.app.get(f'/api/courses/{course_id}/students').get_json()), 3)
+
+        removed = self.app.delete('/api/enrollments/bulk', json={'course_id': other_id, 'student_ids': student_ids[1:]})
+        self.assertEqual(removed.get_json()['removed'], sorted(e['id'] for e in created['created']
+                                                               if e['course_id'] == other_id and e['student_id'] != student_ids[0]))
+        self.assertEqual(len(self.app.get(f'/api/courses/{other_id}/students').get_json()), 1)
+        self.assertEqual(self.app.post('/api/enrollments/bulk', json={'course_id': 999, 'student_ids': [1]}).get_json(),
+                         {'error': 'Unknown course ids: 999'})
+        self.assertEqual(self.app.delete('/api/enrollments/bulk', json={'course_id': course_id}).status_code, 400)
+
+    def test_sqlite_connection_profile(self):
+        if not _sqlite_tuned:
+            self.skipTest('SQLITE_TUNING is off')
+        with app.app_context():
+            self.assertEqual(db.session.execute(text('PRAGMA foreign_keys')).scalar(), 1)
+            self.assertEqual(db.session.execute(text('PRAGMA synchronous')).scalar(), 1)  # NORMAL
+            self.assertEqual(db.session.execute(text('PRAGMA busy_timeout')).scalar(), 5000)
+            db.session.add(Enrollment(course_id=999, student_id=999))
+            with self.assertRaises(IntegrityError):
+                db.session.commit()
+            db.session.rollback()
+        with self.assertNoLogs('app', level='ERROR'):
+            run_sqlite_maintenance()
+
+    def test_bulk_attendance_upsert(self):
+        course_id, student_ids = self.create_course_with_activity(students=30)
+        meetings = self.app.get(f'/api/courses/{course_id}/meetings').get_json()
+        records = [{'meeting_id': m['id'], 'student_id': sid, 'present': sid % 2 == 0}
+                   for m in meetings for sid in student_ids]
+        with record_queries() as stats:
+            resp = self.app.post('/api/attendance/bulk', json={'records': records})
+        self.assertEqual(resp.get_json(), {'saved': 90})
+        # Two existence checks and one upsert, whatever the class size
+        self.assertEqual(stats.count, 3, stats.statements)
+
+        meeting = self.app.get(f'/api/courses/{course_id}/meetings').get_json()[0]
+        self.assertEqual(len(meeting['attendance']), 30)
+        self.assertEqual([a['present'] for a in meeting['attendance']][:4], [s % 2 == 0 for s in student_ids[:4]])
+
+        # Per-meeting saves go through the same upsert; unknown ids are rejected
+        resp = self.app.post(f"/api/meetings/{meeting['id']}/attendance",
+                             json={'attendance': [{'student_id': student_ids[0], 'present': True}]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.app.post('/api/attendance/bulk', json={'records': [
+            {'meeting_id': meeting['id'], 'student_id': 9999, 'present': True}]}).status_code, 400)
+        self.assertEqual(self.app.post('/api/meetings/9999/attendance', json={'attendance': []}).status_code, 404)
+        # present must be a JSON boolean, and a missing body is a 400 rather than a 500
+        for present in ('false', 0, None):
+            self.assertEqual(self.app.post(f"/api/meetings/{meeting['id']}/attendance", json={'attendance': [
+                {'student_id': student_ids[0], 'present': present}]}).status_code, 400)
+        self.assertEqual(self.app.post(f"/api/meetings/{meeting['id']}/attendance").status_code, 400)
+        self.assertEqual(self.app.post('/api/attendance/bulk').status_code, 400)
+        self.assertEqual(self.app.post('/api/attendance/bulk', data='records', content_type='text/plain').status_code,
+                         400)
+        with app.app_context():
+            self.assertEqual(Attendance.query.count(), 90)
+            db.session.add(Attendance(meeting_id=meeting['id'], student_id=student_ids[0], present=False))
+            with self.assertRaises(IntegrityError):
+                db.session.commit()
+
+    def test_attendance_matrix(self):
+        course_id, student_ids = self.create_course_with_activity(students=10)
+        late_id = self.app.post('/api/students', json={
+            'first_name': 'Late', 'fathers_name': 'Joiner', 'phone': '0529999999',
+            'date_of_birth': '2010-01-01'}).get_json()['id']
+        self.app.post('/api/enrollments', json={'course_id': course_id, 'student_id': late_id})
+        self.app.post(f'/api/courses/{course_id}/meetings', json={'date': '2025-01-14', 'attendance': [late_id]})
+
+        matrix = self.app.get(f'/api/courses/{course_id}/attendance-matrix').get_json()
+        names = [s['name'] for s in matrix['students']]
+        self.assertEqual(names, ['Late Joiner'] + [f'Student{i} Hassan' for i in range(10)])
+        self.assertEqual([m['date'] for m in matrix['meetings']],
+                         ['2025-01-05', '2025-01-07', '2025-01-12', '2025-01-14'])
+
+        def decode(bitset):
+            bits = int.from_bytes(base64.b64decode(bitset), 'little')
+            return [i for i in range(len(names)) if bits >> i & 1]
+
+        # Students 0 and 1 (indexes 1 and 2) attended the first three meetings; the late joiner only the last
+        self.assertEqual(decode(matrix['present'][0]), [1, 2])
+        self.assertEqual(decode(matrix['recorded'][0]), list(range(1, 11)))
+        self.assertEqual(decode(matrix['present'][3]), [0])
+        self.assertEqual(matrix['totals']['meeting_present'], [2, 2, 2, 1])
+        self.assertEqual(matrix['totals']['meeting_recorded'], [10, 10, 10, 11])
+        self.assertEqual(matrix['totals']['student_present'][:4], [1, 3, 3, 0])
+        self.assertEqual(matrix['totals']['student_recorded'][:2], [1, 4])
+        self.assertEqual(self.app.get('/api/courses/9999/attendance-matrix').status_code, 404)
+
+    # Per-endpoint statement budgets over create_course_with_activity(); an N+1 regression exceeds them
+    QUERY_BUDGETS = {
+        '/api/courses': 1,
+        '/api/students': 1,
+        '/api/coaches': 1,
+        '/api/enrollments': 1,
+        '/api/payments': 1,
+        '/api/calendar/weekly?start_date=2025-01-05': 3,
+        '/api/calendar/monthly?start_date=2025-01-05': 3,
+        '/api/calendar/range?start=2025-01-01&end=2025-03-31': 3,
+        '/api/courses/{course_id}/meetings': 2,
+        '/api/courses/{course_id}/students': 1,
+        '/api/courses/{course_id}/attendance-matrix': 1,
+        '/api/analysis/dashboard?period=all': 1,
+        '/api/billing/outstanding?month=2025-01&status=all': 1,
+    }
+
+    def test_endpoint_query_budgets(self):
+        # Doubling the data must not change any count
+        course_id, _ = self.create_course_with_activity(students=8)
+        for url, budget in self.QUERY_BUDGETS.items():
+            calendar_cache.clear()
+            _version_snapshots.clear()
+            with self.subTest(url=url):
+                self.assertQueryBudget(url.format(course_id=course_id), budget)
+
+    def test_query_timing_headers(self):
+        self.create_course_with_activity(students=1)
+        self.assertNotIn('X-DB-Queries', self.app.get('/api/payments').headers)
+        app.config['SQL_TIMING_HEADERS'] = True
+        try:
+            resp = self.app.get('/api/payments')
+        finally:
+            app.config['SQL_TIMING_HEADERS'] = False
+        self.assertEqual(resp.headers['X-DB-Queries'], '1')
+        self.assertRegex(resp.headers['Server-Timing'], r'^db;dur=[\d.]+;desc="1 queries", db-slowest;dur=[\d.]+, total;dur=')
+
+    def test_metrics_endpoint(self):
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        labels = {'endpoint': 'get_courses', 'method': 'GET'}
+        before = sample('http_request_duration_seconds_count', **labels)
+        before_404 = sample('http_requests_total', endpoint='get_course', method='GET', status='404')
+        self.app.get('/api/courses')
+        self.app.get('/api/courses/999')
+        self.assertEqual(sample('http_request_duration_seconds_count', **labels), before + 1)
+        self.assertEqual(sample('http_requests_total', endpoint='get_course', method='GET', status='404'),
+                         before_404 + 1)
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn(b'http_request_duration_seconds_bucket{endpoint="get_courses",le="0.005",method="GET"}',
+                      resp.data)
+
+    def test_calendar_classes_remaining(self):
+        # 2025-01-05 is a Sunday; the course runs Sunday and Tuesday for 8 sessions
+        resp = self.app.post('/api/courses', json={
+            'name': 'Swimming',
+            'teacher': 'Coach Sam',
+            'start_date': '2025-01-05',
+            'time': '10:00',
+            'sessions_count': 8,
+            'weekdays': '0,2'
+        })
+        self.assertEqual(resp.status_code, 201)
+        weekly = self.app.get('/api/calendar/weekly?start_date=2025-01-12').get_json()
+        self.assertEqual([e['date'] for e in weekly], ['2025-01-12', '2025-01-14'])
+        self.assertEqual([e['classes_remaining'] for e in weekly], [6, 5])
+        daily = self.app.get('/api/calendar/daily?date=2025-01-28').get_json()
+        self.assertEqual(daily[0]['classes_remaining'], 1)
+        monthly = self.app.get('/api/calendar/monthly?start_date=2025-01-15').get_json()
+        self.assertEqual(len(monthly), 8)
+        self.assertEqual(monthly[-1]['date'], '2025-01-28')
+
+    def test_calendar_range_uses_recorded_meetings(self):
+        self.test_calendar_classes_remaining()
+        course_id = self.app.get('/api/courses').get_json()[0]['id']
+        # Three meetings held in the first week, one of them a make-up on a Thursday
+        for date in ('2025-01-05', '2025-01-07', '2025-01-09'):
+            self.app.post(f'/api/courses/{course_id}/meetings', json={'date': date})
+        events = self.app.get(f'/api/calendar/range?start=2025-01-05&end=2025-01-14&course_id={course_id}').get_json()
+        self.assertEqual([e['classes_remaining'] for e in events], [8, 7, 5, 4])
+        self.assertEqual(self.app.get('/api/calendar/range?start=2025-01-14&end=2025-01-05').status_code, 400)
+        self.assertEqual(self.app.get('/api/calendar/range?start=2025-01-05').status_code, 400)
+        self.assertEqual(self.app.get('/api/calendar/range?start=2025-01-05&end=2025-01-14&coach_id=1').get_json(), [])
+
+    def test_course_sessions_maintained(self):
+        self.test_calendar_classes_remaining()
+        course_id = self.app.get('/api/courses').get_json()[0]['id']
+        with app.app_context():
+            self.assertEqual(CourseSession.query.filter_by(course_id=course_id).count(), 9)
+        meeting = self.app.post(f'/api/courses/{course_id}/meetings', json={'date': '2025-01-07'}).get_json()
+        self.assertIsNotNone(meeting['session_id'])
+        # Moving the course to Mondays only regenerates its sessions and relinks the meeting
+        self.app.put(f'/api/courses/{course_id}', json={'weekdays': '1'})
+        with app.app_context():
+            self.assertEqual(CourseSession.query.filter_by(course_id=course_id).count(), 8)
+            self.assertIsNone(db.session.get(CourseMeeting, meeting['id']).session_id)
+        self.assertEqual(self.app.delete(f'/api/courses/{course_id}').status_code, 204)
+        with app.app_context():
+            self.assertEqual(CourseSession.query.count(), 0)
+
+    def test_calendar_cache_invalidated_by_writes(self):
+        self.test_calendar_classes_remaining()
+        url = '/api/calendar/weekly?start_date=2025-01-19'
+        first = self.app.get(url)
+        second = self.app.get(url)
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.get_json(), second.get_json())
+        self.test_create_student_valid()
+        student_id = self.app.get('/api/students').get_json()[0]['id']
+        course_id = first.get_json()[0]['id']
+        self.app.post('/api/enrollments', json={'course_id': course_id, 'student_id': student_id})
+        third = self.app.get(url)
+        self.assertEqual(third.headers['X-Cache'], 'MISS')
+        self.assertEqual(third.get_json()[0]['enrolled_count'], 1)
+        stats = self.app.get('/api/calendar/cache-stats').get_json()
+        self.assertGreaterEqual(stats['hits'], 1)
+        self.assertLessEqual(stats['entries'], stats['max_entries'])
+        with app.app_context():
+            # The first write to a scope creates its row through the same upsert as later writes
+            self.assertEqual(bump_data_version('unused-scope'), {'unused-scope': 1})
+            self.assertEqual(bump_data_version('unused-scope', SCHEDULE_SCOPE)['unused-scope'], 2)
+            db.session.rollback()
+
+    def test_ics_feeds_and_conditional_requests(self):
+        self.test_calendar_classes_remaining()
+        course_id = self.app.get('/api/courses').get_json()[0]['id']
+        resp = self.app.get(f'/calendar/course/{course_id}.ics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/calendar'))
+        body = resp.get_data(as_text=True)
+        self.assertIn('RRULE:FREQ=WEEKLY;BYDAY=SU,TU;COUNT=8', body)
+        self.assertIn('DTSTART;TZID=', body)
+        # The TZID refers to a VTIMEZONE carrying the zone's offset changes
+        self.assertIn(f'BEGIN:VTIMEZONE\r\nTZID:{CALENDAR_TIMEZONE}\r\n', body)
+        self.assertIn('BEGIN:DAYLIGHT\r\nDTSTART:20250328T020000\r\nTZOFFSETFROM:+0200\r\nTZOFFSETTO:+0300', body)
+        etag = resp.headers['ETag']
+        again = self.app.get(f'/calendar/course/{course_id}.ics', headers={'If-None-Match': etag})
+        self.assertEqual(again.status_code, 304)
+        # Changing the course invalidates the rendered feed
+        self.app.put(f'/api/courses/{course_id}', json={'weekdays': '1,3'})
+        changed = self.app.get(f'/calendar/course/{course_id}.ics', headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertIn('BYDAY=MO,WE', changed.get_data(as_text=True))
+        self.assertEqual(self.app.get('/calendar/coach/999.ics').status_code, 404)
+
+    def test_coach_conflicts_and_free_slots(self):
+        course = {
+            'name': 'Judo',
+            'teacher': 'Coach Sam',
+            'start_date': '2030-01-06',
+            'time': '10:00',
+            'duration': 90,
+            'sessions_count': 8,
+            'weekdays': '0,2'
+        }
+        self.assertEqual(self.app.post('/api/courses', json=course).status_code, 201)
+        clash = dict(course, name='Karate', time='11:00', weekdays='2')
+        resp = self.app.post('/api/courses', json=clash)
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.get_json()['conflicts'][0]['course_name'], 'Judo')
+        forced = self.app.post('/api/courses', json=dict(clash, allow_conflicts=True))
+        self.assertEqual(forced.status_code, 201)
+        self.assertEqual(len(forced.get_json()['conflicts']), 1)
+        # Another coach at the same time, or the same coach later that day, is fine
+        self.assertEqual(self.app.post('/api/courses', json=dict(clash, name='Boxing', teacher='Coach Lee')).status_code, 201)
+        self.assertEqual(self.app.post('/api/courses', json=dict(clash, name='Yoga', time='12:30')).status_code, 201)
+
+        slots = self.app.get('/api/schedule/free-slots?coach=Coach Sam&duration=60&weekday=0').get_json()['slots']
+        self.assertEqual(slots, [{'weekday': 0, 'start': '08:00', 'end': '10:00'},
+                                 {'weekday': 0, 'start': '11:30', 'end': '22:00'}])
+        tuesday = self.app.get('/api/schedule/free-slots?coach=Coach Sam&duration=60&weekday=2').get_json()['slots']
+        self.assertEqual(tuesday[1], {'weekday': 2, 'start': '14:00', 'end': '22:00'})
+        self.assertEqual(self.app.get('/api/schedule/free-slots?coach=Coach Sam').status_code, 400)
+
+        # A rejected edit stays out of the index, even when the conflict check is what refreshes it
+        yoga_id = next(c['id'] for c in self.app.get('/api/courses').get_json() if c['name'] == 'Yoga')
+        with app.app_context():
+            bump_data_version(COURSES_SCOPE)  # logs no keys, so the next lookup rebuilds
+            db.session.commit()
+        _version_snapshots.clear()
+        self.assertEqual(self.app.put(f'/api/courses/{yoga_id}', json={'time': '10:00'}).status_code, 409)
+        tuesday = self.app.get('/api/schedule/free-slots?coach=Coach Sam&duration=60&weekday=2').get_json()['slots']
+        self.assertEqual(tuesday[1], {'weekday': 2, 'start': '14:00', 'end': '22:00'})
+        with app.app_context():
+            self.assertEqual(db.session.get(Course, yoga_id).time, '12:30')
+
+        # Linked courses are filed by coach_id: two coaches sharing a name don't block each other
+        first, second = (self.app.post('/api/coaches', json={
+            'first_name': 'Dana', 'last_name': 'Ron', 'phone': phone}).get_json()['id']
+            for phone in ('0541111111', '0542222222'))
+        taken = dict(course, name='Aikido', coach_id=first)
+        self.assertEqual(self.app.post('/api/courses', json=taken).status_code, 201)
+        self.assertEqual(self.app.post('/api/courses', json=dict(taken, name='Kendo', coach_id=second)).status_code, 201)
+        self.assertEqual(self.app.post('/api/courses', json=dict(taken, name='Sambo')).status_code, 409)
+        first_slots = self.app.get(f'/api/schedule/free-slots?coach={first}&duration=60&weekday=0').get_json()
+        self.assertEqual((first_slots['coach_id'], first_slots['slots'][0]['end']), (first, '10:00'))
+        # An ambiguous name resolves to neither coach, only to unlinked courses filed under it
+        by_name = self.app.get('/api/schedule/free-slots?coach=dana ron&duration=60&weekday=0').get_json()
+        self.assertEqual((by_name['coach_id'], by_name['slots']),
+                         (None, [{'weekday': 0, 'start': '08:00', 'end': '22:00'}]))
+
+    def test_keyset_pagination(self):
+        for i in range(5):
+            self.app.post('/api/students', json={
+                'first_name': f'Student{i}',
+                'fathers_name': 'Hassan',
+                'phone': f'050000000{i}',
+                'date_of_birth': '2010-01-01'
+            })
+        first = self.app.get('/api/students?limit=2&include_total=1').get_json()
+        self.assertEqual(first['total'], 5)
+        self.assertTrue(first['has_more'])
+        names = [s['first_name'] for s in first['items']]
+        cursor = first['next_cursor']
+        while cursor:
+            page = self.app.get(f'/api/students?limit=2&after={cursor}').get_json()
+            names += [s['first_name'] for s in page['items']]
+            cursor = page['next_cursor']
+        self.assertEqual(names, [f'Student{i}' for i in range(5)])
+        newest = self.app.get('/api/students?limit=1&order=desc').get_json()
+        self.assertEqual(newest['items'][0]['first_name'], 'Student4')
+        # Without limit the original bare array is returned
+        self.assertEqual(len(self.app.get('/api/students').get_json()), 5)
+        self.assertEqual(self.app.get('/api/students?limit=2&after=bogus').status_code, 400)
+
+    def test_payment_search_pages_through_matches(self):
+        self.test_create_course_valid()
+        course_id = self.app.get('/api/courses').get_json()[0]['id']
+        for i, name in enumerate(['Rami', 'Rana', 'Omar']):
+            student = self.app.post('/api/students', json={
+                'first_name': name, 'fathers_name': 'Hassan', 'phone': f'050000000{i}',
+                'date_of_birth': '2010-01-01'}).get_json()
+            for month in ('2025-01', '2025-02'):
+                self.app.post('/api/payments', json={'student_id': student['id'], 'course_id': course_id,
+                                                      'month': month, 'amount': 100})
+
+        def search(q, **params):
+            names, cursor = [], None
+            while True:
+                args = {'q': q, 'limit': 1, 'order': 'desc', **params}
+                if cursor:
+                    args['after'] = cursor
+                page = self.app.get('/api/payments', query_string=args).get_json()
+                names += [(p['student_name'], p['month']) for p in page['items']]
+                cursor = page['next_cursor']
+                if not cursor:
+                    return names
+
+        # Every word must match some field, and the cursor walks the matches only
+        self.assertEqual(search('ra 2025-02'), [('Rana Hassan', '2025-02'), ('Rami Hassan', '2025-02')])
+        self.assertEqual(len(search('coach sam')), 6)
+        self.assertEqual(len(search('CASH')), 6)
+        self.assertEqual(search('%'), [])
+
+    def test_student_search_normalization_and_ranking(self):
+        for first, father, phone in [('أحمد', 'إبراهيم', '0501111111'), ('أحمدي', 'خالد', '0502222222'),
+                                     ('مُحَمَّد', 'فاطمة', '0503333333'), ('אברהם', 'כהן', '0504444444')]:
+            self.app.post('/api/students', json={
+                'first_name': first, 'fathers_name': father, 'phone': phone, 'date_of_birth': '2010-01-01'})
+
+        def search(q):
+            return [s['first_name'] for s in self.app.get('/api/students/search', query_string={'q': q}).get_json()]
+
+        # Hamza forms fold together; the exact token ranks above the prefix match
+        self.assertEqual(search('احمد'), ['أحمد', 'أحمدي'])
+        self.assertEqual(search('احمد ابراهيم'), ['أحمد'])
+        self.assertEqual(search('محمد فاطمه'), ['مُحَمَّد'])
+        self.assertEqual(search('אַבְרָהָם'), ['אברהם'])
+        self.assertEqual(search('3333'), ['مُحَمَّد'])
+        self.assertEqual(search(''), [])
+
+        # Writes are applied to the index incrementally, through the keys they logged
+        rebuilds = []
+        original_load = student_search_index._load
+        student_search_index._load = lambda: rebuilds.append(1) or original_load()
+        try:
+            student_id = self.app.get('/api/students').get_json()[0]['id']
+            self.app.put(f'/api/students/{student_id}', json={'first_name': 'Samir'})
+            self.assertEqual(search('sam'), ['Samir'])
+            self.app.delete(f'/api/students/{student_id}')
+            self.assertEqual(search('samir'), [])
+            # A write by another worker is caught up on the next lookup once the version is re-read
+            with app.app_context():
+                other = Student.query.filter_by(phone='0504444444').one()
+                other.first_name = 'Avraham'
+                bump_data_version(STUDENTS_SCOPE, changed={STUDENTS_SCOPE: [other.id]})
+                db.session.commit()
+            _version_snapshots.clear()
+            self.assertEqual(search('avraham'), ['Avraham'])
+            self.assertEqual(rebuilds, [])
+            # A write that logged no keys can't be caught up on, so the index is rebuilt once
+            with app.app_context():
+                bump_data_version(STUDENTS_SCOPE)
+                db.session.commit()
+            _version_snapshots.clear()
+            self.assertEqual(search('avraham'), ['Avraham'])
+            self.assertEqual(len(rebuilds), 1)
+        finally:
+            del student_search_index._load
+        with app.app_context():
+            self.assertEqual(student_search_index.version, get_data_version(STUDENTS_SCOPE))
 
+    def test_response_cache_lru_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put('a', b'1')
+        cache.put('b', b'2')
+        cache.get('a')
+        cache.put('c', b'3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+if __name__ == '__main__':
     if 'test' in sys.argv:
-        unittest.main(argv=['first-arg-is-ignored'], exit=False)
+        # Exit with the suite's status rather than carry on setting up an app the tests already used
+        result = unittest.main(argv=['first-arg-is-ignored'], exit=False).result
+        sys.exit(0 if result.wasSuccessful() else 1)
 _schema_checked = False
 
 
 @app.before_request
 def ensure_schema_on_first_request():
-    """Ensure required tables exist; runs once per process.
+    """Check the schema version once per process, migrating only when the database is behind.
     Compatible with Flask versions that don't expose before_first_request.
     """
     global _schema_checked
     if _schema_checked:
         return
     try:
-        inspector = db.inspect(db.engine)
-        if 'coaches' not in inspector.get_table_names():
-            # Only create the coaches table if it's missing; avoid heavy migrations here
-            Coach.__table__.create(db.engine)
-            logger.info("Created 'coaches' table")
+        run_migrations()
     except Exception as e:
-        logger.error(f"Failed to ensure coaches table exists: {e}")
+        db.session.rollback()
+        logger.error(f"Failed to check the database schema: {e}")
     finally:
-        _schema_checked = True
\ No newline at end of file
+        _schema_checked = True
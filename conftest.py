@@ -0,0 +1,5 @@
+import os
+
+# app.py creates its engine at import and the suite drops every table in tearDown, so pick the
+# database before pytest imports it: in-memory SQLite unless TEST_DATABASE_URL names a scratch one.
+os.environ['DATABASE_URL'] = os.getenv('TEST_DATABASE_URL', 'sqlite:///:memory:')
@@ -0,0 +1,43 @@
+"""
+Gunicorn settings. Gunicorn loads ./gunicorn.conf.py automatically, so the Procfile command picks this up.
+
+Workers are gthread workers: each process serves GUNICORN_THREADS requests concurrently, so a slow Green Invoice
+or SendGrid call ties up one thread instead of the whole site. GUNICORN_WORKERS (or WEB_CONCURRENCY) and
+GUNICORN_THREADS override the defaults. Each worker's database pool is sized to its thread count through
+DB_POOL_SIZE, so the database sees at most workers x (threads + DB_MAX_OVERFLOW) connections.
+
+Every worker writes its Prometheus samples to PROMETHEUS_MULTIPROC_DIR, which /metrics aggregates across
+workers. The directory is emptied when the master starts, and the files of exited workers are marked dead.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = 'gthread'
+# Containers often report the host's cores, so the default is capped; at least 2 so a restarting worker isn't an outage
+workers = int(os.getenv('GUNICORN_WORKERS') or os.getenv('WEB_CONCURRENCY') or min(max(multiprocessing.cpu_count(), 2), 8))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+# Above the 30 s Green Invoice timeouts, so a slow upstream fails the request instead of killing the worker
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = 30
+# Railway's proxy reuses connections; keep them open a little longer than gunicorn's 2 s default
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# Read by app.py when the worker creates its engine: one connection per thread
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+# Set before any worker imports prometheus_client, which picks its storage at import time
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'nest-prometheus'))
+
+
+def on_starting(server):
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -5,9 +5,16 @@ let currentCourseId = null;
 let currentStudentId = null;
 let allStudents = [];
 let allCourses = [];
-let allEnrollments = [];
 let allCoaches = [];
 
+// Keyset pagination state for the list views
+const PAGE_SIZE = 50;
+let studentsCursor = null;
+let studentsTotal = 0;
+let paymentsCursor = null;
+let paymentsSearch = '';  // server-side filter applied to every payments page
+let enrollmentsTotal = 0;
+
 // Tooltip element for calendar events
 let calendarTooltip = null;
 
@@ -39,6 +46,7 @@ const translations = {
     'First Name': 'First Name',
     'Last Name': 'Last Name',
     'Duration (minutes)': 'Duration (minutes)',
+    'Monthly Fee (₪)': 'Monthly Fee (₪)',
     'Invoice': 'Invoice',
     'Add Course': 'Add Course',
     'Add Student': 'Add Student',
@@ -118,6 +126,7 @@ const translations = {
     'Select method...': 'Select method...',
     'Participant': 'Participant',
     'Export Payments': 'Export Payments',
+    'Load more': 'Load more',
     'Export Description': 'Export payment data to Excel for detailed analysis and reporting'
   },
   he: {
@@ -138,6 +147,7 @@ const translations = {
     'Week': 'שבוע',
     'Day': 'יום',
     'Duration (minutes)': 'משך (בדקות)',
+    'Monthly Fee (₪)': 'תשלום חודשי (₪)',
     'years': 'שנים',
     'Month': 'חודש',
     'Students': 'תלמידים',
@@ -212,6 +222,7 @@ const translations = {
     'Select method...': 'בחירת דרך תשלום',
     'Participant': 'משתתף',
     'Export Payments': 'ייצוא תשלומים',
+    'Load more': 'טען עוד',
     'Export Description': 'ייצא נתוני תשלומים לאקסל לניתוח מפורט ודיווח'
   }
 };
@@ -249,9 +260,6 @@ function setLang(lang) {
   const ss = document.getElementById('studentSearch')?.value?.trim();
   if (ss && typeof filterStudents === 'function') filterStudents();
 
-  const ps = document.getElementById('paymentSearch')?.value?.trim();
-  if (ps && typeof filterPayments === 'function') filterPayments();
-
   // Calendar needs a fresh render to localize month/day names
   if (typeof loadCalendarData === 'function') loadCalendarData();
 }
@@ -345,7 +353,7 @@ function setupEventListeners() {
     document.getElementById('addStudentForm').addEventListener('submit', handleAddStudent);
 
     // Student search
-    document.getElementById('studentSearch').addEventListener('input', filterStudents);
+    document.getElementById('studentSearch').addEventListener('input', debounce(filterStudents));
 
     // Coaches tab controls (if present)
     const coachSearchEl = document.getElementById('coachSearch');
@@ -362,7 +370,7 @@ function setupEventListeners() {
     document.getElementById('courseSearch').addEventListener('input', filterCourses);
 
     // Payment search
-    document.getElementById('paymentSearch').addEventListener('input', filterPayments);
+    document.getElementById('paymentSearch').addEventListener('input', debounce(filterPayments));
 
     // Analysis period change
     document.getElementById('analysisPeriod').addEventListener('change', loadAnalysis);
@@ -438,13 +446,44 @@ function loadInitialData() {
     loadEnrollments();
 }
 
+// Fetch one keyset page ({items, next_cursor, has_more, total}) from a list endpoint
+async function fetchPage(url, { after = null, limit = PAGE_SIZE, total = false, order = null, q = null } = {}) {
+    const params = new URLSearchParams({ limit });
+    if (after) params.set('after', after);
+    if (total) params.set('include_total', '1');
+    if (order) params.set('order', order);
+    if (q) params.set('q', q);
+    const response = await fetch(`${url}?${params}`);
+    if (!response.ok) throw new Error(`Failed to load ${url}`);
+    return response.json();
+}
+
+async function fetchAllPages(url) {
+    let items = [];
+    let after = null;
+    do {
+        const page = await fetchPage(url, { after, limit: 500 });
+        items = items.concat(page.items);
+        after = page.next_cursor;
+    } while (after);
+    return items;
+}
+
+function loadMoreButton(handlerName, cursor) {
+    if (!cursor) return '';
+    return `<div class="col-span-full text-center py-4">
+      <button onclick="${handlerName}()" class="btn btn-secondary btn-sm">${t('Load more')}</button>
+    </div>`;
+}
+
 async function loadEnrollments() {
     try {
-        const response = await fetch('/api/enrollments');
-        allEnrollments = await response.json();
+        // Only the count is needed (courses summary)
+        const page = await fetchPage('/api/enrollments', { limit: 1, total: true });
+        enrollmentsTotal = page.total;
     } catch (error) {
         console.error('Error loading enrollments:', error);
-        allEnrollments = [];
+        enrollmentsTotal = 0;
     }
 }
 
@@ -704,8 +743,7 @@ async function loadCalendarData() {
 // Course Functions
 async function loadCourses() {
     try {
-        const response = await fetch('/api/courses');
-        allCourses = await response.json();
+        allCourses = await fetchAllPages('/api/courses');
         renderCourses();
     } catch (error) {
         console.error('Error loading courses:', error);
@@ -831,22 +869,39 @@ async function handleAddCourse(e) {
     const formData = {
       name: document.getElementById('courseName').value,
       teacher: `${coachMatch.first_name} ${coachMatch.last_name}`.trim(),
+      coach_id: coachMatch.id,
       start_date: document.getElementById('courseStartDate').value,
       time: document.getElementById('courseTime').value,
       duration: parseInt(document.getElementById('courseDuration').value),
+      monthly_fee: document.getElementById('courseMonthlyFee').value || null,
       sessions_count: parseInt(document.getElementById('courseSessionsCount').value),
       // sessions_per_week is derived on the server from weekdays
       weekdays: selectedWeekdays.join(','),
       color: color
     };
     try {
-        const response = await fetch('/api/courses', {
+        let response = await fetch('/api/courses', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify(formData)
         });
+        if (response.status === 409) {
+            const errorData = await response.json().catch(() => ({}));
+            if (!errorData.conflicts) {
+                alert(errorData.error || 'Error creating course');
+                return;
+            }
+            if (!confirm(describeCoachConflicts(errorData.conflicts))) return;
+            response = await fetch('/api/courses', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ ...formData, allow_conflicts: true })
+            });
+        }
         if (response.ok) {
             closeAllModals();
             document.getElementById('addCourseForm').reset();
@@ -869,6 +924,12 @@ async function handleAddCourse(e) {
     }
 }
 
+function describeCoachConflicts(conflicts) {
+    const dayNames = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday'];
+    const lines = conflicts.map(c => `• ${c.course_name}: ${dayNames[c.weekday]} ${c.time}-${c.end_time}`);
+    return `This coach is already booked at this time:\n${lines.join('\n')}\n\nSave anyway?`;
+}
+
 async function deleteCourse(courseId) {
     console.log('Attempting to delete course:', courseId);
     const course = allCourses.find(c => c.id === courseId);
@@ -911,19 +972,49 @@ async function deleteCourse(courseId) {
 // Student Functions
 async function loadStudents() {
     try {
-        const response = await fetch('/api/students');
-        allStudents = await response.json();
+        const page = await fetchPage('/api/students', { total: true });
+        allStudents = page.items;
+        studentsCursor = page.next_cursor;
+        studentsTotal = page.total;
+        renderStudents();
+    } catch (error) {
+        console.error('Error loading students:', error);
+    }
+}
+
+async function loadMoreStudents() {
+    if (!studentsCursor) return;
+    try {
+        const page = await fetchPage('/api/students', { after: studentsCursor });
+        allStudents = allStudents.concat(page.items);
+        studentsCursor = page.next_cursor;
         renderStudents();
     } catch (error) {
         console.error('Error loading students:', error);
     }
 }
 
+// Ranked server-side search; the index normalizes Arabic/Hebrew spelling variants
+async function searchStudents(term, limit = 20) {
+    const params = new URLSearchParams({ q: term, limit });
+    const response = await fetch(`/api/students/search?${params}`);
+    if (!response.ok) throw new Error(`Search failed: ${response.status}`);
+    return response.json();
+}
+
+// Delay a handler until typing pauses so each keystroke does not hit the server
+function debounce(fn, wait = 250) {
+    let timer;
+    return function(...args) {
+        clearTimeout(timer);
+        timer = setTimeout(() => fn.apply(this, args), wait);
+    };
+}
+
 // Coaches view (aggregated from courses/enrollments/payments)
 async function loadCoaches() {
     try {
-        const resp = await fetch('/api/coaches');
-        allCoaches = await resp.json();
+        allCoaches = await fetchAllPages('/api/coaches');
         renderCoaches();
     } catch (err) {
         console.error('Error loading coaches:', err);
@@ -1103,18 +1194,28 @@ function renderStudents() {
         </div>
       </div>
     </div>
-  `).join('');
+  `).join('') + loadMoreButton('loadMoreStudents', studentsCursor);
 }
 
 
-function filterStudents() {
-  const searchTerm = document.getElementById('studentSearch').value.toLowerCase();
-  const filteredStudents = allStudents.filter(student =>
-    student.first_name.toLowerCase().includes(searchTerm) ||
-    student.fathers_name.toLowerCase().includes(searchTerm) ||
-    student.phone.includes(searchTerm) ||
-    (student.national_id || '').includes(searchTerm)
-  );
+let studentSearchSeq = 0;
+
+async function filterStudents() {
+  const searchTerm = document.getElementById('studentSearch').value.trim();
+  const seq = ++studentSearchSeq;
+  if (!searchTerm) {
+    renderStudents();
+    return;
+  }
+  let filteredStudents;
+  try {
+    filteredStudents = await searchStudents(searchTerm, 100);
+  } catch (error) {
+    console.error('Error searching students:', error);
+    return;
+  }
+  // A newer keystroke has started its own search; drop this stale result
+  if (seq !== studentSearchSeq) return;
 
   const container = document.getElementById('studentsList');
   if (filteredStudents.length === 0) {
@@ -1189,10 +1290,15 @@ async function handleAddStudent(e) {
 
 async function deleteStudent(studentId) {
     console.log('Attempting to delete student:', studentId);
-    const student = allStudents.find(s => s.id === studentId);
+    // Search results can include students outside the loaded pages, so fall back to the API for the name
+    let student = allStudents.find(s => s.id === studentId);
     if (!student) {
-        console.error('Student not found:', studentId);
-        return;
+        const lookup = await fetch(`/api/students/${studentId}`);
+        if (!lookup.ok) {
+            console.error('Student not found:', studentId);
+            return;
+        }
+        student = await lookup.json();
     }
     
     const studentName = `${student.first_name} ${student.fathers_name}`;
@@ -1211,6 +1317,8 @@ async function deleteStudent(studentId) {
         if (response.ok) {
             console.log('Student deleted successfully, reloading data...');
             await loadStudents();
+            // Keep an active search showing its results, minus the deleted student
+            if (document.getElementById('studentSearch')?.value?.trim()) await filterStudents();
         } else {
             const errorData = await response.json().catch(() => ({}));
             const errorMessage = errorData.error || 'Error deleting student';
@@ -1511,10 +1619,29 @@ let allPayments = [];
 let coachIncomeChart = null;
 let courseIncomeChart = null;
 
+let paymentSearchSeq = 0;
+
 async function loadPayments() {
+    const seq = ++paymentSearchSeq;
     try {
-        const response = await fetch('/api/payments');
-        allPayments = await response.json();
+        // Newest first, one page at a time, filtered on the server by the search box
+        const page = await fetchPage('/api/payments', { order: 'desc', q: paymentsSearch });
+        // A newer search has started its own load; drop this stale result
+        if (seq !== paymentSearchSeq) return;
+        allPayments = page.items;
+        paymentsCursor = page.next_cursor;
+        renderPayments();
+    } catch (error) {
+        console.error('Error loading payments:', error);
+    }
+}
+
+async function loadMorePayments() {
+    if (!paymentsCursor) return;
+    try {
+        const page = await fetchPage('/api/payments', { after: paymentsCursor, order: 'desc', q: paymentsSearch });
+        allPayments = allPayments.concat(page.items);
+        paymentsCursor = page.next_cursor;
         renderPayments();
     } catch (error) {
         console.error('Error loading payments:', error);
@@ -1524,7 +1651,9 @@ async function loadPayments() {
 function renderPayments() {
   const container = document.getElementById('paymentsList');
   if (allPayments.length === 0) {
-    container.innerHTML = '<div class="text-center text-gray-500 py-8">No payments found. Add your first payment!</div>';
+    container.innerHTML = paymentsSearch
+      ? '<div class="text-center text-gray-500 py-8">No payments found matching your search.</div>'
+      : '<div class="text-center text-gray-500 py-8">No payments found. Add your first payment!</div>';
     return;
   }
 
@@ -1572,71 +1701,14 @@ function renderPayments() {
         </div>
       </div>
     </div>
-  `).join('');
+  `).join('') + loadMoreButton('loadMorePayments', paymentsCursor);
 }
 
 
+// Search matches student, course, coach, month and method across all payments, not just the loaded pages
 function filterPayments() {
-  const searchTerm = document.getElementById('paymentSearch').value.toLowerCase();
-  const filtered = allPayments.filter(p =>
-    p.student_name.toLowerCase().includes(searchTerm) ||
-    p.course_name.toLowerCase().includes(searchTerm) ||
-    p.teacher_name.toLowerCase().includes(searchTerm) ||
-    (p.month || '').toLowerCase().includes(searchTerm) ||
-    (p.payment_method || '').toLowerCase().includes(searchTerm)
-  );
-
-  const container = document.getElementById('paymentsList');
-  if (filtered.length === 0) {
-    container.innerHTML = '<div class="text-center text-gray-500 py-8">No payments found matching your search.</div>';
-    return;
-  }
-
-  container.innerHTML = filtered.map(payment => `
-    <div class="payment-card">
-      <div class="flex justify-between items-start">
-        <div class="flex-1">
-          <h3 class="text-lg font-semibold text-gray-900">${payment.student_name}</h3>
-          <div class="text-sm text-gray-600 space-y-1">
-            <p class="flex items-center gap-2">
-              <i class="fas fa-dumbbell"></i>
-              <span>${t('Course') ? t('Course') + ': ' : 'Course: '}${payment.course_name}</span>
-            </p>
-            <p class="flex items-center gap-2">
-              <i class="fas fa-user"></i>
-              <span>${t('Coach') ? t('Coach') + ': ' : 'Coach: '}${payment.teacher_name}</span>
-            </p>
-            <p class="flex items-center gap-2">
-              <i class="fas fa-calendar"></i>
-              <span>${t('Month') ? t('Month') + ': ' : 'Month: '}${payment.month}</span>
-            </p>
-            <p class="flex items-center gap-2">
-              <i class="fas fa-money-bill-wave"></i>
-              <span>${t('Payment Method') ? t('Payment Method') + ': ' : 'Payment Method: '}${formatPaymentMethod(payment.payment_method)}</span>
-            </p>
-            <p class="flex items-center gap-2 payment-date">
-              <i class="fas fa-clock"></i>
-              <span>${t('Date') ? t('Date') + ': ' : 'Date: '}${payment.payment_date}</span>
-            </p>
-          </div>
-        </div>
-
-        <div class="flex flex-col items-end gap-2">
-          <div class="payment-amount">₪${payment.amount.toFixed(2)}</div>
-          <div class="flex gap-2">
-            <button onclick="generateInvoice(${payment.id})"
-                    class="btn btn-success btn-sm inline-flex items-center gap-2">
-              <i class="fas fa-file-invoice"></i><span>${t('Invoice')}</span>
-            </button>
-            <button onclick="deletePayment(${payment.id})"
-                    class="btn btn-danger btn-sm inline-flex items-center gap-2" aria-label="Delete payment">
-              <i class="fas fa-trash"></i><span></span>
-            </button>
-          </div>
-        </div>
-      </div>
-    </div>
-  `).join('');
+  paymentsSearch = document.getElementById('paymentSearch').value.trim();
+  return loadPayments();
 }
 
 
@@ -1690,7 +1762,7 @@ async function handleAddPayment(e) {
       selectedPaymentStudentId = null;
       selectedPaymentCourseId  = null;
       // Optimistically add the new payment card without a full reload
-      if (Array.isArray(allPayments)) {
+      if (Array.isArray(allPayments) && !paymentsSearch) {
         allPayments.unshift(newPayment);
         renderPayments();
       } else {
@@ -1790,14 +1862,19 @@ async function legacyPreviewInvoice(paymentId) {
 // Analysis Functions
 async function loadAnalysis() {
     const period = document.getElementById('analysisPeriod').value;
-    await Promise.all([
-        loadCoachIncomeChart(period),
-        loadCourseIncomeChart(period),
-        loadAnalysisSummary(period)
-    ]);
+    try {
+        // One request answers the charts and the summary
+        const response = await fetch(`/api/analysis/dashboard?period=${period}`);
+        const dashboard = await response.json();
+        renderCoachIncomeChart(dashboard.coach_income);
+        renderCourseIncomeChart(dashboard.course_income);
+        renderAnalysisSummary(dashboard.summary);
+    } catch (error) {
+        console.error('Error loading analysis:', error);
+    }
 }
 
-async function loadCoachIncomeChart(period) {
+function renderCoachIncomeChart(data) {
     try {
         // Reset the canvas
         const oldCanvas = document.getElementById('coachIncomeChart');
@@ -1805,9 +1882,6 @@ async function loadCoachIncomeChart(period) {
         const newCanvas = oldCanvas.cloneNode(false);
         parent.replaceChild(newCanvas, oldCanvas);
         
-        const response = await fetch(`/api/analysis/coach-income?period=${period}`);
-        const data = await response.json();
-        
         const ctx = newCanvas.getContext('2d');
         
         if (coachIncomeChart) {
@@ -1855,7 +1929,7 @@ async function loadCoachIncomeChart(period) {
     }
 }
 
-async function loadCourseIncomeChart(period) {
+function renderCourseIncomeChart(data) {
     try {
         // Reset the canvas
         const oldCanvas = document.getElementById('courseIncomeChart');
@@ -1863,9 +1937,6 @@ async function loadCourseIncomeChart(period) {
         const newCanvas = oldCanvas.cloneNode(false);
         parent.replaceChild(newCanvas, oldCanvas);
         
-        const response = await fetch(`/api/analysis/course-income?period=${period}`);
-        const data = await response.json();
-        
         const ctx = newCanvas.getContext('2d');
         
         if (courseIncomeChart) {
@@ -1911,11 +1982,8 @@ async function loadCourseIncomeChart(period) {
     }
 }
 
-async function loadAnalysisSummary(period) {
+function renderAnalysisSummary(data) {
     try {
-        const response = await fetch(`/api/analysis/summary?period=${period}`);
-        const data = await response.json();
-        
         document.getElementById('totalRevenue').textContent = '₪' + data.total_revenue.toLocaleString();
         document.getElementById('totalPayments').textContent = data.total_payments.toLocaleString();
         document.getElementById('averagePayment').textContent = '₪' + data.average_payment.toFixed(2);
@@ -1934,13 +2002,12 @@ async function exportPaymentsToExcel() {
     }
     
     isExporting = true;
+    const exportBtn = document.getElementById('exportPayments');
+    const originalText = exportBtn.innerHTML;
+    const originalClasses = exportBtn.className;
     
     try {
         // Show loading state
-        const exportBtn = document.getElementById('exportPayments');
-        const originalText = exportBtn.innerHTML;
-        const originalClasses = exportBtn.className;
-        
         exportBtn.innerHTML = '<i class="fas fa-spinner fa-spin mr-2"></i>Exporting...';
         exportBtn.disabled = true;
         exportBtn.className = originalClasses + ' btn-exporting';
@@ -1948,40 +2015,37 @@ async function exportPaymentsToExcel() {
         // Get current period filter
         const period = document.getElementById('analysisPeriod').value;
 
-        // Fetch the Excel file with period filter
-        const response = await fetch(`/api/payments/export?period=${period}`);
-        
+        // Queue the export as a background job and poll it, so a large export never hits a request timeout
+        const response = await fetch('/api/export-jobs', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ kind: 'payments_xlsx', period: period })
+        });
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
+        let job = await response.json();
+        while (job.status === 'queued' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const statusResponse = await fetch(job.status_url);
+            if (!statusResponse.ok) {
+                throw new Error(`HTTP error! status: ${statusResponse.status}`);
+            }
+            job = await statusResponse.json();
+            if (job.progress !== null) {
+                exportBtn.innerHTML = `<i class="fas fa-spinner fa-spin mr-2"></i>Exporting ${Math.round(job.progress * 100)}%`;
+            }
+        }
+        if (job.status !== 'done') {
+            throw new Error(job.error || 'Export failed');
+        }
 
-        // Get the blob from the response
-        const blob = await response.blob();
-        
-        // Create a download link
-        const url = window.URL.createObjectURL(blob);
+        // The server sends the finished file as an attachment, so the browser downloads it without leaving the page
         const a = document.createElement('a');
         a.style.display = 'none';
-        a.href = url;
-        
-        // Get filename from response headers or use default
-        const contentDisposition = response.headers.get('content-disposition');
-        let filename = 'payments.xlsx';
-        if (contentDisposition) {
-            const filenameMatch = contentDisposition.match(/filename="(.+)"/);
-            if (filenameMatch) {
-                filename = filenameMatch[1];
-            }
-        }
-        
-        a.download = filename;
-        
-        // Trigger download
+        a.href = job.download_url;
         document.body.appendChild(a);
         a.click();
-        
-        // Cleanup
-        window.URL.revokeObjectURL(url);
         document.body.removeChild(a);
         
         // Show success state
@@ -2000,7 +2064,6 @@ async function exportPaymentsToExcel() {
         console.error('Error exporting payments:', error);
         
         // Show error state briefly
-        const exportBtn = document.getElementById('exportPayments');
         exportBtn.innerHTML = '<i class="fas fa-exclamation-triangle mr-2"></i>Error!';
         exportBtn.disabled = false;
         exportBtn.className = originalClasses + ' btn-danger';
@@ -2174,23 +2237,16 @@ function setupAddMeetingModalEvents() {
             alert('Please select a date');
             return;
         }
-        // Create meeting
+        // Create meeting and its attendance in one request
         const res = await fetch(`/api/courses/${courseId}/meetings`, {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({date, notes})
+            body: JSON.stringify({date, notes, attendance})
         });
         if (!res.ok) {
             alert('Error creating meeting');
             return;
         }
-        const meeting = await res.json();
-        // Save attendance
-        await fetch(`/api/meetings/${meeting.id}/attendance`, {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({attendance})
-        });
         closeAllModals();
         await renderMeetingsLog(courseId, enrolledStudents);
     };
@@ -2283,9 +2339,9 @@ function renderCoursesSummary() {
         return start <= today && today <= end;
     }).length;
     // Total students
-    const totalStudents = allStudents.length;
+    const totalStudents = studentsTotal;
     // Total enrollments
-    const totalEnrollments = allEnrollments.length;
+    const totalEnrollments = enrollmentsTotal;
     // Unique coaches
     const uniqueCoaches = new Set(allCourses.map(c => c.teacher)).size;
     // Update DOM
@@ -2312,20 +2368,22 @@ loadStudents = async function() {
 function setupPaymentStudentSearch() {
     const input = document.getElementById('paymentStudentInput');
     const dropdown = document.getElementById('paymentStudentDropdown');
-    input.addEventListener('input', function() {
-        const term = input.value.toLowerCase();
+    input.addEventListener('input', debounce(async function() {
+        const term = input.value.trim();
         if (!term) {
             dropdown.innerHTML = '';
             dropdown.classList.add('hidden');
             selectedPaymentStudentId = null;
             return;
         }
-        const matches = allStudents.filter(s =>
-            s.first_name.toLowerCase().includes(term) ||
-            s.fathers_name.toLowerCase().includes(term) ||
-            s.phone.includes(term) ||
-            s.national_id.includes(term)
-        );
+        let matches;
+        try {
+            matches = await searchStudents(term);
+        } catch (error) {
+            console.error('Error searching students:', error);
+            return;
+        }
+        if (input.value.trim() !== term) return;
         if (matches.length === 0) {
             dropdown.innerHTML = '<div class="p-2 text-gray-500">No matches found</div>';
             dropdown.classList.remove('hidden');
@@ -2343,7 +2401,7 @@ function setupPaymentStudentSearch() {
                 dropdown.classList.add('hidden');
             };
         });
-    });
+    }));
     input.addEventListener('blur', function() {
         setTimeout(() => dropdown.classList.add('hidden'), 200);
     });
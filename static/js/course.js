@@ -533,11 +533,23 @@ async function saveCourseEdits() {
       color: document.getElementById('editCourseColor').value
     };
     try {
-        const resp = await fetch(`/api/courses/${courseId}`, {
+        let resp = await fetch(`/api/courses/${courseId}`, {
             method: 'PUT',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify(updated)
         });
+        if (resp.status === 409) {
+            const errorData = await resp.json().catch(() => ({}));
+            const names = (errorData.conflicts || []).map(c => `• ${c.course_name} (${c.time}-${c.end_time})`);
+            if (!names.length || !confirm(`This coach is already booked at this time:\n${names.join('\n')}\n\nSave anyway?`)) {
+                return;
+            }
+            resp = await fetch(`/api/courses/${courseId}`, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ...updated, allow_conflicts: true })
+            });
+        }
         if (resp.ok) {
             courseData = await resp.json();
             closeEditCourseModal();
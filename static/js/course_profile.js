@@ -370,14 +370,13 @@
     }
 
     try {
-      for (const studentId of selected) {
-        const resp = await fetch('/api/enrollments', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ course_id: courseId, student_id: studentId })
-        });
-        if (!resp.ok) throw new Error(`Failed to enroll student ${studentId}`);
-      }
+      // One request for the whole selection; students already in the course are skipped by the server
+      const resp = await fetch('/api/enrollments/bulk', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ course_id: courseId, student_ids: selected })
+      });
+      if (!resp.ok) throw new Error(`Failed to enroll students: ${resp.status}`);
 
       window.closeEnrollStudentsModal();
       window.location.reload();